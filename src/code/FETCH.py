@@ -11,11 +11,19 @@ from TSD.few_shot.prototypical_batch_sampler import PrototypicalBatchSampler
 from TSD.few_shot.prototypical_loss import prototypical_loss as loss_fn
 from TSD.few_shot.prototypical_loss import get_prototypes, prototypical_evaluation
 from TSD.code.parser_util import get_parser
-from TSD.code.tuh_dataset import get_data, get_dataloader
+from TSD.code.tuh_dataset import get_data, get_dataloader, get_manifest, get_shard_directory, make_loader
+from TSD.code.tensor_loader import Prefetcher
 from TSD.few_shot.support_set_const import seizure_support_set, non_seizure_support_set
 from TSD.code.utils import thresh_max_f1
 from TSD.code.utils import create_dataframe, channel_list_to_node_set
 from TSD.code.utils import get_df_with_num_nodes
+from TSD.code.patch_cache import PatchEmbeddingCache
+from TSD.code.multi_config import evaluate_config_block
+from TSD.code.support_cache import load_support_set, PrototypeCache
+from TSD.code.results_store import ResultsStore
+from TSD.code.sweep_runner import run_sharded
+from TSD.code.embedding_store import EmbeddingStore
+from TSD.code.successive_halving import successive_halving
 from sklearn.metrics import roc_auc_score, confusion_matrix, accuracy_score, f1_score
 
 from tqdm import tqdm
@@ -24,7 +32,6 @@ import pandas as pd
 import torch
 import os
 from vit_pytorch.vit import ViT
-import pickle
 
 
 def init_seed(opt):
@@ -73,15 +80,16 @@ def init_dataloader(opt, full_validation=False):
                        event_base=False, masking=False,
                        random_mask=False, remove_not_used=False)
 
+    device = 'cuda:0' if torch.cuda.is_available() and opt.cuda else 'cpu'
     tr_sampler = init_sampler(opt, train_label, mode="train")
-    tr_dataloader = torch.utils.data.DataLoader(tr_dataset, batch_sampler=tr_sampler, num_workers=6)
+    tr_dataloader = make_loader(tr_dataset, batch_sampler=tr_sampler, device=device)
     if full_validation:
-        val_dataloader = torch.utils.data.DataLoader(val_dataset, batch_size=2048, num_workers=6)
+        val_dataloader = make_loader(val_dataset, batch_size=2048, device=device)
     else:
         val_sampler = init_sampler(opt, val_label, mode="val")
-        val_dataloader = torch.utils.data.DataLoader(val_dataset, batch_sampler=val_sampler, num_workers=6)
+        val_dataloader = make_loader(val_dataset, batch_sampler=val_sampler, device=device)
 
-    test_dataloader = torch.utils.data.DataLoader(test_dataset, batch_size=2048, num_workers=6)
+    test_dataloader = make_loader(test_dataset, batch_size=2048, device=device)
 
     return tr_dataloader, val_dataloader, test_dataloader
 
@@ -153,21 +161,24 @@ def get_mask(df=None, selected_channel_id=-1):
     return MASK
 
 
+def masked_forward(opt, model, x, mask):
+    """
+    Run the model on a batch of windows with the channels in mask absent
+    """
+    if opt.sweep_mode == 'token_drop':
+        # only the tokens of the present channels go through the transformer
+        return model(x.reshape((x.shape[0], 1, -1, x.shape[3])), channel_mask=mask)
+
+    x[:, mask, :, :] = -1  # mask the channels
+    x = x.reshape((x.shape[0], 1, -1, x.shape[3]))
+    return model(x)
+
+
 def get_support_set(opt):
-    support_set = []
-    labels = []
-    for label, class_support_set in enumerate([non_seizure_support_set, seizure_support_set]):
-        for filename in class_support_set:
-            filepath = os.path.join(opt.save_directory,
-                                    "task-binary_datatype-train_STFT/",
-                                    filename + ".pkl")
-            with open(filepath, 'rb') as f:
-                data_pkl = pickle.load(f)
-                signals = np.asarray(data_pkl['STFT'])
-                support_set.append(signals)
-                labels.append(label)
-
-    return np.array(support_set), np.array(labels)
+    # loaded from disk only once per process
+    return load_support_set(opt.save_directory, [non_seizure_support_set, seizure_support_set],
+                            manifest=get_manifest(opt.save_directory),
+                            shard_dir=get_shard_directory(opt.save_directory, 'train'))
 
 
 def train(opt, tr_dataloader, model, optim, lr_scheduler, val_dataloader=None):
@@ -199,6 +210,10 @@ def train(opt, tr_dataloader, model, optim, lr_scheduler, val_dataloader=None):
     df_num_nodes = df[df['number_nodes'] == opt.num_nodes]
     print("df_num_nodes", df_num_nodes.sample(n=5))
 
+    tr_dataloader = Prefetcher(tr_dataloader, device, depth=opt.prefetch_depth)
+    if val_dataloader is not None:
+        val_dataloader = Prefetcher(val_dataloader, device, depth=opt.prefetch_depth)
+
     for epoch in range(opt.epochs):
         print('=== Epoch: {} ==='.format(epoch))
         tr_iter = iter(tr_dataloader)
@@ -226,6 +241,7 @@ def train(opt, tr_dataloader, model, optim, lr_scheduler, val_dataloader=None):
         avg_loss = np.mean(train_loss[-opt.iterations:])
         avg_acc = np.mean(train_acc[-opt.iterations:])
         print('Avg Train Loss: {}, Avg Train Acc: {}'.format(avg_loss, avg_acc))
+        print('Data wait: {:.1f}s over {} steps'.format(*tr_dataloader.data_wait()))
         lr_scheduler.step()
         if val_dataloader is None:
             continue
@@ -267,84 +283,307 @@ def train(opt, tr_dataloader, model, optim, lr_scheduler, val_dataloader=None):
     return best_state, best_acc, train_loss, train_acc, val_loss, val_acc
 
 
+def split_auc(opt, dataloader, model, prototypes, mask, device, outputs=None):
+    """
+    Compute the AUC of a split, with the channels in mask absent
+    If outputs is a list, the model outputs of the split are appended to it
+    """
+    prob_all = torch.zeros(len(dataloader.dataset), dtype=torch.float32).to(device)
+    label_all = torch.zeros(len(dataloader.dataset), dtype=torch.int).to(device)
+
+    for i, batch in enumerate(tqdm(Prefetcher(dataloader, device, depth=opt.prefetch_depth))):
+        x, y = batch
+        x, y = x.to(device), y.to(device)
+        model_output = masked_forward(opt, model, x, mask)
+        prob, _ = prototypical_evaluation(prototypes, model_output)
+
+        start_idx = i * dataloader.batch_size
+        end_idx = start_idx + x.size(0)
+
+        prob_all[start_idx:end_idx] = prob.detach()
+        label_all[start_idx:end_idx] = y.detach()
+        if outputs is not None:
+            outputs.append(model_output.detach().cpu())
+
+    label_all = label_all.cpu().numpy()
+    prob_all = prob_all.cpu().numpy()
+    return roc_auc_score(label_all, prob_all)
+
+
+def cached_split_auc(patch_cache, split, model, prototypes, mask, device, batch_size, outputs=None):
+    """
+    Compute the AUC of a split from the cached patch embeddings, with the channels in mask absent
+    If outputs is a list, the model outputs of the split are appended to it
+    """
+    prob_all = []
+    label_all = []
+    with torch.no_grad():
+        for tokens, y in patch_cache.masked_batches(split, mask, batch_size, device):
+            model_output = model.forward_patches(tokens)
+            prob, _ = prototypical_evaluation(prototypes, model_output)
+            prob_all.append(prob.cpu())
+            label_all.append(y)
+            if outputs is not None:
+                outputs.append(model_output.cpu())
+
+    return roc_auc_score(torch.cat(label_all).numpy(), torch.cat(prob_all).numpy())
+
+
 def test(opt, test_dataloader, val_dataloader, model, device,
-         df, selected_channel_id):
+         df, selected_channel_id, patch_cache=None, prototype_cache=None, embedding_store=None):
     """
     Test the model trained with the prototypical learning algorithm
+    If patch_cache is given, the val/test windows are taken from the cached patch embeddings
+    If prototype_cache is given, the prototypes of the configuration are reused when available
+    If embedding_store is given, the model outputs are saved to re-score the configuration later
     """
 
     model.eval()
 
-    x_support_set, y_support_set = get_support_set(opt)  # TODO: move this to the main function
-    x_support_set = torch.tensor(x_support_set).to(device)
-    y_support_set = torch.tensor(y_support_set).to(device)
-
     mask = get_mask(df=df, selected_channel_id=selected_channel_id)
-    x_support_set[:, mask, :, :] = -1  # mask the channels
-    x = x_support_set.reshape((x_support_set.shape[0], 1, -1, x_support_set.shape[3]))
-    model_output = model(x)
 
-    prototypes = get_prototypes(model_output, target=y_support_set).to(device)
+    prototypes = None
+    if prototype_cache is not None:
+        prototypes = prototype_cache.get(selected_channel_id, device)
 
-    val_prob_all = torch.zeros(len(val_dataloader.dataset), dtype=torch.float32).to(device)
-    val_label_all = torch.zeros(len(val_dataloader.dataset), dtype=torch.int).to(device)
+    # the support embeddings are saved even when the prototypes are cached, to re-score the configuration
+    if prototypes is None or embedding_store is not None:
+        x_support_set, y_support_set = get_support_set(opt)
+        x_support_set = torch.tensor(x_support_set).to(device)
+        y_support_set = torch.tensor(y_support_set).to(device)
 
-    for i, batch in enumerate(tqdm(val_dataloader)):
-        x, y = batch
-        x, y = x.to(device), y.to(device)
-        x[:, mask, :, :] = -1  # mask the channels
-        x = x.reshape((x.shape[0], 1, -1, x.shape[3]))
-        model_output = model(x)
-        prob, _ = prototypical_evaluation(prototypes, model_output)
+        model_output = masked_forward(opt, model, x_support_set, mask)
 
-        start_idx = i * val_dataloader.batch_size
-        end_idx = start_idx + x.size(0)
+        if prototypes is None:
+            prototypes = get_prototypes(model_output, target=y_support_set).to(device)
+            if prototype_cache is not None:
+                prototype_cache.put(selected_channel_id, prototypes)
+        if embedding_store is not None:
+            embedding_store.write(selected_channel_id, 'support', model_output, labels=y_support_set.cpu().numpy())
 
-        val_prob_all[start_idx:end_idx] = prob.detach()
-        val_label_all[start_idx:end_idx] = y.detach()
+    split_outputs = {'val': [], 'test': []} if embedding_store is not None else {'val': None, 'test': None}
 
-    val_label_all = val_label_all.cpu().numpy()
-    val_prob_all = val_prob_all.cpu().numpy()
-    val_auc = roc_auc_score(val_label_all, val_prob_all)
+    if patch_cache is not None:
+        val_auc = cached_split_auc(patch_cache, 'val', model, prototypes, mask, device,
+                                   val_dataloader.batch_size, outputs=split_outputs['val'])
+        test_auc = cached_split_auc(patch_cache, 'test', model, prototypes, mask, device,
+                                    test_dataloader.batch_size, outputs=split_outputs['test'])
+    else:
+        val_auc = split_auc(opt, val_dataloader, model, prototypes, mask, device, outputs=split_outputs['val'])
+        test_auc = split_auc(opt, test_dataloader, model, prototypes, mask, device, outputs=split_outputs['test'])
 
-    predict_prob = torch.zeros(len(test_dataloader.dataset), dtype=torch.float32).to(device)
-    true_label = torch.zeros(len(test_dataloader.dataset), dtype=torch.int).to(device)
+    if embedding_store is not None:
+        embedding_store.write_prototypes(selected_channel_id, prototypes)
+        for split, dataloader in [('val', val_dataloader), ('test', test_dataloader)]:
+            embedding_store.write(selected_channel_id, split, torch.cat(split_outputs[split]),
+                                  labels=dataloader.dataset.labels)
 
-    for i, batch in enumerate(tqdm(test_dataloader)):
-        x, y = batch
-        x, y = x.to(device), y.to(device)
+    return val_auc, test_auc
 
-        x[:, mask, :, :] = -1  # mask the channels
-        x = x.reshape((x.shape[0], 1, -1, x.shape[3]))
-        model_output = model(x)
-        prob, _ = prototypical_evaluation(prototypes, model_output)
 
-        start_idx = i * test_dataloader.batch_size
-        end_idx = start_idx + x.size(0)
+def test_config_blocks(opt, test_dataloader, val_dataloader, model, device, df, patch_cache=None, exact=False):
+    """
+    Test the model on all the channel configurations of df, opt.config_block_size configurations
+    per pass over the val/test data. Yields (channel_id, val_auc, test_auc) for every row of df
+    If exact is True, the AUCs are exact even if opt.auc_bins or opt.auc_tolerance is set, otherwise the largest
+    error bound of the AUCs of each block is printed
+    """
+    auc_bins = 0 if exact else opt.auc_bins
+    auc_tolerance = 0 if exact else opt.auc_tolerance
+    block_size = max(1, opt.config_block_size)
+    x_support_set, y_support_set = get_support_set(opt)
+    x_support_set = torch.tensor(x_support_set).to(device)
+    y_support_set = torch.tensor(y_support_set).to(device)
 
-        predict_prob[start_idx:end_idx] = prob.detach()
-        true_label[start_idx:end_idx] = y.detach()
+    channel_ids = df['channel_id'].tolist()
+    for start_idx in range(0, len(channel_ids), block_size):
+        block_ids = channel_ids[start_idx:start_idx + block_size]
+        masks = np.stack([get_mask(df=df, selected_channel_id=channel_id) for channel_id in block_ids])
+
+        error_bounds = {'val': [], 'test': []}
+        val_aucs = evaluate_config_block(model, val_dataloader, x_support_set, y_support_set, masks, device,
+                                         max_forward_size=val_dataloader.batch_size,
+                                         patch_cache=patch_cache, split='val', auc_bins=auc_bins,
+                                         token_drop=opt.sweep_mode == 'token_drop', auc_tolerance=auc_tolerance,
+                                         error_bounds=error_bounds['val'])
+        test_aucs = evaluate_config_block(model, test_dataloader, x_support_set, y_support_set, masks, device,
+                                          max_forward_size=test_dataloader.batch_size,
+                                          patch_cache=patch_cache, split='test', auc_bins=auc_bins,
+                                          token_drop=opt.sweep_mode == 'token_drop', auc_tolerance=auc_tolerance,
+                                          error_bounds=error_bounds['test'])
+        if auc_bins > 0 or auc_tolerance > 0:
+            print("AUC error bound of configurations {}-{}: val {:.2e}, test {:.2e}".format(
+                start_idx, start_idx + len(block_ids) - 1, max(error_bounds['val']), max(error_bounds['test'])))
+        for channel_id, val_auc, test_auc in zip(block_ids, val_aucs, test_aucs):
+            yield channel_id, val_auc, test_auc
+
+
+def test_successive_halving(opt, test_dataloader, val_dataloader, model, device, df, patch_cache=None):
+    """
+    Search the best opt.halving_top_n channel configurations of df by successive halving on the validation
+    windows. Yields (channel_id, val_auc, test_auc) with the exact AUCs of the final configurations
+    If patch_cache is given, the val/test windows are taken from the cached patch embeddings
+    """
+    x_support_set, y_support_set = get_support_set(opt)
+    x_support_set = torch.tensor(x_support_set).to(device)
+    y_support_set = torch.tensor(y_support_set).to(device)
+    block_size = max(1, opt.config_block_size)
+    val_dataset = val_dataloader.dataset
+
+    def score_fn(channel_ids, window_indices):
+        if patch_cache is None:
+            subset_dataloader = make_loader(val_dataset, batch_size=val_dataloader.batch_size,
+                                            sampler=window_indices, num_workers=val_dataloader.num_workers,
+                                            device=device)
+        else:
+            subset_dataloader = val_dataloader  # only its batch size is used
+        aucs = []
+        for start_idx in tqdm(range(0, len(channel_ids), block_size), desc='Configurations'):
+            block_ids = channel_ids[start_idx:start_idx + block_size]
+            masks = np.stack([get_mask(df=df, selected_channel_id=channel_id) for channel_id in block_ids])
+            aucs += evaluate_config_block(model, subset_dataloader, x_support_set, y_support_set, masks, device,
+                                          max_forward_size=val_dataloader.batch_size, auc_bins=opt.auc_bins,
+                                          auc_tolerance=opt.auc_tolerance,
+                                          token_drop=opt.sweep_mode == 'token_drop', patch_cache=patch_cache,
+                                          split='val', window_indices=window_indices)
+        return aucs
+
+    best_channel_ids = successive_halving(df['channel_id'].tolist(), score_fn, val_dataset.labels,
+                                          top_n=opt.halving_top_n, eta=opt.halving_eta,
+                                          min_fraction=opt.halving_min_fraction, seed=opt.manual_seed)
+
+    # exact AUCs for the final configurations
+    final_df = df[df['channel_id'].isin(best_channel_ids)]
+    for channel_id, val_auc, test_auc in test_config_blocks(opt, test_dataloader, val_dataloader, model, device,
+                                                            final_df, patch_cache=patch_cache, exact=True):
+        yield channel_id, val_auc, test_auc
+
+
+def get_experiment_name(options):
+    experiment_name = 'FETCH_halving' if options.successive_halving else 'FETCH'
+    # dropping the tokens of the absent channels is not equivalent to masking them
+    return experiment_name + '_token_drop' if options.sweep_mode == 'token_drop' else experiment_name
+
+
+def sweep(options, df, model, val_dataloader, test_dataloader, device, results_store, report_progress=None):
+    """
+    Evaluate all the channel configurations of df and append the results to results_store
+    If report_progress is given, it is called after every configuration instead of printing the AUCs
+    """
+    model_name = 'model_{}nodes'.format(options.num_nodes)
+    experiment_name = get_experiment_name(options)
+
+    prototype_cache = None
+    if options.cache_prototypes:
+        prototype_cache = PrototypeCache(os.path.join(options.experiment_root, model_name, 'prototype_cache'),
+                                         model, [non_seizure_support_set, seizure_support_set],
+                                         forward_mode=options.sweep_mode)
+        print("Cached prototypes", len(prototype_cache))
+
+    embedding_store = None
+    if options.save_embeddings and options.config_block_size > 1:
+        print("WARNING: the embeddings are only saved when the configurations are evaluated one by one")
+    elif options.save_embeddings:
+        embedding_store = EmbeddingStore(os.path.join(options.experiment_root, model_name,
+                                                      'embeddings_{}'.format(experiment_name)))
+
+    patch_cache = None
+    if options.sweep_mode == 'patch_cache':
+        # embed the val/test patches once, every configuration only swaps in the masked embeddings
+        patch_cache = PatchEmbeddingCache(model)
+        patch_cache.build('val', val_dataloader, device)
+        patch_cache.build('test', test_dataloader, device)
+
+    if options.successive_halving:
+        # only the best configurations are evaluated on the whole val/test sets
+        evaluated_configs = test_successive_halving(opt=options,
+                                                    test_dataloader=test_dataloader,
+                                                    val_dataloader=val_dataloader,
+                                                    model=model,
+                                                    device=device,
+                                                    df=df,
+                                                    patch_cache=patch_cache)
+    elif options.config_block_size > 1:
+        # several configurations per pass over the data
+        evaluated_configs = test_config_blocks(opt=options,
+                                               test_dataloader=test_dataloader,
+                                               val_dataloader=val_dataloader,
+                                               model=model,
+                                               device=device,
+                                               df=df,
+                                               patch_cache=patch_cache)
+    else:
+        # iterate over all rows of the dataframe
+        evaluated_configs = ((row['channel_id'],) + test(opt=options,
+                                                         test_dataloader=test_dataloader,
+                                                         val_dataloader=val_dataloader,
+                                                         model=model,
+                                                         df=df,
+                                                         device=device,
+                                                         selected_channel_id=row['channel_id'],
+                                                         patch_cache=patch_cache,
+                                                         prototype_cache=prototype_cache,
+                                                         embedding_store=embedding_store)
+                             for index, row in df.iterrows())
+
+    for selected_channel_id, val_auc, test_auc in evaluated_configs:
+        results = {'channel_id': selected_channel_id,
+                   'val_auc': val_auc,
+                   'test_auc': test_auc,
+                   'experiment_name': experiment_name,
+                   'model_name': model_name,
+                   'number_nodes': options.num_nodes}
+        results_store.add(results)
+        if report_progress is None:
+            print("val_auc: ", val_auc)
+            print("test_auc: ", test_auc)
+            print("------------------------------------------------------")
+        else:
+            report_progress()
 
-    predict_prob = predict_prob.cpu().numpy()
-    true_label = true_label.cpu().numpy()
-    test_auc = roc_auc_score(true_label, predict_prob)
+    if prototype_cache is not None:
+        prototype_cache.save()
 
-    return val_auc, test_auc
+
+def sweep_worker(channel_ids, report_progress, options, model_state, val_dataset, test_dataset):
+    """
+    Worker of the sharded sweep: evaluate the configurations channel_ids on the shared val/test datasets
+    """
+    device = 'cuda:0' if torch.cuda.is_available() and options.cuda else 'cpu'
+    model = init_vit(options)
+    model.load_state_dict(model_state)
+
+    df = get_df_with_num_nodes(options.num_nodes)
+    df = df[df['channel_id'].isin(channel_ids)]
+
+    # the worker is already one of several processes, the data is read in-process
+    val_dataloader = make_loader(val_dataset, batch_size=2048, num_workers=0, device=device)
+    test_dataloader = make_loader(test_dataset, batch_size=2048, num_workers=0, device=device)
+
+    model_name = 'model_{}nodes'.format(options.num_nodes)
+    results_store = ResultsStore(os.path.join(options.experiment_root, model_name, 'results.sqlite'))
+    sweep(options, df, model, val_dataloader, test_dataloader, device, results_store,
+          report_progress=report_progress)
+    results_store.close()
 
 
 def eval():
     """
-    Initialize everything and train
+    Initialize everything and evaluate all the channel configurations with options.num_nodes nodes
     """
     options = get_parser().parse_args()
     num_nodes = options.num_nodes
     df = get_df_with_num_nodes(num_nodes)
-    # shuffle df rows
+    model_name = 'model_{}nodes'.format(num_nodes)
+    experiment_name = get_experiment_name(options)
 
-
-    # Create a dataframe to store the results
-    results_df = pd.DataFrame(columns=['channel_id', 'val_auc', 'test_auc',
-                                       'experiment_name', 'model_name', 'number_nodes'])
+    # The results are appended to the store as soon as a configuration is evaluated,
+    # the configurations of a previous (interrupted) sweep are skipped
+    results_store = ResultsStore(os.path.join(options.experiment_root, model_name, 'results.sqlite'))
+    if not options.successive_halving:  # the search needs all the configurations
+        done_channel_ids = results_store.done_channel_ids(experiment_name, model_name)
+        df = df[~df['channel_id'].isin(done_channel_ids)]
+        print("Configurations already evaluated: {}, remaining: {}".format(len(done_channel_ids), len(df)))
 
     if torch.cuda.is_available() and not options.cuda:
         print("WARNING: You have a CUDA device, so you should probably run with --cuda")
@@ -352,44 +591,30 @@ def eval():
     init_seed(options)
     tr_dataloader, val_dataloader, test_dataloader = init_dataloader(options, full_validation=True)
     model = init_vit(options)
-    model_path = os.path.join(options.experiment_root, 'model_{}nodes'.format(num_nodes),
-                              'best_model.pth')
+    model_path = os.path.join(options.experiment_root, model_name, 'best_model.pth')
     model.load_state_dict(torch.load(model_path))
 
     device = 'cuda:0' if torch.cuda.is_available() and options.cuda else 'cpu'
     print("Device", device)
 
-    # iterate over all rows of the dataframe
-    for index, row in df.iterrows():
-        selected_channel_id = row['channel_id']
-        selected_channels = row['channel_list']
-
-        val_auc, test_auc = test(opt=options,
-                                 test_dataloader=test_dataloader,
-                                 val_dataloader=val_dataloader,
-                                 model=model,
-                                 df=df,
-                                 device=device,
-                                 selected_channel_id=selected_channel_id, )
-        print("val_auc: ", val_auc)
-        print("test_auc: ", test_auc)
-        print("------------------------------------------------------")
-        results = {'channel_id': selected_channel_id,
-                   'val_auc': val_auc,
-                   'test_auc': test_auc,
-                   'experiment_name': 'FETCH',
-                   'model_name': 'model_{}nodes'.format(num_nodes),
-                   'number_nodes': num_nodes}
-        # Concatenate the results
-        results_df = pd.concat([results_df, pd.DataFrame.from_records([results])], ignore_index=True)
-        # Save the results
-        if index % 300 == 299:
-            results_df.to_csv(os.path.join(options.experiment_root,
-                                           'model_{}nodes'.format(num_nodes),
-                                           'results.csv'), index=False)
-    results_df.to_csv(os.path.join(options.experiment_root,
-                                   'model_{}nodes'.format(num_nodes),
-                                   'results.csv'), index=False)
+    if options.sweep_workers > 1 and options.successive_halving:
+        # every round ranks all the surviving configurations, the search cannot be split into shards
+        print("WARNING: successive halving runs in a single process, --sweep_workers is ignored")
+    if options.sweep_workers > 1 and not options.successive_halving:
+        # the workers get a handle on the val/test signals instead of their own copy
+        val_dataloader.dataset.signals.share_memory_()
+        test_dataloader.dataset.signals.share_memory_()
+        model_state = {name: tensor.cpu() for name, tensor in model.state_dict().items()}
+        run_sharded(sweep_worker, df['channel_id'].tolist(), options.sweep_workers,
+                    worker_args=(options, model_state, val_dataloader.dataset, test_dataloader.dataset),
+                    threads_per_worker=options.threads_per_worker)
+    else:
+        sweep(options, df, model, val_dataloader, test_dataloader, device, results_store)
+
+    # results.csv is kept for the analysis notebook
+    results_df = results_store.to_dataframe(experiment_name=experiment_name, model_name=model_name)
+    results_df.to_csv(os.path.join(options.experiment_root, model_name, 'results.csv'), index=False)
+    results_store.close()
 
 
 def main():
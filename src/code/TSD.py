@@ -22,10 +22,8 @@ from channel_possibility import double_banana
 from utils import create_dataframe
 
 import tuh_dataset
+from tensor_loader import Prefetcher
 from vit_pytorch.vit import ViT
-import torch.multiprocessing
-
-torch.multiprocessing.set_sharing_strategy('file_system')
 
 print(f"Torch: {torch.__version__}")
 
@@ -100,7 +98,12 @@ def train(model_path=None, selected_channel_id=tuh_dataset.args.selected_channel
                                    batch_size=batch_size,
                                    selected_channel_id=selected_channel_id,
                                    return_dataset=False,
-                                   event_base=False, masking=False, random_mask=False, remove_not_used=True)
+                                   event_base=False, masking=False, random_mask=False, remove_not_used=True,
+                                   device=device)
+
+    train_loader, val_loader, test_loader = \
+        [Prefetcher(loader, device, depth=tuh_dataset.args.prefetch_depth)
+         for loader in (train_loader, val_loader, test_loader)]
 
     best_val_auc = 0.0
     best_val_epoch = 0
@@ -163,6 +166,7 @@ def train(model_path=None, selected_channel_id=tuh_dataset.args.selected_channel
 
         print(f"Epoch: {epoch + 1} - train_loss: {epoch_train_loss:.4f} -  train_auc: {train_auc:.4f}; "
               f"val_loss: {epoch_val_loss:.4f} - val_auc: {val_auc:.4f}")
+        print("Data wait: train {:.1f}s, val {:.1f}s".format(train_loader.data_wait()[0], val_loader.data_wait()[0]))
 
         if best_val_auc < val_auc:
             best_val_auc = val_auc
@@ -225,7 +229,7 @@ def inference(model_path,
                                    selected_channel_id=selected_channel_id,
                                    return_dataset=False,
                                    event_base=False, masking=False, random_mask=False,
-                                   remove_not_used=True)
+                                   remove_not_used=True, device=device)
 
     model.eval()
     val_label_all = []
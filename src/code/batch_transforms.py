@@ -0,0 +1,75 @@
+# coding=utf-8
+import torch
+
+NUM_CHANNELS = 20
+
+
+class ChannelMasking(object):
+    """
+    ChannelMasking: the channel masking of TUHDataset applied to a whole B x 20 x 160 x 15 batch at once,
+    on the device of the batch, with a mask per row.
+    - remove_not_used: keep only selected_channels
+    - masking: set to masked_value all the channels except selected_channels, or except num_present
+      random channels drawn independently for every row when selected_channels is None
+    The masked or reduced batch is reshaped to the B x 1 x (channels * 160) x 15 model input.
+    """
+
+    def __init__(self, selected_channels=None, masking=True, remove_not_used=False, num_present=8,
+                 masked_value=-1):
+        self.selected_channels = selected_channels
+        self.masking = masking
+        self.remove_not_used = remove_not_used
+        self.num_present = num_present
+        self.masked_value = masked_value
+
+    def masks(self, batch_size, device):
+        """
+        Return the batch_size x 20 boolean masks, True for the masked channels
+        """
+        if self.selected_channels is None:
+            present_channels = torch.rand((batch_size, NUM_CHANNELS), device=device).argsort(dim=1)
+            present_channels = present_channels[:, :self.num_present]
+        else:
+            present_channels = torch.as_tensor(self.selected_channels, device=device).expand(batch_size, -1)
+        masks = torch.ones((batch_size, NUM_CHANNELS), dtype=torch.bool, device=device)
+        return masks.scatter_(1, present_channels, False)
+
+    def __call__(self, x):
+        if self.remove_not_used:
+            x = x[:, self.selected_channels]
+        elif self.masking:
+            masks = self.masks(x.shape[0], x.device)
+            x = torch.where(masks[:, :, None, None], torch.tensor(self.masked_value, dtype=x.dtype, device=x.device),
+                            x)
+        else:
+            return x
+        return x.reshape((x.shape[0], 1, -1, x.shape[3]))
+
+
+class TransformedLoader(object):
+    """
+    Iterate over a DataLoader, moving every batch to device (if given) and applying transform to it.
+    The copy is synchronous: the source may be a buffer the loader reuses for a later batch.
+    A tensor_loader.Prefetcher given a TransformedLoader without a device copies the batches of the DataLoader
+    first and applies the transform on its device.
+    The other attributes (dataset, batch_size, ...) are the ones of the DataLoader.
+    """
+
+    def __init__(self, dataloader, transform, device=None):
+        self.dataloader = dataloader
+        self.transform = transform
+        self.device = device
+
+    def __iter__(self):
+        for x, y in self.dataloader:
+            if self.device is not None:
+                x = x.to(self.device)
+            yield self.transform(x), y
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __getattr__(self, name):
+        if name == 'dataloader':
+            raise AttributeError(name)
+        return getattr(self.dataloader, name)
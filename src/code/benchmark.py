@@ -0,0 +1,286 @@
+# coding=utf-8
+import argparse
+import json
+import os
+import platform
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+from TSD.few_shot.prototypical_loss import get_prototypes
+from TSD.code.FETCH import get_mask, get_support_set, masked_forward, split_auc, cached_split_auc
+from TSD.code.multi_config import config_block_forward, evaluate_config_block
+from TSD.code.parser_util import get_parser as get_fetch_parser
+from TSD.code.patch_cache import PatchEmbeddingCache
+from TSD.code.stft_shards import STORAGE_DTYPES, read_shard
+from TSD.code.tuh_dataset import get_shard_directory, make_loader
+from TSD.code.utils import get_df_with_num_nodes
+from vit_pytorch.vit import ViT
+
+NUM_CHANNELS = 20
+STFT_SHAPE = (NUM_CHANNELS, 160, 15)
+MODES = ['default', 'token_drop', 'patch_cache', 'config_block']
+
+
+def synthetic_stft(num_windows, seizure_ratio=0.1, seed=0):
+    """
+    Random log-magnitude STFT windows with the shape of the TUSZ features, N x 20 x 160 x 15
+    """
+    generator = torch.Generator().manual_seed(seed)
+    labels = (torch.rand(num_windows, generator=generator) < seizure_ratio).long()
+    labels[:2] = torch.tensor([0, 1])  # both classes are needed for the AUC
+    signals = torch.randn((num_windows,) + STFT_SHAPE, generator=generator) - 4.
+    signals += labels.view(-1, 1, 1, 1).float() * 0.5
+    return signals, labels
+
+
+def synthetic_config_table(num_configs, min_channels=4, max_channels=12, seed=0):
+    """
+    A feasible-configuration table with the columns used by FETCH.eval (channel_id, channel_list)
+    """
+    rng = np.random.RandomState(seed)
+    channel_lists = [sorted(rng.choice(NUM_CHANNELS, rng.randint(min_channels, max_channels + 1),
+                                       replace=False).tolist())
+                     for _ in range(num_configs)]
+    return pd.DataFrame({'channel_id': np.arange(num_configs), 'channel_list': channel_lists})
+
+
+def init_model(device):
+    # the FETCH.init_vit architecture
+    return ViT(image_size=(3200, 15), patch_size=(80, 5), num_classes=16, dim=16, depth=4, heads=4, mlp_dim=4,
+               pool='cls', channels=1, dim_head=4, dropout=0.2, emb_dropout=0.2).to(device).eval()
+
+
+def run_per_config(opt, model, dataloader, x_support_set, y_support_set, masks, device, patch_cache=None):
+    """
+    FETCH.test on one split for every configuration of masks: the support forward, then split_auc (or
+    cached_split_auc with patch_cache), one pass over the data per configuration
+    """
+    aucs = []
+    with torch.no_grad():
+        for mask in masks:
+            support_output = masked_forward(opt, model, x_support_set.clone(), mask)
+            prototypes = get_prototypes(support_output, target=y_support_set).to(device)
+            if patch_cache is not None:
+                aucs.append(cached_split_auc(patch_cache, 'val', model, prototypes, mask, device,
+                                             dataloader.batch_size))
+            else:
+                aucs.append(split_auc(opt, dataloader, model, prototypes, mask, device))
+    return aucs
+
+
+def fetch_options(mode, prefetch_depth):
+    # the FETCH.py defaults, with the sweep mode of the benchmark
+    opt = get_fetch_parser().parse_args([])
+    opt.sweep_mode = mode if mode in ('token_drop', 'patch_cache') else 'default'
+    opt.prefetch_depth = prefetch_depth
+    return opt
+
+
+def benchmark(mode, model, signals, labels, x_support_set, y_support_set, masks, batch_size, device,
+              config_block_size=8, prefetch_depth=2):
+    """
+    Time one evaluation of all the configurations of masks, returns the elapsed seconds
+    """
+    opt = fetch_options(mode, prefetch_depth)
+    dataloader = make_loader(torch.utils.data.TensorDataset(signals, labels), batch_size=batch_size,
+                             num_workers=0, device=device)
+    start_time = time.time()
+    if mode == 'config_block':
+        for start_idx in range(0, len(masks), config_block_size):
+            evaluate_config_block(model, dataloader, x_support_set, y_support_set,
+                                  masks[start_idx:start_idx + config_block_size], device,
+                                  max_forward_size=batch_size)
+    elif mode == 'patch_cache':
+        patch_cache = PatchEmbeddingCache(model)
+        patch_cache.build('val', dataloader, device)
+        run_per_config(opt, model, dataloader, x_support_set, y_support_set, masks, device, patch_cache=patch_cache)
+    else:
+        run_per_config(opt, model, dataloader, x_support_set, y_support_set, masks, device)
+    return time.time() - start_time
+
+
+def upcast_collate(batch):
+    # the batches of the 16-bit storage are upcast to float32, as in TUHDataset
+    return torch.stack([x for x, _ in batch]).float(), torch.stack([y for _, y in batch])
+
+
+def storage_dtype_check(model, signals, labels, x_support_set, y_support_set, masks, batch_size, device,
+                        dtypes=('float16', 'bfloat16'), tolerance=1e-3):
+    """
+    Compare the AUCs of every configuration when the windows are stored in 16 bits to the float32 ones
+    Returns a dict with the largest absolute AUC difference of each dtype
+    """
+    reference_aucs = None
+    differences = {}
+    for dtype in ('float32',) + tuple(dtypes):
+        torch_dtype = STORAGE_DTYPES[dtype]
+        dataloader = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(signals.to(torch_dtype), labels),
+                                                 batch_size=batch_size, num_workers=0, collate_fn=upcast_collate)
+        aucs = np.asarray(run_per_config(fetch_options('default', 0), model, dataloader,
+                                         x_support_set.to(torch_dtype).float(), y_support_set, masks, device))
+        if reference_aucs is None:
+            reference_aucs = aucs
+            continue
+        differences[dtype] = float(np.max(np.abs(aucs - reference_aucs)))
+        print("{:>12} storage: max |AUC - float32 AUC| = {:.2e} ({})".format(
+            dtype, differences[dtype], 'ok' if differences[dtype] <= tolerance else 'above {}'.format(tolerance)))
+    return differences
+
+
+def val_shard_storage_check(options, device, dtypes=('float16', 'bfloat16'), tolerance=1e-3):
+    """
+    storage_dtype_check on the real validation windows: the float32 val shard of options.save_directory, the
+    support set and the best_model.pth of FETCH for options.num_nodes nodes, with its first options.num_configs
+    configurations
+    Returns a dict with the largest absolute AUC difference of each dtype
+    """
+    opt = fetch_options('default', options.prefetch_depth)
+    opt.save_directory = options.save_directory
+    shard = read_shard(get_shard_directory(opt.save_directory, 'val'))
+    if shard['signals'].dtype != torch.float32:
+        raise SystemExit("The val shard is stored in {}, the check needs a float32 shard (--storage_dtype float32)"
+                         .format(shard['signals'].dtype))
+
+    model_path = os.path.join(options.experiment_root, 'model_{}nodes'.format(options.num_nodes), 'best_model.pth')
+    model = init_model(device)
+    model.load_state_dict(torch.load(model_path, map_location=device))
+
+    x_support_set, y_support_set = get_support_set(opt)
+    x_support_set = torch.tensor(x_support_set).to(device)
+    y_support_set = torch.tensor(y_support_set).to(device)
+    df = get_df_with_num_nodes(options.num_nodes).head(options.num_configs)
+    masks = np.stack([get_mask(df=df, selected_channel_id=channel_id) for channel_id in df['channel_id']])
+    print("val shard: {} windows, {} configurations of {}".format(len(shard['labels']), len(masks), model_path))
+    return storage_dtype_check(model, shard['signals'], torch.from_numpy(shard['labels']).long(), x_support_set,
+                               y_support_set, masks, options.batch_sizes[0], device, dtypes=dtypes,
+                               tolerance=tolerance)
+
+
+def token_drop_check(model, signals, labels, x_support_set, y_support_set, masks, batch_size, device,
+                     tolerance=1e-3):
+    """
+    Compare dropping the tokens of the absent channels (ViT.forward(img, channel_mask=...)) to filling the
+    channels with -1, for every configuration: relative difference of the model outputs on the first batch
+    and AUCs, both computed by multi_config as in the sweep
+    Returns a dict with the mean relative output difference and the largest absolute AUC difference
+    """
+    dataloader = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(signals, labels),
+                                             batch_size=batch_size, num_workers=0)
+    masks_tensor = torch.as_tensor(masks, dtype=torch.bool, device=device)
+    with torch.no_grad():
+        x = signals[:batch_size].to(device)
+        filled = config_block_forward(model, x, masks_tensor)
+        dropped = config_block_forward(model, x, masks_tensor, token_drop=True)
+    output_difference = float(((dropped - filled).norm(dim=-1) / filled.norm(dim=-1)).mean())
+
+    aucs = {}
+    for token_drop in (False, True):
+        aucs[token_drop] = np.asarray(evaluate_config_block(model, dataloader, x_support_set, y_support_set, masks,
+                                                            device, max_forward_size=batch_size,
+                                                            token_drop=token_drop))
+    auc_difference = float(np.max(np.abs(aucs[True] - aucs[False])))
+    print("  token_drop: mean |output - filled output| / |filled output| = {:.2e}, "
+          "max |AUC - filled AUC| = {:.2e} ({})".format(output_difference, auc_difference,
+                                                       'ok' if auc_difference <= tolerance
+                                                       else 'above {}'.format(tolerance)))
+    return {'relative_output_difference': output_difference, 'max_auc_difference': auc_difference}
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Throughput of the FETCH evaluation path on synthetic data')
+    parser.add_argument('--num_windows', type=int, default=2048)
+    parser.add_argument('--num_configs', type=int, default=8)
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[256, 1024, 2048])
+    parser.add_argument('--threads', type=int, nargs='+', default=sorted({1, os.cpu_count() or 1}))
+    parser.add_argument('--modes', type=str, nargs='+', default=MODES, choices=MODES)
+    parser.add_argument('--config_block_size', type=int, default=8)
+    parser.add_argument('--prefetch_depth', type=int, default=2)
+    parser.add_argument('--check_storage_dtype', action='store_true',
+                        help="check that the AUCs of the float16/bfloat16 storage stay within --auc_tolerance")
+    parser.add_argument('--check_val_shard', action='store_true',
+                        help="check the AUCs of the 16-bit storage on the val shard of --save_directory with the "
+                             "best_model.pth of --experiment_root and --num_nodes")
+    fetch_parser = get_fetch_parser()
+    parser.add_argument('--save_directory', type=str, default=fetch_parser.get_default('save_directory'))
+    parser.add_argument('--experiment_root', type=str, default=fetch_parser.get_default('experiment_root'))
+    parser.add_argument('--num_nodes', type=int, default=fetch_parser.get_default('num_nodes'))
+    parser.add_argument('--check_token_drop', action='store_true',
+                        help="compare the AUCs of token dropping with the -1 filling of the absent channels")
+    parser.add_argument('--auc_tolerance', type=float, default=1e-3)
+    parser.add_argument('--cuda', action='store_true')
+    parser.add_argument('--output', type=str, default='benchmark_results.json')
+    return parser
+
+
+def main():
+    options = get_parser().parse_args()
+    device = 'cuda:0' if torch.cuda.is_available() and options.cuda else 'cpu'
+    torch.manual_seed(0)
+
+    signals, labels = synthetic_stft(options.num_windows)
+    x_support_set, y_support_set = synthetic_stft(50, seizure_ratio=0.5, seed=1)
+    x_support_set, y_support_set = x_support_set.to(device), y_support_set.to(device)
+    df = synthetic_config_table(options.num_configs)
+    masks = np.stack([get_mask(df=df, selected_channel_id=channel_id) for channel_id in df['channel_id']])
+    model = init_model(device)
+
+    results = []
+    for num_threads in options.threads:
+        torch.set_num_threads(num_threads)
+        for batch_size in options.batch_sizes:
+            for mode in options.modes:
+                elapsed = benchmark(mode, model, signals, labels, x_support_set, y_support_set, masks,
+                                    batch_size, device, config_block_size=options.config_block_size,
+                                    prefetch_depth=options.prefetch_depth)
+                result = {'mode': mode,
+                          'threads': num_threads,
+                          'batch_size': batch_size,
+                          'seconds': elapsed,
+                          'windows_per_sec': options.num_windows * len(masks) / elapsed,
+                          'configs_per_sec': len(masks) / elapsed}
+                print("{mode:>12} threads {threads:>3} batch {batch_size:>5}: {windows_per_sec:10.1f} windows/sec, "
+                      "{configs_per_sec:8.3f} configs/sec".format(**result))
+                results.append(result)
+
+    storage_dtype_differences = None
+    if options.check_storage_dtype:
+        storage_dtype_differences = storage_dtype_check(model, signals, labels, x_support_set, y_support_set, masks,
+                                                        options.batch_sizes[0], device,
+                                                        tolerance=options.auc_tolerance)
+
+    val_shard_differences = None
+    if options.check_val_shard:
+        val_shard_differences = val_shard_storage_check(options, device, tolerance=options.auc_tolerance)
+
+    token_drop_differences = None
+    if options.check_token_drop:
+        token_drop_differences = token_drop_check(model, signals, labels, x_support_set, y_support_set, masks,
+                                                  options.batch_sizes[0], device, tolerance=options.auc_tolerance)
+
+    report = {'torch': torch.__version__,
+              'platform': platform.platform(),
+              'cpu_count': os.cpu_count(),
+              'device': device,
+              'num_windows': options.num_windows,
+              'num_configs': options.num_configs,
+              'results': results,
+              'storage_dtype_auc_differences': storage_dtype_differences,
+              'val_shard_auc_differences': val_shard_differences,
+              'token_drop_differences': token_drop_differences}
+    with open(options.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Results saved to", options.output)
+
+    for name, differences in [('synthetic', storage_dtype_differences), ('val shard', val_shard_differences)]:
+        if differences is not None and max(differences.values()) > options.auc_tolerance:
+            raise SystemExit("The 16-bit AUCs of the {} windows differ from the float32 ones by more than {}".format(
+                name, options.auc_tolerance))
+    if token_drop_differences is not None and token_drop_differences['max_auc_difference'] > options.auc_tolerance:
+        raise SystemExit("The token_drop AUCs differ from the -1 filling by more than {}".format(options.auc_tolerance))
+
+
+if __name__ == '__main__':
+    main()
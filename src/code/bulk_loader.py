@@ -0,0 +1,88 @@
+# coding=utf-8
+import os
+import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from tqdm import tqdm
+
+STFT_SHAPE = (20, 160, 15)
+
+# the output tensor of the worker processes, set by _init_process
+_OUT = None
+
+
+def _read_into(out, positions, filepath):
+    with open(filepath, 'rb') as f:
+        data_pkl = pickle.load(f)
+    out[positions] = torch.from_numpy(np.asarray(data_pkl['STFT'], dtype=np.float32)).to(out.dtype)
+    return os.path.getsize(filepath)
+
+
+def _init_process(out):
+    global _OUT
+    _OUT = out
+    torch.set_num_threads(1)
+
+
+def _read_into_shared(task):
+    positions, filepath = task
+    return _read_into(_OUT, positions, filepath)
+
+
+def read_pickles(data_files, num_workers=8, backend='thread', share_memory=False, dtype=torch.float,
+                 desc="Reading input files"):
+    """
+    Read the STFT of the window pickles data_files into one N x 20 x 160 x 15 tensor.
+    The files are unpickled by a pool of num_workers threads or processes (backend), each writing its
+    windows directly into its rows of the preallocated tensor. Files repeated in data_files (the balanced
+    training set) are read once. With backend='process' or share_memory the tensor is in shared memory,
+    so it can be handed to DataLoader workers without a copy.
+    num_workers <= 1 reads the files serially in this process.
+    The tensor is allocated in dtype, e.g. torch.float16 to halve its memory.
+    """
+    out = torch.zeros((len(data_files),) + STFT_SHAPE, dtype=dtype)
+    if share_memory or backend == 'process':
+        out.share_memory_()
+
+    positions_of = {}
+    for idx, filepath in enumerate(data_files):
+        positions_of.setdefault(filepath, []).append(idx)
+    tasks = [(torch.tensor(positions), filepath) for filepath, positions in positions_of.items()]
+
+    start_time = time.time()
+    num_bytes = 0
+    progress = tqdm(total=len(tasks), desc=desc)
+    if num_workers <= 1:
+        results = (_read_into(out, positions, filepath) for positions, filepath in tasks)
+        pool = None
+    elif backend == 'thread':
+        pool = ThreadPoolExecutor(max_workers=num_workers)
+        results = pool.map(lambda task: _read_into(out, *task), tasks)
+    elif backend == 'process':
+        pool = mp.get_context('spawn').Pool(num_workers, initializer=_init_process, initargs=(out,))
+        results = pool.imap_unordered(_read_into_shared, tasks, chunksize=64)
+    else:
+        raise ValueError("Unknown backend {}".format(backend))
+
+    try:
+        for file_size in results:
+            num_bytes += file_size
+            progress.update()
+            if progress.n % 1000 == 0:
+                progress.set_postfix(MB_per_sec='{:.1f}'.format(num_bytes / 1e6 / (time.time() - start_time)))
+    finally:
+        progress.close()
+        if isinstance(pool, ThreadPoolExecutor):
+            pool.shutdown()
+        elif pool is not None:
+            pool.close()
+            pool.join()
+
+    elapsed = max(time.time() - start_time, 1e-9)
+    print("Read {} files ({:.1f} MB) in {:.1f}s: {:.1f} files/sec, {:.1f} MB/sec".format(
+        len(tasks), num_bytes / 1e6, elapsed, len(tasks) / elapsed, num_bytes / 1e6 / elapsed))
+    return out
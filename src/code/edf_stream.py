@@ -0,0 +1,56 @@
+# coding=utf-8
+import numpy as np
+import pyedflib
+
+
+def chunk_bounds(num_samples, chunk_samples, overlap_samples):
+    """
+    Split [0, num_samples) into consecutive cores of chunk_samples samples, each extended by overlap_samples on
+    both sides (within the recording). Yields (start, core_start, core_end, end)
+    """
+    for core_start in range(0, num_samples, chunk_samples):
+        core_end = min(core_start + chunk_samples, num_samples)
+        yield max(0, core_start - overlap_samples), core_start, core_end, min(num_samples, core_end + overlap_samples)
+
+
+def read_edf_chunks(edf_file, channels, chunk_samples, overlap_samples):
+    """
+    Read only the signals channels (signal numbers) of edf_file, chunk by chunk and without the annotations.
+    Yields (start, core_start, core_end, chunk), chunk holding the samples [start, end) of the channels as
+    float32 (channels x samples); the samples out of [core_start, core_end) overlap the neighbouring chunks.
+    The channels must have the same sampling frequency.
+    """
+    with pyedflib.EdfReader(edf_file, annotations_mode=pyedflib.DO_NOT_READ_ANNOTATIONS) as f:
+        num_samples = min(f.getNSamples()[channel] for channel in channels)
+        for start, core_start, core_end, end in chunk_bounds(num_samples, chunk_samples, overlap_samples):
+            chunk = np.empty((len(channels), end - start), dtype=np.float32)
+            for row, channel in enumerate(channels):
+                chunk[row] = f.readSignal(channel, start=start, n=end - start)
+            yield start, core_start, core_end, chunk
+
+
+def stream_windows(pieces, window_length, num_windows):
+    """
+    Cut the consecutive channels x samples pieces of a recording into its first num_windows windows of
+    window_length samples, as soon as they are complete.
+    Yields (index of the first window, n x channels x window_length windows); the last windows are zero-padded
+    if the recording is shorter than num_windows windows.
+    """
+    buffer = None
+    window_idx = 0
+    for piece in pieces:
+        buffer = piece if buffer is None else np.concatenate((buffer, piece), axis=1)
+        num_complete = min(buffer.shape[1] // window_length, num_windows - window_idx)
+        if num_complete > 0:
+            windows = buffer[:, :num_complete * window_length]
+            yield window_idx, windows.reshape((buffer.shape[0], num_complete, window_length)).transpose(1, 0, 2)
+            window_idx += num_complete
+            buffer = buffer[:, num_complete * window_length:]
+        if window_idx == num_windows:
+            return
+
+    num_samples = (num_windows - window_idx) * window_length
+    if buffer is None:
+        return
+    buffer = np.pad(buffer, ((0, 0), (0, num_samples - buffer.shape[1])))
+    yield window_idx, buffer.reshape((buffer.shape[0], num_windows - window_idx, window_length)).transpose(1, 0, 2)
@@ -0,0 +1,105 @@
+# coding=utf-8
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+from sklearn.metrics import roc_auc_score
+
+from TSD.few_shot.prototypical_loss import get_prototypes, prototypical_evaluation, euclidean_dist, cosine_dist
+
+DISTANCES = {'euclidean': euclidean_dist, 'cosine': cosine_dist}
+
+
+def _save_atomic(path, array):
+    # np.save appends .npy to names without it, so the temporary file keeps the extension
+    tmp_path = path[:-len('.npy')] + '.{}.tmp.npy'.format(os.getpid())
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+class EmbeddingStore(object):
+    """
+    EmbeddingStore: the model outputs of a channel sweep, to re-score it without running the ViT again.
+    For every (channel_id, split) the embeddings of the windows are kept in one .npy file,
+    read back with memory mapping:
+        root/<split>/labels.npy
+        root/<split>/<channel_id>.npy      N x D embeddings (float16 by default)
+        root/prototypes/<channel_id>.npy   n_classes x D prototypes used during the sweep
+        root/support/<channel_id>.npy      embeddings of the support set, when they were computed
+    """
+
+    def __init__(self, root, dtype=np.float16):
+        self.root = root
+        self.dtype = dtype
+
+    def _path(self, split, name):
+        return os.path.join(self.root, split, '{}.npy'.format(name))
+
+    def write(self, channel_id, split, embeddings, labels=None):
+        """
+        Save the embeddings of a split (and its labels, once per split) for a configuration
+        """
+        os.makedirs(os.path.join(self.root, split), exist_ok=True)
+        if labels is not None and not os.path.exists(self._path(split, 'labels')):
+            _save_atomic(self._path(split, 'labels'), np.asarray(labels))
+        if isinstance(embeddings, torch.Tensor):
+            embeddings = embeddings.detach().cpu().numpy()
+        _save_atomic(self._path(split, int(channel_id)), embeddings.astype(self.dtype))
+
+    def write_prototypes(self, channel_id, prototypes):
+        # only n_classes x D values, kept in float32
+        os.makedirs(os.path.join(self.root, 'prototypes'), exist_ok=True)
+        _save_atomic(self._path('prototypes', int(channel_id)),
+                     prototypes.detach().cpu().numpy().astype(np.float32))
+
+    def read(self, channel_id, split):
+        return np.load(self._path(split, int(channel_id)), mmap_mode='r')
+
+    def labels(self, split):
+        return np.load(self._path(split, 'labels'), mmap_mode='r')
+
+    def channel_ids(self, split):
+        """
+        Return the channel_ids having embeddings for split
+        """
+        directory = os.path.join(self.root, split)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(int(name[:-len('.npy')]) for name in os.listdir(directory)
+                      if name.endswith('.npy') and name[:-len('.npy')].isdigit())
+
+    def prototypes(self, channel_id, support_indices=None):
+        """
+        Return the prototypes of a configuration. By default the ones saved during the sweep,
+        if support_indices is given they are recomputed from these windows of the stored support set
+        """
+        if support_indices is None:
+            return torch.from_numpy(np.array(self.read(channel_id, 'prototypes'), dtype=np.float32))
+
+        support = np.asarray(self.read(channel_id, 'support'), dtype=np.float32)[support_indices]
+        support_labels = np.asarray(self.labels('support'))[support_indices]
+        return get_prototypes(torch.from_numpy(support), torch.from_numpy(support_labels))
+
+    def score(self, channel_id, split, prototypes=None, distance='euclidean'):
+        """
+        Return the probability of class 1 of every window of split for a configuration
+        """
+        if prototypes is None:
+            prototypes = self.prototypes(channel_id)
+        embeddings = torch.from_numpy(np.array(self.read(channel_id, split), dtype=np.float32))
+        prob, _ = prototypical_evaluation(prototypes.float(), embeddings, distance_fn=DISTANCES[distance])
+        return prob.numpy()
+
+    def rescore(self, split, channel_ids=None, distance='euclidean', support_indices=None):
+        """
+        Return a dataframe with the AUC of split for every stored configuration (or channel_ids)
+        """
+        if channel_ids is None:
+            channel_ids = self.channel_ids(split)
+        labels = np.asarray(self.labels(split))
+        aucs = []
+        for channel_id in channel_ids:
+            prototypes = self.prototypes(channel_id, support_indices=support_indices)
+            aucs.append(roc_auc_score(labels, self.score(channel_id, split, prototypes, distance)))
+        return pd.DataFrame({'channel_id': channel_ids, '{}_auc'.format(split): aucs})
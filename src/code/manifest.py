@@ -0,0 +1,156 @@
+# coding=utf-8
+import os
+import sqlite3
+
+import numpy as np
+
+from stft_shards import parse_window_filename
+
+LABELS = ['bckg', 'seiz']
+
+
+def group_by_recording(paths):
+    """
+    Group window paths by recording, each recording being the list of its window paths sorted by index
+    """
+    recordings = {}
+    for path in paths:
+        recording_id, _, index, _ = parse_window_filename(path)
+        recordings.setdefault(recording_id, []).append((index, path))
+    return [[path for _, path in sorted(windows)] for windows in recordings.values()]
+
+
+class Manifest(object):
+    """
+    Manifest: sqlite table of the STFT windows, one row per window pickle with its split, path, label
+    (index in LABELS), patient id, session, recording id, window index and offset in the split shard.
+    refresh only lists the directories whose mtime changed since the last refresh, and only
+    inserts (deletes) the windows added (removed) since then.
+    The windows written straight into a shard (see tuh_dataset.make_STFT_from_edf) have no pickle, they are
+    listed under the path their pickle would have in the window directory.
+    """
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=timeout)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS windows (
+                                       split TEXT NOT NULL,
+                                       path TEXT PRIMARY KEY,
+                                       label INTEGER NOT NULL,
+                                       patient_id TEXT NOT NULL,
+                                       session TEXT NOT NULL,
+                                       recording_id TEXT NOT NULL,
+                                       window_index INTEGER NOT NULL,
+                                       shard_offset INTEGER)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS windows_split_label '
+                                'ON windows (split, label, recording_id, window_index)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS windows_patient ON windows (patient_id)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS windows_recording '
+                                'ON windows (recording_id, window_index)')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS directories (
+                                       directory TEXT PRIMARY KEY,
+                                       split TEXT NOT NULL,
+                                       mtime REAL NOT NULL)''')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM windows').fetchone()[0]
+
+    def refresh(self, directories, shards=None):
+        """
+        Bring the manifest up to date with directories, a dict split -> directory of window pickles,
+        and shards, a dict split -> shard directory (see stft_shards), whose windows are added to the ones
+        of the directory of the split. The splits with neither directory nor shard have no windows
+        """
+        shards = shards or {}
+        for split, directory in directories.items():
+            shard_dir = shards.get(split)
+            if shard_dir is None or not os.path.isdir(shard_dir):
+                shard_dir = None
+            sources = [path for path in [directory, shard_dir] if path is not None and os.path.isdir(path)]
+            # a split not written yet is recorded as empty, its windows are added once it is
+            mtime = max([os.stat(path).st_mtime for path in sources] or [0.])
+            row = self.connection.execute('SELECT mtime FROM directories WHERE directory = ?',
+                                          (directory,)).fetchone()
+            if row is not None and row[0] == mtime:
+                continue
+
+            on_disk = set()
+            if os.path.isdir(directory):
+                on_disk.update(os.path.join(directory, entry.name) for entry in os.scandir(directory)
+                               if entry.name.endswith('.pkl'))
+            if shard_dir is not None:
+                on_disk.update(os.path.join(directory, str(filename))
+                               for filename in np.load(os.path.join(shard_dir, 'filenames.npy')))
+            known = {path for path, in self.connection.execute('SELECT path FROM windows WHERE split = ?', (split,))
+                     if os.path.dirname(path) == directory}
+            added = sorted(on_disk - known)
+            removed = known - on_disk
+            with self.connection:
+                self.connection.executemany('DELETE FROM windows WHERE path = ?', [(path,) for path in removed])
+                self.connection.executemany('INSERT OR REPLACE INTO windows VALUES (?, ?, ?, ?, ?, ?, ?, NULL)',
+                                            [(split, path) + self._parse(path) for path in added])
+                self.connection.execute('INSERT OR REPLACE INTO directories VALUES (?, ?, ?)',
+                                        (directory, split, mtime))
+            print("Manifest of {}: {} windows added, {} removed".format(directory, len(added), len(removed)))
+        return self
+
+    @staticmethod
+    def _parse(path):
+        recording_id, label, index, patient_id = parse_window_filename(path)
+        if label not in LABELS:
+            raise ValueError("Unknown label {} in {}".format(label, path))
+        session = recording_id.split('_')[1]
+        return LABELS.index(label), patient_id, session, recording_id, index
+
+    def query(self, columns=('path',), split=None, label=None, patient_id=None, recording_id=None):
+        """
+        Return the rows of the windows matching the given filters (label is 'bckg', 'seiz' or its index),
+        ordered by recording and window index
+        """
+        conditions = []
+        params = []
+        if label in LABELS:
+            label = LABELS.index(label)
+        for column, value in [('split', split), ('label', label), ('patient_id', patient_id),
+                              ('recording_id', recording_id)]:
+            if value is not None:
+                conditions.append('{} = ?'.format(column))
+                params.append(value)
+        query = 'SELECT {} FROM windows'.format(', '.join(columns))
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY recording_id, window_index'
+        return self.connection.execute(query, params).fetchall()
+
+    def paths(self, **filters):
+        return [path for path, in self.query(('path',), **filters)]
+
+    def file_lists(self, splits):
+        """
+        Return the window paths in the layout of the former file_lists.pkl: {split: {'bckg': [...], 'seiz': [...]}}
+        """
+        return {split: {label: self.paths(split=split, label=label) for label in LABELS} for split in splits}
+
+    def find(self, filenames, split=None):
+        """
+        Return the paths of the windows named filenames (with or without .pkl), in the same order
+        """
+        paths_of = {os.path.basename(path)[:-len('.pkl')]: path for path in self.paths(split=split)}
+        names = [os.path.basename(filename).split('.pkl')[0] for filename in filenames]
+        missing = [name for name in names if name not in paths_of]
+        if missing:
+            raise KeyError("{} windows are not in the manifest, e.g. {}".format(len(missing), missing[0]))
+        return [paths_of[name] for name in names]
+
+    def set_shard_offsets(self, file_list):
+        """
+        Record the offset of each window of file_list in the shard written from it
+        """
+        with self.connection:
+            self.connection.executemany('UPDATE windows SET shard_offset = ? WHERE path = ?',
+                                        [(offset, path) for offset, path in enumerate(file_list)])
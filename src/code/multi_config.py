@@ -0,0 +1,119 @@
+# coding=utf-8
+import numpy as np
+import torch
+
+from TSD.few_shot.prototypical_loss import get_batched_prototypes, batched_prototypical_log_odds
+from TSD.code.streaming_metrics import StreamingAUC, num_bins_for_tolerance
+
+
+def expand_masked(x, masks, masked_value=-1):
+    """
+    Build the K masked versions of a batch of windows
+    Args:
+    - x: B x 20 x 160 x 15 windows
+    - masks: K x 20 boolean masks, True for the absent channels (as returned by FETCH.get_mask)
+    Returns the (K * B) x 1 x 3200 x 15 model input, ordered configuration by configuration
+    """
+    x = torch.where(masks[:, None, :, None, None], torch.tensor(masked_value, dtype=x.dtype, device=x.device),
+                    x.unsqueeze(0))
+    return x.reshape((-1, 1, x.shape[2] * x.shape[3], x.shape[4]))
+
+
+def config_block_forward(model, x, masks, token_drop=False):
+    """
+    Return the model outputs of the B windows x for the K configurations of masks, K x B x D
+    With token_drop, the tokens of the absent channels are dropped (one forward per configuration)
+    instead of the channels being filled with -1 (one forward for the K masked versions)
+    """
+    if token_drop:
+        img = x.reshape((x.shape[0], 1, -1, x.shape[3]))
+        return torch.stack([model(img, channel_mask=mask) for mask in masks])
+    return model(expand_masked(x, masks)).reshape((masks.shape[0], x.shape[0], -1))
+
+
+def config_block_prototypes(model, x_support_set, y_support_set, masks, token_drop=False):
+    """
+    Compute the prototypes of every configuration of the block, K x n_classes x D
+    """
+    with torch.no_grad():
+        model_output = config_block_forward(model, x_support_set, masks, token_drop=token_drop)
+    return get_batched_prototypes(model_output, y_support_set)
+
+
+def accumulate_config_block(model, dataloader, prototypes, masks, device, accumulator, max_forward_size=2048,
+                            patch_cache=None, split=None, token_drop=False, window_indices=None):
+    """
+    Stream a split through the model once for a block of K channel configurations.
+    Every batch is moved to the device once and expanded into its K masked versions,
+    which go through the model in a single forward of at most max_forward_size windows.
+    The K x batch log-odds of class 1 are fed to accumulator (a streaming_metrics.StreamingAUC).
+    If patch_cache is given, the windows of `split` are taken from the cached patch embeddings
+    and the masking is done on the embeddings (only the windows window_indices if given, the dataloader
+    is then only used for its batch size).
+    With token_drop, the tokens of the absent channels are dropped instead (see config_block_forward).
+    """
+    num_configs = masks.shape[0]
+    chunk_size = max(1, max_forward_size // num_configs)
+
+    if patch_cache is None:
+        batches = ((x.to(device), y) for x, y in dataloader)
+    else:
+        patch_masks = model.channel_patch_mask(masks.cpu()).to(device)[:, None, :, None]
+        masked_embedding = patch_cache.masked_embedding(device)
+        batches = patch_cache.batches(split, dataloader.batch_size, device, indices=window_indices)
+
+    with torch.no_grad():
+        for x, y in batches:
+            y = torch.as_tensor(y)
+            for start_idx in range(0, x.shape[0], chunk_size):
+                x_chunk = x[start_idx:start_idx + chunk_size]
+                if patch_cache is None:
+                    model_output = config_block_forward(model, x_chunk, masks, token_drop=token_drop)
+                else:
+                    tokens = torch.where(patch_masks, masked_embedding, x_chunk.unsqueeze(0))
+                    model_output = model.forward_patches(tokens.reshape((-1,) + tokens.shape[2:]))
+                    model_output = model_output.reshape((num_configs, x_chunk.shape[0], -1))
+                log_odds = batched_prototypical_log_odds(prototypes, model_output)
+                accumulator.update(log_odds, y[start_idx:start_idx + chunk_size])
+
+
+def evaluate_config_block(model, dataloader, x_support_set, y_support_set, masks, device,
+                          max_forward_size=2048, patch_cache=None, split=None, auc_bins=0, token_drop=False,
+                          window_indices=None, auc_tolerance=0, error_bounds=None):
+    """
+    Return the AUC of each of the K channel configurations of masks on one split
+    With auc_bins > 0, the AUCs are computed from auc_bins-bin score histograms instead of
+    keeping all the scores (see streaming_metrics.StreamingAUC)
+    With auc_tolerance > 0, auc_bins defaults to num_bins_for_tolerance(auc_tolerance), and the configurations
+    whose error bound is above auc_tolerance are evaluated again in exact mode
+    If error_bounds is a list, the error bound of every AUC is appended to it (0 for the exact ones)
+    With token_drop, the tokens of the absent channels are dropped instead of the channels being filled with -1
+    """
+    model.eval()
+    masks = torch.as_tensor(np.asarray(masks), dtype=torch.bool, device=device)
+    prototypes = config_block_prototypes(model, x_support_set, y_support_set, masks, token_drop=token_drop)
+    if auc_bins <= 0 and auc_tolerance > 0:
+        auc_bins = num_bins_for_tolerance(auc_tolerance)
+    accumulator = StreamingAUC(masks.shape[0], num_bins=auc_bins, exact=auc_bins <= 0, device=device)
+    accumulate_config_block(model, dataloader, prototypes, masks, device, accumulator,
+                            max_forward_size=max_forward_size, patch_cache=patch_cache, split=split,
+                            token_drop=token_drop, window_indices=window_indices)
+    aucs = accumulator.auc()
+    bounds = accumulator.error_bound()
+
+    inexact = np.where(bounds > auc_tolerance)[0] if auc_tolerance > 0 else []
+    if len(inexact) > 0:
+        # too many ties in the histograms, e.g. scores piled up in a few bins
+        print("{} configurations above the AUC tolerance {} (error bound up to {:.2e}), evaluated exactly".format(
+            len(inexact), auc_tolerance, bounds[inexact].max()))
+        exact_accumulator = StreamingAUC(len(inexact), exact=True, device=device)
+        inexact_indices = torch.as_tensor(inexact, device=device)
+        accumulate_config_block(model, dataloader, prototypes[inexact_indices], masks[inexact_indices], device,
+                                exact_accumulator, max_forward_size=max_forward_size, patch_cache=patch_cache,
+                                split=split, token_drop=token_drop, window_indices=window_indices)
+        aucs[inexact] = exact_accumulator.auc()
+        bounds[inexact] = 0.
+
+    if error_bounds is not None:
+        error_bounds += bounds.tolist()
+    return aucs.tolist()
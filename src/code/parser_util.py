@@ -98,5 +98,61 @@ def get_parser():
     parser.add_argument('--global_model', action='store_true', help='enables global model')
     parser.add_argument('--server', action='store_true', help='enables server mode -> use more memory')
     parser.add_argument('--num_nodes', type=int, default=-1, help="number of nodes in EEG")
+    parser.add_argument('--sweep_mode', type=str, default='default', choices=['default', 'patch_cache', 'token_drop'],
+                        help="how FETCH.eval evaluates the channel configurations")
+    parser.add_argument('--config_block_size', type=int, default=1,
+                        help="number of channel configurations evaluated in the same forward pass by FETCH.eval")
+    parser.add_argument('--auc_bins', type=int, default=0,
+                        help="histogram bins of the streaming AUC of the configuration blocks, 0 for the exact AUC")
+    parser.add_argument('--auc_tolerance', type=float, default=0,
+                        help="error of the streaming AUC of the configuration blocks, sets the bins if --auc_bins "
+                             "is 0; the configurations with a larger error bound are evaluated exactly, 0 to disable")
+    parser.add_argument('--cache_prototypes', action='store_true',
+                        help="reuse the prototypes of the previous sweeps with the same model and support set")
+    parser.add_argument('--save_embeddings', action='store_true',
+                        help="save the model outputs of every configuration to re-score the sweep later")
+    parser.add_argument('--successive_halving', action='store_true',
+                        help="search the best configurations by successive halving instead of evaluating all of them")
+    parser.add_argument('--halving_top_n', type=int, default=10,
+                        help="number of configurations with exact AUCs at the end of the successive halving")
+    parser.add_argument('--halving_eta', type=int, default=3,
+                        help="1/eta of the configurations survive each round, on eta times more windows")
+    parser.add_argument('--halving_min_fraction', type=float, default=0.05,
+                        help="fraction of the validation windows used in the first round")
+    parser.add_argument('--sweep_workers', type=int, default=1,
+                        help="number of processes sharing the channel configurations of FETCH.eval "
+                             "(successive halving always runs in one process)")
+    parser.add_argument('--threads_per_worker', type=int, default=0,
+                        help="intra-op threads of each sweep worker, 0 to split the cores evenly")
+    parser.add_argument('--load_workers', type=int, default=8,
+                        help="threads or processes reading the STFT pickles, 1 to read them serially")
+    parser.add_argument('--load_backend', type=str, default='thread', choices=['thread', 'process'],
+                        help="pool used to read the STFT pickles")
+    parser.add_argument('--share_memory', action='store_true',
+                        help="load the signals in shared memory")
+    parser.add_argument('--storage_dtype', type=str, default='float32', choices=['float32', 'float16', 'bfloat16'],
+                        help="precision of the STFT kept in memory and in the shards, batches are upcast to float32")
+    parser.add_argument('--shared_signals', action='store_true',
+                        help="keep the signals in one memory-mapped file shared by all the sweep workers")
+    parser.add_argument('--shared_directory', type=str, default='/dev/shm',
+                        help="directory of the shared signal files, /dev/shm for POSIX shared memory")
+    parser.add_argument('--prefetch_depth', type=int, default=2,
+                        help="batches prepared on the device ahead of the training and evaluation loops, 0 to disable")
+    parser.add_argument('--recording_store', action='store_true',
+                        help="precompute the features of the event-based recordings once, rebuilt when the windows change")
+    parser.add_argument('--window_stride', type=int, default=1,
+                        help="the event-based datasets return every window_stride-th window of a recording")
+    parser.add_argument('--resample_method', type=str, default='poly', choices=['poly', 'fft'],
+                        help="resampling of the recordings to --sample_rate: polyphase or the former FFT resample")
+    parser.add_argument('--keep_raw_windows', action='store_true',
+                        help="make_STFT_from_edf also saves the lead-wise window pickles used by the TSD baselines")
+    parser.add_argument('--ledger_checksum', action='store_true',
+                        help="the preprocessing ledger also compares the checksum of the recordings whose mtime changed")
+    parser.add_argument('--preprocess_workers', type=int, default=6,
+                        help="processes preprocessing the EDF files")
+    parser.add_argument('--edf_chunk_seconds', type=float, default=300,
+                        help="the EDF files are read, filtered and resampled in chunks of this duration")
+    parser.add_argument('--edf_overlap_seconds', type=float, default=60,
+                        help="overlap on both sides of the EDF chunks, dropped after the filter and the resampling")
 
     return parser
@@ -0,0 +1,81 @@
+# coding=utf-8
+import torch
+from tqdm import tqdm
+
+
+class PatchEmbeddingCache(object):
+    """
+    PatchEmbeddingCache: keep the ViT patch embeddings of every window of a split.
+    The channel sweep in FETCH.eval evaluates the same windows with thousands of channel masks.
+    Since an absent channel is filled with a constant, its patches always embed to the same vector,
+    so the windows are embedded once and, for every configuration, only the patches of the absent
+    channels are replaced by that constant embedding before running the transformer.
+
+    The cache is only valid for the weights of the model it was built with.
+    """
+
+    def __init__(self, model, masked_value=-1, storage_device='cpu'):
+        """
+        Args:
+        - model: the ViT used in the sweep (its weights must not change after `build`)
+        - masked_value: the value written into the absent channels
+        - storage_device: where the cached embeddings are kept
+        """
+        self.model = model
+        self.masked_value = masked_value
+        self.storage_device = storage_device
+        self.embeddings = {}
+        self.labels = {}
+
+    def __contains__(self, split):
+        return split in self.embeddings
+
+    def build(self, split, dataloader, device):
+        """
+        Embed the patches of all the windows of `dataloader` and store them under `split`.
+        The dataloader must not shuffle, the order of the windows is kept.
+        """
+        self.model.eval()
+        embeddings = []
+        labels = []
+        with torch.no_grad():
+            for x, y in tqdm(dataloader, desc='Embedding {} patches'.format(split)):
+                x = x.to(device)
+                x = x.reshape((x.shape[0], 1, -1, x.shape[3]))
+                embeddings.append(self.model.embed_patches(x).to(self.storage_device))
+                labels.append(torch.as_tensor(y))
+        self.embeddings[split] = torch.cat(embeddings)
+        self.labels[split] = torch.cat(labels)
+
+    def masked_embedding(self, device):
+        """
+        the embedding of a patch of an absent channel
+        """
+        with torch.no_grad():
+            return self.model.constant_patch_embedding(self.masked_value).to(device)
+
+    def batches(self, split, batch_size, device, indices=None):
+        """
+        yield the (patch embeddings, labels) batches of `split`, without any mask
+        If indices is given, only these windows of the split are yielded, in this order
+        """
+        embeddings = self.embeddings[split]
+        labels = self.labels[split]
+        if indices is not None:
+            indices = torch.as_tensor(indices, dtype=torch.long)
+            embeddings = embeddings[indices]
+            labels = labels[indices]
+        for start_idx in range(0, embeddings.shape[0], batch_size):
+            yield (embeddings[start_idx:start_idx + batch_size].to(device),
+                   labels[start_idx:start_idx + batch_size])
+
+    def masked_batches(self, split, mask, batch_size, device):
+        """
+        yield the (patch embeddings, labels) batches of `split` where the patches of the channels
+        set in `mask` (True = absent, as returned by FETCH.get_mask) hold the masked embedding
+        """
+        patch_mask = self.model.channel_patch_mask(mask).to(device)[None, :, None]
+        masked_embedding = self.masked_embedding(device)
+
+        for tokens, labels in self.batches(split, batch_size, device):
+            yield torch.where(patch_mask, masked_embedding, tokens), labels
@@ -0,0 +1,151 @@
+# coding=utf-8
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+
+
+def params_hash(params):
+    """
+    Hash of the preprocessing parameters, a json serializable dict
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def source_params_hash(params, source):
+    """
+    Hash of the preprocessing parameters of source: params is a dict, or a function returning the dict of
+    a source (for the parameters which differ between the sources)
+    """
+    return params_hash(params(source) if callable(params) else params)
+
+
+def file_checksum(path, block_size=1 << 20):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def atomic_pickle_dump(obj, path):
+    """
+    Pickle obj to path through a temporary file renamed over it, so path is either absent or complete
+    (the temporary file ends with .tmp, it is never listed as a window)
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def remove_partial_files(directory):
+    """
+    Remove the temporary files left in directory by an interrupted atomic_pickle_dump
+    """
+    for entry in os.scandir(directory):
+        if entry.name.endswith('.tmp') and entry.is_file():
+            os.remove(entry.path)
+
+
+class PreprocessLedger(object):
+    """
+    PreprocessLedger: sqlite table of the recordings already preprocessed, one row per (stage, source) with
+    the size, mtime (and optionally the checksum) of the source, the hash of the preprocessing parameters
+    and the list of the files written from it.
+    A stage is an output directory (e.g. the lead-wise windows of a split); a source is recorded once all its
+    outputs are written, so after a change or an interruption only the new, changed or unfinished sources
+    are processed again.
+    With checksum, a source whose mtime changed but whose content did not is not processed again.
+    The params are a dict, or a function of the source (see source_params_hash).
+    """
+
+    def __init__(self, path, checksum=False, timeout=60):
+        self.path = path
+        self.checksum = checksum
+        self.connection = sqlite3.connect(path, timeout=timeout)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS sources (
+                                       stage TEXT NOT NULL,
+                                       source TEXT NOT NULL,
+                                       size INTEGER NOT NULL,
+                                       mtime_ns INTEGER NOT NULL,
+                                       checksum TEXT,
+                                       params_hash TEXT NOT NULL,
+                                       outputs TEXT NOT NULL,
+                                       PRIMARY KEY (stage, source))''')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM sources').fetchone()[0]
+
+    def _entries(self, stage):
+        return {row[0]: row[1:] for row in self.connection.execute(
+            'SELECT source, size, mtime_ns, checksum, params_hash, outputs FROM sources WHERE stage = ?', (stage,))}
+
+    def _is_done(self, stage, source, entry, params):
+        size, mtime_ns, checksum, entry_params_key, _ = entry
+        stat = os.stat(source)
+        if entry_params_key != source_params_hash(params, source) or stat.st_size != size:
+            return False
+        if stat.st_mtime_ns == mtime_ns:
+            return True
+        if not self.checksum or checksum is None or file_checksum(source) != checksum:
+            return False
+        # touched but not modified
+        with self.connection:
+            self.connection.execute('UPDATE sources SET mtime_ns = ? WHERE stage = ? AND source = ?',
+                                    (stat.st_mtime_ns, stage, source))
+        return True
+
+    def update(self, stage, sources, params):
+        """
+        Compare sources with the ledger of stage and return the ones to process: new, changed, processed with
+        other params or interrupted. The outputs of the changed sources and of the recorded sources which are
+        not in sources anymore are removed, as well as their entries.
+        """
+        entries = self._entries(stage)
+        pending = [source for source in sources
+                   if source not in entries or not self._is_done(stage, source, entries[source], params)]
+        stale = (set(entries) - set(sources)) | (set(pending) & set(entries))
+        for source in stale:
+            for output in json.loads(entries[source][4]):
+                if os.path.exists(output):
+                    os.remove(output)
+        with self.connection:
+            self.connection.executemany('DELETE FROM sources WHERE stage = ? AND source = ?',
+                                        [(stage, source) for source in stale])
+        print("Ledger of {}: {} sources to process, {} up to date, {} removed".format(
+            stage, len(pending), len(sources) - len(pending), len(set(entries) - set(sources))))
+        return pending
+
+    def record(self, stage, source, params, outputs):
+        """
+        Record that source was processed with params into outputs (all written)
+        """
+        stat = os.stat(source)
+        checksum = file_checksum(source) if self.checksum else None
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (stage, source, stat.st_size, stat.st_mtime_ns, checksum,
+                                     source_params_hash(params, source), json.dumps(list(outputs))))
+
+    def outputs(self, stage):
+        """
+        Return the outputs recorded for stage, per source
+        """
+        return {source: json.loads(entry[4]) for source, entry in self._entries(stage).items()}
+
+    def move(self, stage, new_stage):
+        """
+        Move the entries of stage to new_stage (e.g. once the outputs of a temporary stage are renamed),
+        they replace the entries of new_stage with the same sources
+        """
+        with self.connection:
+            self.connection.execute('DELETE FROM sources WHERE stage = ? AND source IN '
+                                    '(SELECT source FROM sources WHERE stage = ?)', (new_stage, stage))
+            self.connection.execute('UPDATE sources SET stage = ? WHERE stage = ?', (new_stage, stage))
@@ -0,0 +1,105 @@
+# coding=utf-8
+import os
+import pickle
+import shutil
+
+import numpy as np
+from tqdm import tqdm
+
+from stft_shards import parse_window_filename
+
+
+def write_recording_store(recordings, store_dir, feature_fn, sources_key=None):
+    """
+    Compute the features of every window once and store them recording by recording in one contiguous
+    array (features.npy, total windows x feature shape), with the window range of each recording
+    (recording_offsets.npy, n_recordings + 1), the window labels, the recording ids and the window indices.
+    Args:
+    - recordings: lists of window pickles, one list per recording sorted by index
+      (see manifest.group_by_recording)
+    - feature_fn: maps the 20 x 3072 signals of a window to its features
+    - sources_key: identifies the windows and the features the store is written from (e.g. a hash of
+      the paths, mtimes and feature parameters), saved to tell a stale store
+    """
+    tmp_dir = store_dir + '.tmp'
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    num_windows = sum(len(recording) for recording in recordings)
+    recording_offsets = np.cumsum([0] + [len(recording) for recording in recordings]).astype(np.int64)
+    labels = np.zeros(num_windows)
+    window_indices = np.zeros(num_windows, dtype=np.int32)
+    features = None
+    window_idx = 0
+    for recording in tqdm(recordings, desc="Writing {}".format(os.path.basename(store_dir))):
+        for filepath in recording:
+            with open(filepath, 'rb') as f:
+                data_pkl = pickle.load(f)
+            window_features = np.asarray(feature_fn(np.asarray(data_pkl['signals'])), dtype=np.float32)
+            if features is None:
+                features = np.lib.format.open_memmap(os.path.join(tmp_dir, 'features.npy'), mode='w+',
+                                                     dtype=np.float32,
+                                                     shape=(num_windows,) + window_features.shape)
+            features[window_idx] = window_features
+            labels[window_idx] = 0. if data_pkl['label'] == "bckg" else 1.
+            window_indices[window_idx] = parse_window_filename(filepath)[2]
+            window_idx += 1
+    if features is not None:
+        features.flush()
+        del features
+
+    np.save(os.path.join(tmp_dir, 'recording_offsets.npy'), recording_offsets)
+    np.save(os.path.join(tmp_dir, 'labels.npy'), labels)
+    np.save(os.path.join(tmp_dir, 'window_indices.npy'), window_indices)
+    np.save(os.path.join(tmp_dir, 'recording_ids.npy'),
+            np.array([parse_window_filename(recording[0])[0] for recording in recordings]))
+    if sources_key is not None:
+        np.save(os.path.join(tmp_dir, 'sources_key.npy'), np.array(sources_key))
+
+    if os.path.isdir(store_dir):
+        shutil.rmtree(store_dir)
+    os.rename(tmp_dir, store_dir)
+
+
+class RecordingStore(object):
+    """
+    RecordingStore: the per-recording window features written by write_recording_store.
+    The features are memory mapped, recording returns views of them without copying or recomputing anything.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        # copy-on-write, so the views can be handed to torch without a read-only warning
+        self.features = np.load(os.path.join(store_dir, 'features.npy'), mmap_mode='c')
+        self.recording_offsets = np.load(os.path.join(store_dir, 'recording_offsets.npy'))
+        self.labels = np.load(os.path.join(store_dir, 'labels.npy'))
+        self.window_indices = np.load(os.path.join(store_dir, 'window_indices.npy'))
+        self.recording_ids = np.load(os.path.join(store_dir, 'recording_ids.npy'))
+        sources_key_path = os.path.join(store_dir, 'sources_key.npy')
+        self.sources_key = str(np.load(sources_key_path)) if os.path.exists(sources_key_path) else None
+
+    def __len__(self):
+        return len(self.recording_ids)
+
+    def recording_index(self, recording_ids, num_windows=None):
+        """
+        Return the positions of recording_ids in the store, None if some of them are not in it
+        (or, if given, do not have num_windows windows)
+        """
+        index_of = {recording_id: idx for idx, recording_id in enumerate(self.recording_ids)}
+        indices = [index_of.get(recording_id) for recording_id in recording_ids]
+        if any(idx is None for idx in indices):
+            return None
+        if num_windows is not None and \
+                np.any(np.diff(self.recording_offsets)[indices] != np.asarray(num_windows)):
+            return None
+        return indices
+
+    def recording(self, idx, stride=1):
+        """
+        Return the features (n_windows x feature shape) and the labels (n_windows x 1) of the idx-th recording,
+        every stride-th window, as views of the store
+        """
+        start, end = self.recording_offsets[idx], self.recording_offsets[idx + 1]
+        return self.features[start:end:stride], self.labels[start:end:stride, None]
@@ -0,0 +1,101 @@
+# coding=utf-8
+import argparse
+import json
+import time
+
+import numpy as np
+from scipy.signal import welch
+
+from resampling import resample_channels, resample_factors
+
+NUM_CHANNELS = 20
+
+
+def synthetic_eeg(fs, duration, num_channels=NUM_CHANNELS, seed=0):
+    """
+    A sum of sinusoids in the EEG band (0.5 - 100 Hz), evaluated exactly at the rate fs.
+    Returns the signals and the function giving them at any rate, the reference of the resampled signals
+    """
+    rng = np.random.RandomState(seed)
+    freqs = rng.uniform(0.5, 100., size=(num_channels, 32))
+    amplitudes = 1. / freqs  # 1/f spectrum
+    phases = rng.uniform(0, 2 * np.pi, size=(num_channels, 32))
+
+    def at_rate(rate):
+        t = np.arange(int(duration * rate)) / rate
+        signals = np.zeros((num_channels, len(t)))
+        for channel in range(num_channels):
+            signals[channel] = np.sum(amplitudes[channel, :, None] *
+                                      np.sin(2 * np.pi * freqs[channel, :, None] * t + phases[channel, :, None]),
+                                      axis=0)
+        return signals
+
+    return at_rate(fs), at_rate
+
+
+def fidelity(resampled, reference, target_fs, edge=1., band=(0.5, 100.), floor_db=-40.):
+    """
+    Relative RMS error in time, and largest deviation (dB) of the power in the 1 Hz bands of band
+    holding more than floor_db of the strongest one, away from the edges
+    """
+    edge_samples = int(edge * target_fs)
+    resampled = resampled[:, edge_samples:-edge_samples]
+    reference = reference[:, edge_samples:-edge_samples]
+    relative_error = np.sqrt(np.mean((resampled - reference) ** 2) / np.mean(reference ** 2))
+
+    freqs, psd = welch(resampled, fs=target_fs, nperseg=4 * target_fs, axis=-1)
+    _, reference_psd = welch(reference, fs=target_fs, nperseg=4 * target_fs, axis=-1)
+    bands = np.floor(freqs).astype(int)
+    power = np.zeros((psd.shape[0], bands.max() + 1))
+    reference_power = np.zeros_like(power)
+    np.add.at(power.T, bands, psd.T)
+    np.add.at(reference_power.T, bands, reference_psd.T)
+    in_band = np.zeros(power.shape[1], dtype=bool)
+    in_band[int(band[0]):int(band[1])] = True
+    significant = in_band & (reference_power > reference_power.max() * 10 ** (floor_db / 10))
+    power_deviation = np.max(np.abs(10 * np.log10(power[significant] / reference_power[significant])))
+    return float(relative_error), float(power_deviation)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Speed and fidelity of the resampling of the recordings')
+    parser.add_argument('--source_rates', type=int, nargs='+', default=[250, 400, 500, 512, 1000])
+    parser.add_argument('--target_rate', type=int, default=256)
+    parser.add_argument('--duration', type=float, default=600., help="seconds of recording")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', type=str, default='resample_benchmark_results.json')
+    return parser
+
+
+def main():
+    options = get_parser().parse_args()
+    num_target_samples = int(options.duration * options.target_rate)
+    results = []
+    for fs in options.source_rates:
+        signals, at_rate = synthetic_eeg(fs, options.duration)
+        reference = at_rate(options.target_rate)
+        for method in ['fft', 'poly']:
+            elapsed = []
+            for _ in range(options.repeats):
+                start_time = time.time()
+                resampled = resample_channels(signals, fs, options.target_rate, num_target_samples, method=method)
+                elapsed.append(time.time() - start_time)
+            relative_error, psd_deviation = fidelity(resampled, reference, options.target_rate)
+            result = {'source_rate': fs,
+                      'method': method,
+                      'factors': resample_factors(fs, options.target_rate) if method == 'poly' else None,
+                      'seconds': min(elapsed),
+                      'relative_error': relative_error,
+                      'band_power_deviation_db': psd_deviation}
+            print("{source_rate:>5} Hz {method:>4}: {seconds:8.3f}s, relative error {relative_error:.2e}, "
+                  "band power deviation {band_power_deviation_db:.4f} dB".format(**result))
+            results.append(result)
+
+    with open(options.output, 'w') as f:
+        json.dump({'target_rate': options.target_rate, 'duration': options.duration,
+                   'num_channels': NUM_CHANNELS, 'results': results}, f, indent=2)
+    print("Results saved to", options.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# coding=utf-8
+from fractions import Fraction
+from functools import lru_cache
+
+import numpy as np
+from scipy.signal import firwin, resample, resample_poly
+
+RESAMPLE_METHODS = ['poly', 'fft']
+
+
+@lru_cache(maxsize=None)
+def resample_factors(fs, target_fs, max_denominator=1000):
+    """
+    Return the (up, down) integer factors of target_fs / fs, e.g. (128, 125) from 250 Hz to 256 Hz.
+    The ratio is exact for integer rates, non-integer rates are approximated with a denominator of
+    at most max_denominator.
+    """
+    if float(fs).is_integer() and float(target_fs).is_integer():
+        ratio = Fraction(int(target_fs), int(fs))
+    else:
+        ratio = Fraction(float(target_fs) / float(fs)).limit_denominator(max_denominator)
+    return ratio.numerator, ratio.denominator
+
+
+@lru_cache(maxsize=None)
+def polyphase_filter(up, down):
+    """
+    The anti-aliasing filter resample_poly designs by default for (up, down), designed once
+    """
+    max_rate = max(up, down)
+    return firwin(2 * 10 * max_rate + 1, 1. / max_rate, window=('kaiser', 5.0))
+
+
+def resample_chunk(signals, up, down):
+    """
+    Polyphase resampling of signals by up / down along the last axis, all the ceil(n * up / down) samples.
+    Output sample k corresponds to input sample k * down / up, so a chunk starting on a multiple of down
+    resamples to a chunk starting on an output sample.
+    """
+    return resample_poly(signals, up, down, axis=-1, window=polyphase_filter(up, down))
+
+
+def resample_channels(signals, fs, target_fs, num_target_samples, method='poly'):
+    """
+    Resample the channels x samples signals from fs to target_fs, all the channels in one call
+    - poly: polyphase filtering with the exact rational ratio of the rates
+    - fft: scipy.signal.resample of the whole recording (the former path)
+    Returns channels x num_target_samples (the polyphase output is trimmed or zero-padded to it)
+    """
+    if method == 'fft':
+        return resample(signals, num_target_samples, axis=-1)
+
+    up, down = resample_factors(fs, target_fs)
+    resampled = resample_chunk(signals, up, down)
+    if resampled.shape[-1] >= num_target_samples:
+        return resampled[..., :num_target_samples]
+    return np.pad(resampled, [(0, 0)] * (resampled.ndim - 1) + [(0, num_target_samples - resampled.shape[-1])])
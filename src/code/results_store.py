@@ -0,0 +1,117 @@
+# coding=utf-8
+import sqlite3
+
+import pandas as pd
+
+RESULTS_COLUMNS = ['channel_id', 'val_auc', 'test_auc', 'experiment_name', 'model_name', 'number_nodes']
+SPLITS = {'val': 'val_auc', 'test': 'test_auc'}
+
+
+class ResultsStore(object):
+    """
+    ResultsStore: append-only sqlite store of the channel sweep results.
+    Every configuration is written (and committed) as soon as it is evaluated, one row per
+    (experiment_name, model_name, channel_id, split), so an interrupted sweep loses nothing and can
+    skip the configurations already done when it is restarted.
+    to_dataframe returns the same columns as the results.csv written by FETCH.eval.
+    """
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=timeout)
+        # readers (e.g. the analysis notebook) do not block the sweep
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS results (
+                                       experiment_name TEXT NOT NULL,
+                                       model_name TEXT NOT NULL,
+                                       channel_id INTEGER NOT NULL,
+                                       split TEXT NOT NULL,
+                                       auc REAL,
+                                       number_nodes INTEGER,
+                                       PRIMARY KEY (experiment_name, model_name, channel_id, split))''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS results_auc '
+                                'ON results (model_name, split, number_nodes, auc)')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def add(self, results):
+        """
+        Write the results of one configuration, a dict with the keys of RESULTS_COLUMNS
+        """
+        rows = [(results['experiment_name'], results['model_name'], int(results['channel_id']), split,
+                 float(results[column]), int(results['number_nodes']))
+                for split, column in SPLITS.items() if results.get(column) is not None]
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def add_many(self, results_list):
+        for results in results_list:
+            self.add(results)
+
+    def done_channel_ids(self, experiment_name, model_name, splits=tuple(SPLITS)):
+        """
+        Return the set of channel_ids having a result for all the splits
+        """
+        query = ('SELECT channel_id FROM results WHERE experiment_name = ? AND model_name = ? '
+                 'AND split IN ({}) GROUP BY channel_id HAVING COUNT(DISTINCT split) = ?'
+                 .format(', '.join('?' * len(splits))))
+        cursor = self.connection.execute(query, (experiment_name, model_name) + tuple(splits) + (len(splits),))
+        return {row[0] for row in cursor}
+
+    def _select(self, experiment_name=None, model_name=None, number_nodes=None):
+        conditions = []
+        params = []
+        for column, value in [('experiment_name', experiment_name), ('model_name', model_name),
+                              ('number_nodes', number_nodes)]:
+            if value is not None:
+                conditions.append('{} = ?'.format(column))
+                params.append(value)
+        query = 'SELECT * FROM results'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        return pd.read_sql_query(query, self.connection, params=params)
+
+    def to_dataframe(self, experiment_name=None, model_name=None, number_nodes=None):
+        """
+        Return the results in the results.csv layout: one row per configuration with val_auc and test_auc
+        """
+        long_df = self._select(experiment_name, model_name, number_nodes)
+        if len(long_df) == 0:
+            return pd.DataFrame(columns=RESULTS_COLUMNS)
+        results_df = long_df.pivot_table(index=['experiment_name', 'model_name', 'number_nodes', 'channel_id'],
+                                         columns='split', values='auc').reset_index()
+        results_df = results_df.rename(columns=SPLITS)
+        results_df.columns.name = None
+        for column in SPLITS.values():
+            if column not in results_df:
+                results_df[column] = float('nan')
+        return results_df[RESULTS_COLUMNS]
+
+    def top_configurations(self, n=10, split='val', model_name=None, number_nodes=None):
+        """
+        Return the n best configurations according to the AUC of split
+        """
+        results_df = self.to_dataframe(model_name=model_name, number_nodes=number_nodes)
+        return results_df.nlargest(n, SPLITS[split])
+
+    def summary(self):
+        """
+        Return the number of configurations and the AUC statistics per model, number of nodes and split
+        """
+        query = ('SELECT experiment_name, model_name, number_nodes, split, COUNT(*) AS num_configurations, '
+                 'AVG(auc) AS mean_auc, MIN(auc) AS min_auc, MAX(auc) AS max_auc FROM results '
+                 'GROUP BY experiment_name, model_name, number_nodes, split')
+        return pd.read_sql_query(query, self.connection)
+
+
+def load_results(path, experiment_name=None, model_name=None, number_nodes=None):
+    """
+    Read the results of a store in the results.csv layout, e.g. from the analysis notebook
+    """
+    results_store = ResultsStore(path)
+    try:
+        return results_store.to_dataframe(experiment_name, model_name, number_nodes)
+    finally:
+        results_store.close()
@@ -0,0 +1,83 @@
+# coding=utf-8
+import os
+import uuid
+import weakref
+
+import numpy as np
+import torch
+
+
+def _close_if_owner(fd, owner_pid):
+    # forked processes inherit the finalizer, only the process which wrote the file closes it
+    if os.getpid() == owner_pid:
+        os.close(fd)
+
+
+class SharedSignals(object):
+    """
+    SharedSignals: a N x 20 x 160 x 15 signal tensor kept in one .npy file (a shard, or a file written once
+    in /dev/shm) and memory mapped by every process using it.
+    Pickling only sends the path, so the spawned sweep workers (see FETCH.eval) map the same physical pages
+    instead of receiving their own copy. The training and evaluation loaders of an in-memory dataset read it
+    in-process (see tuh_dataset.make_loader), they have no worker to share it with.
+    Indexing returns torch tensors, like the tensor it replaces.
+    """
+
+    def __init__(self, path, bfloat16=False):
+        self.path = path
+        self.bfloat16 = bfloat16
+        self._tensor = None
+
+    @classmethod
+    def from_tensor(cls, tensor, directory='/dev/shm'):
+        """
+        Write tensor once to a file of directory which is unlinked as soon as it is created: the other processes
+        open it through /proc/<pid>/fd of the process which created it, while the returned object lives there.
+        Its space is freed once the last process mapping it exits, even if the run is killed
+        """
+        bfloat16 = tensor.dtype == torch.bfloat16
+        array = tensor.view(torch.int16).numpy() if bfloat16 else tensor.numpy()
+        path = os.path.join(directory, 'fetch_signals_{}_{}.npy'.format(os.getpid(), uuid.uuid4().hex))
+        out = np.lib.format.open_memmap(path, mode='w+', dtype=array.dtype, shape=array.shape)
+        fd = os.open(path, os.O_RDONLY)
+        os.remove(path)
+        out[:] = array
+        out.flush()
+        del out
+
+        shared_signals = cls('/proc/{}/fd/{}'.format(os.getpid(), fd), bfloat16=bfloat16)
+        weakref.finalize(shared_signals, _close_if_owner, fd, os.getpid())
+        return shared_signals
+
+    @property
+    def tensor(self):
+        if self._tensor is None:
+            # copy-on-write: the pages stay shared as long as no process writes to them
+            self._tensor = torch.from_numpy(np.load(self.path, mmap_mode='c'))
+            if self.bfloat16:
+                self._tensor = self._tensor.view(torch.bfloat16)
+        return self._tensor
+
+    def __getstate__(self):
+        return {'path': self.path, 'bfloat16': self.bfloat16}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], bfloat16=state['bfloat16'])
+
+    @property
+    def shape(self):
+        return self.tensor.shape
+
+    @property
+    def dtype(self):
+        return self.tensor.dtype
+
+    def __len__(self):
+        return self.tensor.shape[0]
+
+    def __getitem__(self, idx):
+        return self.tensor[idx]
+
+    def share_memory_(self):
+        # already shared
+        return self
@@ -0,0 +1,183 @@
+# coding=utf-8
+import os
+import pickle
+import shutil
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+STFT_SHAPE = (20, 160, 15)
+# the log-magnitudes fit in 16 bits, the windows are upcast to float32 when they are batched
+STORAGE_DTYPES = {'float32': torch.float32, 'float16': torch.float16, 'bfloat16': torch.bfloat16}
+
+
+def parse_window_filename(filepath):
+    """
+    Parse the name of a window pickle, e.g. aaaaafxr_s002_t002_label_bckg_index_9.pkl
+    Returns the recording id (aaaaafxr_s002_t002), the label (bckg), the window index (9)
+    and the patient id (aaaaafxr)
+    """
+    filename = os.path.basename(filepath)
+    recording_id = filename.split('_label')[0]
+    label = filename.split('_label_')[-1].split('_index')[0]
+    index = int(filename.split('index_')[-1].split('.pkl')[0])
+    patient_id = recording_id.split('_')[0]
+    return recording_id, label, index, patient_id
+
+
+def to_storage(stft, dtype):
+    """
+    Return the STFT (numpy array or torch tensor) as the numpy array stored in a shard of dtype
+    """
+    if not torch.is_tensor(stft):
+        stft = torch.from_numpy(np.asarray(stft))
+    stft = stft.to(STORAGE_DTYPES[dtype])
+    return (stft.view(torch.int16) if dtype == 'bfloat16' else stft).numpy()
+
+
+def same_layout(shard_dir, filenames, dtype):
+    """
+    Whether shard_dir holds the windows named filenames (in this order) stored in dtype
+    """
+    filenames_path = os.path.join(shard_dir, 'filenames.npy')
+    dtype_path = os.path.join(shard_dir, 'storage_dtype.npy')
+    if not (os.path.exists(filenames_path) and os.path.exists(dtype_path)):
+        return False
+    return str(np.load(dtype_path)) == dtype and np.load(filenames_path).tolist() == \
+        [os.path.basename(filename) for filename in filenames]
+
+
+class ShardWriter(object):
+    """
+    ShardWriter: write the N x 20 x 160 x 15 STFT of the windows named filenames (window pickle names,
+    see parse_window_filename) into a shard, in any order and in batches: write(offsets, stft) stores
+    stft[i] as the window filenames[offsets[i]].
+    The side arrays labels.npy, patient_ids.npy, recording_ids.npy, window_indices.npy and filenames.npy
+    follow the order of filenames.
+    dtype is one of STORAGE_DTYPES, bfloat16 (not a numpy type) is saved as its int16 bit pattern.
+    The shard is written to a temporary directory and only moved to shard_dir by close, so a partial shard
+    is never read, and the previous shard can be read while the new one is written.
+    With resume, the temporary directory left by an interrupted writer with the same filenames and dtype is
+    reopened (resumed is then True) instead of being started over, the windows already written are kept.
+    """
+
+    def __init__(self, filenames, shard_dir, dtype='float32', resume=False):
+        self.filenames = [os.path.basename(filename) for filename in filenames]
+        self.shard_dir = shard_dir
+        self.dtype = dtype
+        self.tmp_dir = shard_dir + '.tmp'
+        # other processes can write their windows too, by memory mapping signals_path in r+ mode
+        self.signals_path = os.path.join(self.tmp_dir, 'signals.npy')
+        self.resumed = resume and self._same_layout()
+        if self.resumed:
+            self.signals = np.load(self.signals_path, mmap_mode='r+')
+            return
+
+        if os.path.isdir(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+        os.makedirs(self.tmp_dir)
+        self.signals = np.lib.format.open_memmap(self.signals_path, mode='w+',
+                                                 dtype=np.int16 if dtype == 'bfloat16' else dtype,
+                                                 shape=(len(self.filenames),) + STFT_SHAPE)
+        # written last, the layout of a temporary directory is only checked once its signals are allocated
+        np.save(os.path.join(self.tmp_dir, 'storage_dtype.npy'), np.array(self.dtype))
+        np.save(os.path.join(self.tmp_dir, 'filenames.npy'), np.array(self.filenames))
+
+    def _same_layout(self):
+        """
+        whether the temporary directory holds the signals of the same windows in the same dtype
+        """
+        return same_layout(self.tmp_dir, self.filenames, self.dtype)
+
+    def write(self, offsets, stft):
+        self.signals[offsets] = to_storage(stft, self.dtype)
+
+    def close(self):
+        self.signals.flush()
+        del self.signals
+
+        parsed_filenames = [parse_window_filename(filename) for filename in self.filenames]
+        np.save(os.path.join(self.tmp_dir, 'labels.npy'),
+                np.array([0 if p[1] == "bckg" else 1 for p in parsed_filenames], dtype=np.int8))
+        np.save(os.path.join(self.tmp_dir, 'storage_dtype.npy'), np.array(self.dtype))
+        np.save(os.path.join(self.tmp_dir, 'recording_ids.npy'), np.array([p[0] for p in parsed_filenames]))
+        np.save(os.path.join(self.tmp_dir, 'window_indices.npy'),
+                np.array([p[2] for p in parsed_filenames], dtype=np.int32))
+        np.save(os.path.join(self.tmp_dir, 'patient_ids.npy'), np.array([p[3] for p in parsed_filenames]))
+        np.save(os.path.join(self.tmp_dir, 'filenames.npy'), np.array(self.filenames))
+
+        if os.path.isdir(self.shard_dir):
+            shutil.rmtree(self.shard_dir)
+        os.rename(self.tmp_dir, self.shard_dir)
+
+
+def write_shard(file_list, shard_dir, dtype='float32'):
+    """
+    Pack the STFT pickles of file_list into one contiguous N x 20 x 160 x 15 array (signals.npy),
+    with the side arrays of ShardWriter, all in the order of file_list.
+    """
+    writer = ShardWriter(file_list, shard_dir, dtype=dtype)
+    for idx, filepath in enumerate(tqdm(file_list, desc="Writing {}".format(os.path.basename(shard_dir)))):
+        with open(filepath, 'rb') as f:
+            writer.write(idx, pickle.load(f)['STFT'])
+    writer.close()
+
+
+def read_shard(shard_dir):
+    """
+    Open a shard written by write_shard. The signals are memory mapped copy-on-write, so no data is read
+    until it is accessed and the pages are shared (through the page cache) by all the processes reading it.
+    Returns a dict with the signals as a torch tensor and the side arrays as numpy arrays
+    """
+    signals = torch.from_numpy(np.load(os.path.join(shard_dir, 'signals.npy'), mmap_mode='c'))
+    dtype_path = os.path.join(shard_dir, 'storage_dtype.npy')
+    if os.path.exists(dtype_path) and str(np.load(dtype_path)) == 'bfloat16':
+        signals = signals.view(torch.bfloat16)
+    shard = {'signals': signals}
+    for name in ['labels', 'patient_ids', 'recording_ids', 'window_indices', 'filenames']:
+        shard[name] = np.load(os.path.join(shard_dir, name + '.npy'))
+    return shard
+
+
+def shard_indices(shard, file_list):
+    """
+    Return the indices of the windows of file_list in the shard, None if some of them are not in it
+    """
+    index_of = {filename: idx for idx, filename in enumerate(shard['filenames'])}
+    indices = [index_of.get(os.path.basename(filepath)) for filepath in file_list]
+    if any(idx is None for idx in indices):
+        return None
+    return np.asarray(indices, dtype=np.int64)
+
+
+class ShardWindows(object):
+    """
+    ShardWindows: the windows of file_list read from the memory-mapped shard holding them instead of their
+    pickles, which the windows written by tuh_dataset.make_STFT_from_edf do not have.
+    windows[idx] returns the float32 STFT (a copy, it can be modified in place) and the label (0. or 1.)
+    of the window file_list[idx]
+    """
+
+    def __init__(self, shard, indices):
+        self.signals = shard['signals']
+        self.labels = shard['labels']
+        self.indices = indices
+
+    @classmethod
+    def open(cls, file_list, shard_dir):
+        """
+        Return the ShardWindows of file_list, None if shard_dir does not hold a shard containing all of them
+        """
+        if len(file_list) == 0 or not os.path.isdir(shard_dir):
+            return None
+        shard = read_shard(shard_dir)
+        indices = shard_indices(shard, file_list)
+        return None if indices is None else cls(shard, indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        offset = self.indices[idx]
+        return self.signals[offset].to(torch.float, copy=True).numpy(), float(self.labels[offset])
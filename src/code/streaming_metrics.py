@@ -0,0 +1,138 @@
+# coding=utf-8
+import math
+
+import numpy as np
+import torch
+from sklearn.metrics import roc_auc_score
+
+
+def num_bins_for_tolerance(tolerance):
+    """
+    Number of histogram bins (a power of two, see StreamingAUC) for which the AUC error is below tolerance for
+    usual score distributions: the error is 1 / (2 * num_bins) for scores spread evenly over the bins, the 4x margin
+    covers the scores piling up in part of the range. The actual bound of a run is given by StreamingAUC.error_bound
+    """
+    return 2 ** int(math.ceil(math.log2(4. / tolerance)))
+
+
+class StreamingAUC(object):
+    """
+    StreamingAUC: ROC-AUC of K configurations accumulated batch by batch.
+    In histogram mode, only a K x num_bins histogram of the scores of each class is kept, so the memory
+    does not depend on the number of windows. The windows falling in the same bin are counted as ties,
+    which is what error_bound measures. In exact mode, all the scores are kept and sklearn is used.
+
+    The scores can be any increasing function of the probability of class 1. The prototypical probabilities
+    saturate at 0 and 1, so the log-odds before the softmax are given instead
+    (see prototypical_loss.batched_prototypical_log_odds).
+    The range of the bins of each configuration is fitted on its first batch, and doubled (merging the bins
+    two by two) whenever a later score falls outside of it, so no score is clipped into the end bins.
+    num_bins is rounded up to a power of two for the merges.
+    """
+
+    def __init__(self, num_configs, num_bins=4096, exact=False, device='cpu'):
+        self.num_configs = num_configs
+        self.num_bins = 2 ** int(math.ceil(math.log2(max(num_bins, 2))))
+        self.exact = exact
+        self.device = device
+
+        if self.exact:
+            self.scores = []
+            self.labels = []
+        else:
+            self.positives = torch.zeros(num_configs * self.num_bins, dtype=torch.float64, device=device)
+            self.negatives = torch.zeros(num_configs * self.num_bins, dtype=torch.float64, device=device)
+            # bins of configuration k: [low[k] + i * width[k] / num_bins, low[k] + (i + 1) * width[k] / num_bins)
+            self.low = None
+            self.width = None
+
+    def _fit_range(self, scores):
+        """
+        Fit the range of the bins on the first batch, with a margin of a quarter of its spread on each side
+        """
+        low, high = scores.min(1)[0], scores.max(1)[0]
+        spread = (high - low).clamp(min=1e-6)
+        self.low = low - 0.25 * spread
+        self.width = 1.5 * spread
+
+    def _extend_range(self, scores):
+        """
+        Double the range of the configurations whose scores fall outside of it, towards the lowest (resp. highest)
+        score, until all the scores fit. The bins are merged two by two, so the counts stay exact
+        """
+        low, high = scores.min(1)[0], scores.max(1)[0]
+        positives, negatives = self._histograms()
+        while True:
+            below = low < self.low
+            above = high >= self.low + self.width
+            extend = below | above
+            if not extend.any():
+                return
+            for histogram in [positives, negatives]:
+                merged = histogram[extend].view(-1, self.num_bins // 2, 2).sum(2)
+                zeros = torch.zeros_like(merged)
+                histogram[extend] = torch.where(below[extend, None], torch.cat([zeros, merged], 1),
+                                                torch.cat([merged, zeros], 1))
+            self.low = torch.where(below, self.low - self.width, self.low)
+            self.width = torch.where(extend, 2 * self.width, self.width)
+
+    def _bins(self, scores):
+        if self.low is None:
+            self._fit_range(scores)
+        else:
+            self._extend_range(scores)
+        bins = ((scores - self.low[:, None]) / self.width[:, None] * self.num_bins).long()
+        bins = bins.clamp(0, self.num_bins - 1)
+        offsets = torch.arange(self.num_configs, device=self.device).unsqueeze(1) * self.num_bins
+        return bins + offsets
+
+    def update(self, scores, labels):
+        """
+        Args:
+        - scores: K x B scores of class 1, e.g. log-odds
+        - labels: B binary labels
+        """
+        labels = torch.as_tensor(labels)
+        if self.exact:
+            self.scores.append(scores.detach().cpu())
+            self.labels.append(labels.cpu())
+            return
+
+        labels = labels.to(self.device).bool()
+        bins = self._bins(scores.detach().to(self.device, torch.float64))
+        minlength = self.num_configs * self.num_bins
+        self.positives += torch.bincount(bins[:, labels].flatten(), minlength=minlength).double()
+        self.negatives += torch.bincount(bins[:, ~labels].flatten(), minlength=minlength).double()
+
+    def _histograms(self):
+        positives = self.positives.view(self.num_configs, self.num_bins)
+        negatives = self.negatives.view(self.num_configs, self.num_bins)
+        return positives, negatives
+
+    def auc(self):
+        """
+        Return the AUC of each configuration, a numpy array of size K
+        """
+        if self.exact:
+            scores = torch.cat(self.scores, dim=1).numpy()
+            labels = torch.cat(self.labels).numpy()
+            return np.array([roc_auc_score(labels, config_scores) for config_scores in scores])
+
+        positives, negatives = self._histograms()
+        # negatives strictly below each bin, plus half of the ties within the bin
+        negatives_below = torch.cumsum(negatives, dim=1) - negatives
+        correct = (positives * (negatives_below + 0.5 * negatives)).sum(1)
+        total = positives.sum(1) * negatives.sum(1)
+        return (correct / total).cpu().numpy()
+
+    def error_bound(self):
+        """
+        Return, for each configuration, the maximum difference between auc() and the exact AUC
+        """
+        if self.exact:
+            return np.zeros(self.num_configs)
+
+        positives, negatives = self._histograms()
+        ties = (positives * negatives).sum(1)
+        total = positives.sum(1) * negatives.sum(1)
+        return (0.5 * ties / total).cpu().numpy()
@@ -0,0 +1,54 @@
+# coding=utf-8
+import math
+
+import numpy as np
+
+
+def stratified_subsample(labels, fraction, seed=0):
+    """
+    Return the sorted indices of a subsample of fraction of the windows of each class
+    The subsamples of increasing fractions drawn with the same seed are nested
+    """
+    labels = np.asarray(labels)
+    rng = np.random.RandomState(seed)
+    indices = []
+    for label in np.unique(labels):
+        class_indices = np.where(labels == label)[0]
+        class_indices = class_indices[rng.permutation(len(class_indices))]
+        num_samples = max(1, int(math.ceil(fraction * len(class_indices))))
+        indices.append(class_indices[:num_samples])
+    return np.sort(np.concatenate(indices))
+
+
+def successive_halving(channel_ids, score_fn, labels, top_n=10, eta=3, min_fraction=0.05, seed=0):
+    """
+    Successive halving over the channel configurations.
+    All configurations are scored on a stratified subsample of min_fraction of the windows, only the best
+    1/eta are kept and scored again on eta times more windows, until top_n configurations are left
+    or the whole split is used.
+    Args:
+    - channel_ids: the configurations to search
+    - score_fn: score_fn(channel_ids, window_indices) returns the AUC of every configuration
+      on these windows, higher is better
+    - labels: the labels of all the windows, used to stratify the subsamples
+    Returns the surviving channel_ids (at most top_n), best first
+    """
+    survivors = list(channel_ids)
+    fraction = min_fraction
+    round_idx = 0
+    while True:
+        indices = stratified_subsample(labels, min(1., fraction), seed=seed)
+        scores = np.asarray(score_fn(survivors, indices))
+        order = np.argsort(-scores, kind='stable')
+        print("Successive halving round {}: {} configurations on {} windows, best AUC {:.4f}".format(
+            round_idx, len(survivors), len(indices), scores[order[0]]))
+
+        if fraction >= 1. or len(survivors) <= top_n:
+            return [survivors[i] for i in order[:top_n]]
+
+        num_keep = max(top_n, int(math.ceil(len(survivors) / eta)))
+        survivors = [survivors[i] for i in order[:num_keep]]
+        if len(survivors) <= top_n:
+            return survivors
+        fraction *= eta
+        round_idx += 1
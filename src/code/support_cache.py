@@ -0,0 +1,142 @@
+# coding=utf-8
+import fcntl
+import hashlib
+import os
+import pickle
+
+import numpy as np
+import torch
+
+from stft_shards import read_shard, shard_indices
+
+_SUPPORT_SETS = {}
+
+
+def load_support_set(save_directory, class_support_sets, manifest=None, shard_dir=None):
+    """
+    Load the STFT of the support set windows, once per process.
+    Args:
+    - save_directory: the preprocess directory containing task-binary_datatype-train_STFT
+    - class_support_sets: one list of window names per class, the label is the index of the list
+    - manifest: if given, the windows are looked up in the train split of this manifest.Manifest
+    - shard_dir: if it holds a shard containing the windows (see stft_shards), they are read from it instead
+      of the pickles, which the windows written by tuh_dataset.make_STFT_from_edf do not have
+    Returns the signals and the labels as read-only numpy arrays
+    """
+    key = (save_directory, tuple(tuple(class_support_set) for class_support_set in class_support_sets))
+    if key not in _SUPPORT_SETS:
+        shard = read_shard(shard_dir) if shard_dir is not None and os.path.isdir(shard_dir) else None
+        support_set = []
+        labels = []
+        for label, class_support_set in enumerate(class_support_sets):
+            if manifest is not None:
+                filepaths = manifest.find(class_support_set, split='train')
+            else:
+                filepaths = [os.path.join(save_directory, "task-binary_datatype-train_STFT/", filename + ".pkl")
+                             for filename in class_support_set]
+            indices = shard_indices(shard, filepaths) if shard is not None else None
+            if indices is not None:
+                support_set.extend(shard['signals'][torch.from_numpy(indices)].float().numpy())
+                labels.extend([label] * len(indices))
+                continue
+            for filepath in filepaths:
+                with open(filepath, 'rb') as f:
+                    data_pkl = pickle.load(f)
+                    support_set.append(np.asarray(data_pkl['STFT']))
+                    labels.append(label)
+        support_set = np.array(support_set)
+        labels = np.array(labels)
+        support_set.setflags(write=False)
+        labels.setflags(write=False)
+        _SUPPORT_SETS[key] = (support_set, labels)
+
+    return _SUPPORT_SETS[key]
+
+
+def state_dict_hash(model):
+    """
+    Hash of the weights of a model, used to recognize a checkpoint
+    """
+    sha = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha.hexdigest()
+
+
+def names_hash(class_support_sets):
+    sha = hashlib.sha1()
+    for class_support_set in class_support_sets:
+        sha.update('\n'.join(class_support_set).encode())
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+class PrototypeCache(object):
+    """
+    PrototypeCache: persist the prototypes computed by FETCH.test.
+    The prototypes depend on the model weights, the support set and the channel configuration,
+    so a cache file is kept per (model checkpoint hash, support set list, forward mode) and
+    holds the prototypes of every channel_id evaluated with them.
+    """
+
+    def __init__(self, cache_dir, model, class_support_sets, forward_mode='default', save_every=100):
+        """
+        Args:
+        - cache_dir: directory of the cache files
+        - model: the model computing the support set embeddings
+        - class_support_sets: one list of window names per class
+        - forward_mode: how the absent channels are handled (opt.sweep_mode), it changes the prototypes
+        - save_every: number of new prototypes after which the cache file is rewritten
+        """
+        self.save_every = save_every
+        self.num_unsaved = 0
+        key = '{}_{}_{}'.format(state_dict_hash(model)[:16], names_hash(class_support_sets)[:16], forward_mode)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, 'prototypes_{}.pkl'.format(key))
+
+        self.prototypes = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                self.prototypes = pickle.load(f)
+
+    def __len__(self):
+        return len(self.prototypes)
+
+    def get(self, channel_id, device):
+        """
+        Return the prototypes of the configuration, None if they were never computed
+        """
+        channel_id = int(channel_id)
+        if channel_id not in self.prototypes:
+            return None
+        return torch.from_numpy(self.prototypes[channel_id]).to(device)
+
+    def put(self, channel_id, prototypes):
+        self.prototypes[int(channel_id)] = prototypes.detach().cpu().numpy()
+        self.num_unsaved += 1
+        if self.num_unsaved >= self.save_every:
+            self.save()
+
+    def save(self):
+        if self.num_unsaved == 0:
+            return
+        # other processes (e.g. the sweep workers) may save their prototypes at the same time: the read, merge
+        # and write are done under an exclusive lock, so none of them overwrites the prototypes of another
+        with open(self.path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(self.path):
+                    with open(self.path, 'rb') as f:
+                        prototypes = pickle.load(f)
+                    prototypes.update(self.prototypes)
+                    self.prototypes = prototypes
+
+                # write to a temporary file first so that a crash never leaves a truncated cache
+                tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+                with open(tmp_path, 'wb') as f:
+                    pickle.dump(self.prototypes, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, self.path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        self.num_unsaved = 0
@@ -0,0 +1,86 @@
+# coding=utf-8
+import os
+import queue
+import time
+
+import torch
+import torch.multiprocessing as mp
+from tqdm import tqdm
+
+
+def default_threads_per_worker(num_workers):
+    return max(1, (os.cpu_count() or 1) // num_workers)
+
+
+def _worker_main(worker_fn, items, threads_per_worker, progress_queue, worker_args):
+    # each worker gets its share of the cores, otherwise every intra-op pool would use all of them
+    torch.set_num_threads(threads_per_worker)
+    try:
+        worker_fn(items, lambda num=1: progress_queue.put(num), *worker_args)
+    finally:
+        progress_queue.put(None)
+
+
+def run_sharded(worker_fn, items, num_workers, worker_args=(), threads_per_worker=0, desc='Configurations'):
+    """
+    Split items (e.g. the channel_ids of the sweep) round-robin across num_workers processes.
+    Every process calls worker_fn(shard, report_progress, *worker_args), where report_progress()
+    must be called once per finished item. Tensors in worker_args are passed as shared memory handles,
+    so large tensors should be moved to shared memory (tensor.share_memory_()) beforehand.
+    Args:
+    - worker_fn: a module level function
+    - threads_per_worker: intra-op threads of each worker, 0 to split the cores evenly
+    Returns the number of items per second
+    """
+    shards = [items[worker_id::num_workers] for worker_id in range(num_workers)]
+    shards = [shard for shard in shards if len(shard) > 0]
+    if threads_per_worker <= 0:
+        threads_per_worker = default_threads_per_worker(len(shards))
+    print("Workers: {}, threads per worker: {}".format(len(shards), threads_per_worker))
+
+    context = mp.get_context('spawn')
+    progress_queue = context.Queue()
+    processes = [context.Process(target=_worker_main,
+                                 args=(worker_fn, shard, threads_per_worker, progress_queue, worker_args))
+                 for shard in shards]
+
+    # the OpenMP pool of a worker is sized from the environment when it starts
+    omp_num_threads = os.environ.get('OMP_NUM_THREADS')
+    os.environ['OMP_NUM_THREADS'] = str(threads_per_worker)
+    start_time = time.time()
+    for process in processes:
+        process.start()
+    if omp_num_threads is None:
+        del os.environ['OMP_NUM_THREADS']
+    else:
+        os.environ['OMP_NUM_THREADS'] = omp_num_threads
+
+    num_running = len(processes)
+    num_done = 0
+    with tqdm(total=len(items), desc=desc, unit='config') as progress:
+        while num_running > 0:
+            try:
+                num = progress_queue.get(timeout=10)
+            except queue.Empty:
+                # a worker killed without reaching its finally block never reports
+                if not any(process.is_alive() for process in processes):
+                    break
+                continue
+            if num is None:
+                num_running -= 1
+            else:
+                num_done += num
+                progress.update(num)
+
+    for process in processes:
+        process.join()
+
+    elapsed = time.time() - start_time
+    items_per_sec = num_done / elapsed if elapsed > 0 else 0.
+    print("{} configurations in {:.1f}s: {:.2f} configurations/sec".format(num_done, elapsed, items_per_sec))
+
+    failed = [process.exitcode for process in processes if process.exitcode != 0]
+    if failed:
+        raise RuntimeError("{} sweep workers failed, exit codes {}".format(len(failed), failed))
+
+    return items_per_sec
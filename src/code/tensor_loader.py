@@ -0,0 +1,205 @@
+# coding=utf-8
+import math
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+from batch_transforms import TransformedLoader
+from shared_signals import SharedSignals
+
+
+class InMemoryLoader(object):
+    """
+    InMemoryLoader: DataLoader replacement for a TUHDataset holding its signals in memory
+    (TUHDataset(None, signals=..., labels=...)).
+    Every batch is gathered from the resident tensor with one index tensor, instead of one __getitem__ per
+    window in worker processes followed by a collate and a transfer back to the main process.
+    The batches are the same as the ones of DataLoader(dataset, ...) with the same arguments:
+    - batch_size, shuffle, drop_last: as for DataLoader
+    - sampler: iterable of window indices, e.g. a subset of the windows or a RepeatedIndexSampler
+    - batch_sampler: iterable of index batches, e.g. a PrototypicalBatchSampler
+    - pin_memory: gather the windows into two alternating page-locked buffers, so the copy to the GPU
+      can be asynchronous (only useful when the batches go to a CUDA device, see tuh_dataset.make_loader).
+      A batch is then only valid until the next one is requested, reuses_buffers is True.
+    """
+
+    def __init__(self, dataset, batch_size=1, shuffle=False, sampler=None, batch_sampler=None, drop_last=False,
+                 pin_memory=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.sampler = sampler
+        self.batch_sampler = batch_sampler
+        self.drop_last = drop_last
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.num_workers = 0
+        self.labels = torch.from_numpy(np.asarray(dataset.labels))
+        self.reuses_buffers = self.pin_memory
+        self._buffers = None
+
+    def _num_windows(self):
+        return len(self.sampler) if self.sampler is not None else len(self.dataset)
+
+    def __len__(self):
+        if self.batch_sampler is not None:
+            return len(self.batch_sampler)
+        if self.drop_last:
+            return self._num_windows() // self.batch_size
+        return int(math.ceil(self._num_windows() / self.batch_size))
+
+    def index_batches(self):
+        if self.batch_sampler is not None:
+            for batch in self.batch_sampler:
+                yield torch.as_tensor(batch, dtype=torch.long)
+            return
+
+        if self.sampler is not None:
+            indices = torch.as_tensor(list(self.sampler), dtype=torch.long)
+        elif self.shuffle:
+            indices = torch.randperm(len(self.dataset))
+        else:
+            indices = torch.arange(len(self.dataset))
+        for batch in torch.split(indices, self.batch_size):
+            if self.drop_last and len(batch) < self.batch_size:
+                return
+            yield batch
+
+    def _gather(self, indices, buffer_idx):
+        signals = self.dataset.signals
+        if isinstance(signals, SharedSignals):
+            signals = signals.tensor
+        if not self.pin_memory:
+            return signals[indices].float()
+
+        if self._buffers is None or self._buffers[0].shape[0] < len(indices):
+            self._buffers = [torch.empty((len(indices),) + signals.shape[1:], dtype=torch.float).pin_memory()
+                             for _ in range(2)]
+        out = self._buffers[buffer_idx][:len(indices)]
+        if signals.dtype == torch.float:
+            return torch.index_select(signals, 0, indices, out=out)
+        return out.copy_(signals[indices])
+
+    def __iter__(self):
+        for batch_idx, indices in enumerate(self.index_batches()):
+            x = self._gather(indices, batch_idx % 2)
+            if not self.dataset.batch_masking:  # the masking TUHDataset.__getitem__ does per window
+                x = self.dataset.channel_masking(x)
+            yield x, self.labels[indices]
+
+
+class Prefetcher(object):
+    """
+    Prefetcher: iterate over any loader of (x, y) batches from a background thread, keeping the signals x
+    of the next `depth` batches ready on device. On CUDA the batches are pinned and copied on a side stream, so preparing and
+    transferring a batch overlaps with the computation on the previous one.
+    transform (e.g. a batch_transforms.ChannelMasking) is applied to the signals once on device, on the same stream
+    as the copy. The transform of a TransformedLoader without a device (as returned by tuh_dataset.get_dataloader)
+    is taken over, so its batches are copied before being masked instead of being masked on the CPU.
+    The batches handed to the loop never share memory with the buffers of the loader: on CUDA the pinned buffer
+    is released once its copy is done, otherwise the batches of a loader reusing its buffers are cloned.
+    The time spent waiting for each batch is appended to wait_times (seconds, one entry per step).
+    The other attributes (dataset, batch_size, ...) are the ones of the loader.
+    """
+
+    def __init__(self, loader, device, depth=2, transform=None):
+        if transform is None and isinstance(loader, TransformedLoader) and loader.device is None:
+            loader, transform = loader.dataloader, loader.transform
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.transform = transform
+        self.wait_times = []
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        if name == 'loader':
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def _to_device(self, batch, stream):
+        # only the signals, the labels stay where the loop expects them
+        x, y = batch
+        if stream is None:
+            x_device = x.to(self.device)
+            if x_device is x and getattr(self.loader, 'reuses_buffers', False):
+                # the loader would overwrite it while the loop still reads it
+                x_device = x.clone()
+            if self.transform is not None:
+                x_device = self.transform(x_device)
+            return (x_device, y), None
+        with torch.cuda.stream(stream):
+            if x.device.type == 'cpu':
+                x = x.pin_memory().to(self.device, non_blocking=True)
+            if self.transform is not None:
+                x = self.transform(x)
+            event = torch.cuda.Event()
+            event.record(stream)
+        # the source may be a reused pinned buffer (InMemoryLoader), wait for the copy before the next batch
+        event.synchronize()
+        return (x, y), event
+
+    @staticmethod
+    def _put(batches, stop, item):
+        # gives up when the consumer stopped iterating
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, batches, stop):
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        try:
+            for batch in self.loader:
+                if not self._put(batches, stop, self._to_device(batch, stream)):
+                    return
+            self._put(batches, stop, None)
+        except BaseException as error:
+            self._put(batches, stop, error)
+
+    def __iter__(self):
+        if self.depth <= 0:
+            for batch in self.loader:
+                yield self._to_device(batch, None)[0]
+            return
+
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batches, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start_time = time.time()
+                item = batches.get()
+                self.wait_times.append(time.time() - start_time)
+                if item is None:
+                    self.wait_times.pop()
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                batch, event = item
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    # allocated on the side stream, not to be reused before the loop is done with it
+                    batch[0].record_stream(current_stream)
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+    def data_wait(self, reset=True):
+        """
+        Return the total time waited for data since the last reset, and the number of steps
+        """
+        total_wait, num_steps = sum(self.wait_times), len(self.wait_times)
+        if reset:
+            self.wait_times = []
+        return total_wait, num_steps
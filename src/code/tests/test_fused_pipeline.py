@@ -0,0 +1,59 @@
+# coding=utf-8
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+import torch
+
+CODE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(CODE_DIR)
+
+from stft_shards import STFT_SHAPE, ShardWriter, read_shard  # noqa: E402
+
+FETCH = pytest.importorskip('TSD.code.FETCH')
+
+
+def write_fused_output(save_dir, data_type, num_recordings=3, num_windows=8):
+    """
+    The output of make_STFT_from_edf without --keep_raw_windows: a shard and no window pickle
+    """
+    names = ['patient{}_s001_t000_label_{}_index_{}.pkl'.format(recording, 'seiz' if i % 4 == 0 else 'bckg', i)
+             for recording in range(num_recordings) for i in range(num_windows)]
+    writer = ShardWriter(names, os.path.join(save_dir, 'task-binary_datatype-{}_STFT_shard'.format(data_type)))
+    writer.write(np.arange(len(names)), np.random.randn(len(names), *STFT_SHAPE).astype(np.float32))
+    writer.close()
+
+
+def test_default_init_dataloader_on_fused_output(tmp_path, monkeypatch):
+    save_dir = str(tmp_path / 'preprocess')
+    for data_type in ['train', 'dev', 'eval']:
+        write_fused_output(save_dir, data_type)
+    assert not os.path.exists(os.path.join(save_dir, 'task-binary_datatype-train_STFT'))
+
+    # the datasets read the feasible configurations relative to the working directory
+    os.makedirs(str(tmp_path / 'feasible_channels'))
+    with open(str(tmp_path / 'feasible_channels' / 'feasible_20edges.json'), 'w') as f:
+        json.dump([list(range(8))], f)
+    os.makedirs(str(tmp_path / 'code'))
+    monkeypatch.chdir(str(tmp_path / 'code'))
+
+    opt = FETCH.get_parser().parse_args([])
+    opt.save_directory = save_dir
+    opt.classes_per_it_tr, opt.num_query_tr, opt.iterations = 2, 2, 2
+    assert not opt.server
+    tr_dataloader, val_dataloader, test_dataloader = FETCH.init_dataloader(opt, full_validation=True)
+
+    # the sampler draws new windows on every pass, so each window of a batch is looked up in the shard
+    shard = read_shard(os.path.join(save_dir, 'task-binary_datatype-train_STFT_shard'))
+    signals = shard['signals'].flatten(1)
+    num_batches = 0
+    for x, y in tr_dataloader:
+        assert x.shape[1:] == STFT_SHAPE
+        matches = (x.flatten(1)[:, None] == signals[None]).all(-1)
+        assert (matches.sum(1) == 1).all()
+        assert np.array_equal(np.asarray(y), shard['labels'][matches.int().argmax(1).numpy()])
+        num_batches += 1
+    assert num_batches == opt.iterations
+    assert len(val_dataloader.dataset) == len(test_dataloader.dataset) == 24
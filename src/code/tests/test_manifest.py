@@ -0,0 +1,33 @@
+# coding=utf-8
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from manifest import Manifest  # noqa: E402
+from stft_shards import STFT_SHAPE, ShardWriter  # noqa: E402
+
+
+def write_shard(shard_dir, names):
+    writer = ShardWriter(names, shard_dir)
+    writer.write(np.arange(len(names)), np.zeros((len(names),) + STFT_SHAPE, dtype=np.float32))
+    writer.close()
+
+
+def test_refresh_with_missing_splits(tmp_path):
+    directories = {split: str(tmp_path / 'task-binary_datatype-{}_STFT'.format(split)) for split in ['train', 'dev']}
+    shards = {split: directory + '_shard' for split, directory in directories.items()}
+    write_shard(shards['train'], ['aaa_s001_t000_label_bckg_index_0.pkl', 'aaa_s001_t000_label_seiz_index_1.pkl'])
+
+    manifest = Manifest(str(tmp_path / 'manifest.sqlite')).refresh(directories, shards=shards)
+    assert len(manifest.paths(split='train')) == 2
+    assert manifest.paths(split='dev') == []
+
+    # the split written later is picked up by the next refresh
+    os.makedirs(directories['dev'])
+    open(os.path.join(directories['dev'], 'bbb_s001_t000_label_bckg_index_0.pkl'), 'wb').close()
+    manifest.refresh(directories, shards=shards)
+    assert manifest.paths(split='dev') == [os.path.join(directories['dev'], 'bbb_s001_t000_label_bckg_index_0.pkl')]
+    manifest.close()
@@ -0,0 +1,46 @@
+# coding=utf-8
+import os
+import sys
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from batch_transforms import ChannelMasking, TransformedLoader  # noqa: E402
+from tensor_loader import Prefetcher  # noqa: E402
+
+
+class RecordingMasking(ChannelMasking):
+    """
+    ChannelMasking recording the device of the batches it masks
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingMasking, self).__init__(*args, **kwargs)
+        self.devices = []
+
+    def __call__(self, x):
+        self.devices.append(x.device.type)
+        return super(RecordingMasking, self).__call__(x)
+
+
+def batches(num_batches=3, batch_size=4):
+    generator = torch.Generator().manual_seed(0)
+    return [(torch.randn(batch_size, 20, 160, 15, generator=generator), torch.arange(batch_size))
+            for _ in range(num_batches)]
+
+
+def test_prefetcher_masks_after_the_copy():
+    masking = RecordingMasking(selected_channels=[0, 3, 5])
+    prefetcher = Prefetcher(TransformedLoader(batches(), masking), 'meta', depth=2)
+    outputs = list(prefetcher)
+    assert len(outputs) == 3
+    assert all(x.device.type == 'meta' and x.shape == (4, 1, 3200, 15) for x, _ in outputs)
+    assert masking.devices == ['meta'] * 3
+
+
+def test_prefetched_batches_match_the_transformed_loader():
+    loader = TransformedLoader(batches(), ChannelMasking(selected_channels=[1, 2, 19]))
+    for depth in [0, 2]:
+        for (x, y), (x_prefetched, y_prefetched) in zip(loader, Prefetcher(loader, 'cpu', depth=depth)):
+            assert torch.equal(x, x_prefetched) and torch.equal(y, y_prefetched)
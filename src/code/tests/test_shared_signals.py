@@ -0,0 +1,27 @@
+# coding=utf-8
+import os
+import pickle
+import subprocess
+import sys
+
+import torch
+
+CODE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(CODE_DIR)
+
+from shared_signals import SharedSignals  # noqa: E402
+
+
+def test_from_tensor_leaves_no_file(tmp_path):
+    signals = torch.randn(6, 20, 160, 15).to(torch.bfloat16)
+    shared_signals = SharedSignals.from_tensor(signals, directory=str(tmp_path))
+    # unlinked once written, nothing is left behind if the run is killed
+    assert os.listdir(str(tmp_path)) == []
+    assert torch.equal(shared_signals[:], signals)
+
+    # another process maps the same file from the pickled path
+    child = pickle.loads(pickle.dumps(shared_signals))
+    script = "import pickle, sys; sys.path.append({!r}); print(float(pickle.loads({!r})[:].float().sum()))".format(
+        CODE_DIR, pickle.dumps(child))
+    output = subprocess.check_output([sys.executable, '-c', script])
+    assert abs(float(output) - float(signals.float().sum())) < 1e-3
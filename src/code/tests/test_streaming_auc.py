@@ -0,0 +1,89 @@
+# coding=utf-8
+import os
+import sys
+
+import numpy as np
+import pytest
+import torch
+from sklearn.metrics import roc_auc_score
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streaming_metrics import StreamingAUC, num_bins_for_tolerance  # noqa: E402
+
+multi_config = pytest.importorskip('TSD.code.multi_config')
+prototypical_loss = pytest.importorskip('TSD.few_shot.prototypical_loss')
+
+TOLERANCE = 1e-3
+
+
+def saturated_outputs(num_configs=3, num_windows=4000, dim=64, seed=0):
+    """
+    Prototypes and query embeddings far from each other, as the trained models give them: the probabilities
+    of most windows are exactly 0 or 1 in float32, while the classes still overlap (AUCs of 0.75 to 0.87)
+    """
+    generator = torch.Generator().manual_seed(seed)
+    labels = (torch.rand(num_windows, generator=generator) < 0.2).long()
+    prototypes = 3 * torch.randn(num_configs, 2, dim, generator=generator)
+    noise = torch.linspace(20., 35., num_configs)[:, None, None]
+    outputs = prototypes[:, labels] + noise * torch.randn(num_configs, num_windows, dim, generator=generator)
+    return prototypes, outputs, labels
+
+
+def test_saturated_scores_within_tolerance():
+    prototypes, outputs, labels = saturated_outputs()
+    prob, _ = prototypical_loss.batched_prototypical_evaluation(prototypes, outputs)
+    assert ((prob == 0) | (prob == 1)).float().mean() > 0.9
+
+    accumulator = StreamingAUC(prototypes.shape[0], num_bins=num_bins_for_tolerance(TOLERANCE))
+    log_odds = prototypical_loss.batched_prototypical_log_odds(prototypes, outputs)
+    for start_idx in range(0, labels.shape[0], 256):
+        accumulator.update(log_odds[:, start_idx:start_idx + 256], labels[start_idx:start_idx + 256])
+
+    exact = np.array([roc_auc_score(labels.numpy(), scores) for scores in log_odds.numpy()])
+    bounds = accumulator.error_bound()
+    assert (bounds < TOLERANCE).all()
+    assert (np.abs(accumulator.auc() - exact) <= bounds + 1e-12).all()
+
+
+def test_range_extension_keeps_counts():
+    # the first batch covers a small part of the scores, the range is doubled for the later ones
+    scores = torch.cat([torch.linspace(-1, 1, 64), torch.linspace(-500, 500, 4000)])[None]
+    labels = torch.arange(scores.shape[1]) % 3 == 0
+    accumulator = StreamingAUC(1, num_bins=1024)
+    for start_idx in range(0, scores.shape[1], 64):
+        accumulator.update(scores[:, start_idx:start_idx + 64], labels[start_idx:start_idx + 64])
+    assert accumulator.positives.sum() == labels.sum() and accumulator.negatives.sum() == (~labels).sum()
+    exact = roc_auc_score(labels.numpy(), scores[0].numpy())
+    assert abs(accumulator.auc()[0] - exact) <= accumulator.error_bound()[0] + 1e-12
+
+
+class Embedding(torch.nn.Module):
+    """
+    A model whose outputs are far apart, giving saturated prototypical probabilities
+    """
+
+    def __init__(self):
+        super(Embedding, self).__init__()
+        self.linear = torch.nn.Linear(3200 * 15, 16)
+
+    def forward(self, x):
+        return 50 * self.linear(x.flatten(1))
+
+
+def test_evaluate_config_block_without_fallback(capsys):
+    torch.manual_seed(0)
+    model = Embedding()
+    y = (torch.arange(600) % 4 == 0).long()
+    x = torch.randn(600, 20, 160, 15) + y[:, None, None, None].float()
+    dataloader = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(x[100:], y[100:]), batch_size=64)
+    masks = np.zeros((3, 20), dtype=bool)
+    masks[1, :10] = masks[2, 10:] = True
+
+    error_bounds = []
+    aucs = multi_config.evaluate_config_block(model, dataloader, x[:100], y[:100], masks, 'cpu',
+                                              auc_tolerance=TOLERANCE, error_bounds=error_bounds)
+    assert 'evaluated exactly' not in capsys.readouterr().out
+    assert max(error_bounds) < TOLERANCE
+    exact_aucs = multi_config.evaluate_config_block(model, dataloader, x[:100], y[:100], masks, 'cpu')
+    assert np.allclose(aucs, exact_aucs, atol=TOLERANCE)
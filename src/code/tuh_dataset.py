@@ -1,21 +1,40 @@
 import json
+from functools import lru_cache
 import os
 import pickle
+import shutil
 from multiprocessing import Pool
 import numpy as np
 import pandas as pd
 import pyedflib
-from scipy.signal import stft, resample
-from scipy.signal import filtfilt, butter
-from torch.utils.data import DataLoader, Dataset
+from scipy.signal import stft
+from scipy.signal import sosfiltfilt, butter
+from torch.utils.data import DataLoader, Dataset, Sampler
 from torchvision.transforms import transforms
 from tqdm import tqdm
 import torch
 from parser_util import get_parser
+from batch_transforms import ChannelMasking, TransformedLoader
+from bulk_loader import read_pickles
+from resampling import resample_channels, resample_chunk, resample_factors
+from recording_store import RecordingStore, write_recording_store
+from shared_signals import SharedSignals
+from tensor_loader import InMemoryLoader
+from manifest import Manifest, group_by_recording
+from edf_stream import read_edf_chunks, stream_windows
+from preprocess_ledger import PreprocessLedger, atomic_pickle_dump, params_hash, remove_partial_files
+from stft_shards import ShardWindows, ShardWriter, write_shard, read_shard, shard_indices, parse_window_filename, \
+    same_layout, to_storage, STORAGE_DTYPES
 
 torch.random.manual_seed(42)  # optional: for reproducibility
 
 GLOBAL_INFO = {}
+SPLIT_DATA_TYPES = {'train': 'train', 'val': 'dev', 'test': 'eval'}
+MANIFESTS = {}
+LEDGERS = {}
+# band-pass filter of the recordings and STFT of the windows, see bandpass_sos and STFT_features
+BANDPASS = {'lowcut': 0.1, 'highcut': 80, 'order': 4}
+STFT_PARAMS = {'nperseg': 256, 'noverlap': 64, 'sampling_rate': 256, 'freq_resolution': 2, 'cutoff_freq': 80}
 
 # channels_groups = [
 #     [0, 1, 2, 3, 4, 5, 6, 7],
@@ -30,8 +49,14 @@ GLOBAL_INFO = {}
 #     [0, 3, 4, 6, 7, 9, 17, 19], # RANDOM
 # ]
 
-TUSZv2_info_df = pd.read_json('../../input/TUSZv2_info.json')
-args = get_parser().parse_args()
+# the flags of the calling script (e.g. FETCH.py) set the defaults below, other modules can import this one
+args = get_parser().parse_known_args()[0]
+
+
+@lru_cache(maxsize=None)
+def get_TUSZv2_info():
+    # read on the first use, the module is imported without the dataset by the benchmark
+    return pd.read_json('../../input/TUSZv2_info.json')
 
 
 def search_walk(info):
@@ -65,9 +90,15 @@ def spectrogram_unfold_feature(signals):
 
 
 class TUHDataset(Dataset):
+    """
+    With batch_masking, the windows are returned as they are stored and the masking or channel removal
+    is left to self.channel_masking, applied to the collated batches (see get_dataloader)
+    """
     def __init__(self, file_list, signals=None, labels= None, transform=None,
-                 selected_channel_id=-1, masking=True, remove_not_used=False):
+                 selected_channel_id=-1, masking=True, remove_not_used=False, batch_masking=False):
         self.file_list = file_list
+        # the windows are read from the shard of their directory when it holds them, see get_window_shard
+        self.shard_windows = get_window_shard(file_list) if file_list is not None else None
         self.signals = signals
         self.labels = labels
         self.file_length = len(self.file_list) if not self.file_list is None else self.signals.shape[0]
@@ -82,6 +113,9 @@ class TUHDataset(Dataset):
             self.selected_channels = self.all_feasible_channel_combination[selected_channel_id]
 
         print("Selected channels: ", self.selected_channels)
+        self.batch_masking = batch_masking
+        self.channel_masking = ChannelMasking(self.selected_channels, masking=masking,
+                                              remove_not_used=remove_not_used)
 
     def __len__(self):
         return self.file_length
@@ -90,8 +124,14 @@ class TUHDataset(Dataset):
         if self.file_list is None:
             if self.signals is None:
                 raise ValueError("Both file list and signals are None!")
-            signals = self.signals[idx].clone()
+            if self.batch_masking:  # not modified in place, no copy needed
+                signals = self.signals[idx].float()
+            else:
+                signals = self.signals[idx].to(torch.float, copy=True)  # upcast the 16-bit storage
             label = self.labels[idx].copy()
+        elif self.shard_windows is not None:
+            signals, label = self.shard_windows[idx]
+            signals = torch.from_numpy(signals)
         else:
             with open(self.file_list[idx], 'rb') as f:
                 data_pkl = pickle.load(f)
@@ -99,6 +139,9 @@ class TUHDataset(Dataset):
                 label = data_pkl['label']
                 label = 0. if label == "bckg" else 1.
 
+        if self.batch_masking:  # masked with the rest of the batch
+            return signals, label
+
         if self.remove_not_used_channels:
             present_channels = self.selected_channels
             signals = signals[present_channels]
@@ -134,6 +177,7 @@ class TUHDatasetValidation(Dataset):
         self.file_list = file_list
         self.file_length = len(self.file_list)
         self.transform = transform
+        self.shard_windows = get_window_shard(file_list)
         with open('../../TUSZv2/validation_file_mask8_dict.pkl', 'rb') as f:
             self.file_mask_dict = pickle.load(f)
 
@@ -141,33 +185,48 @@ class TUHDatasetValidation(Dataset):
         return self.file_length
 
     def __getitem__(self, idx):
-        with open(self.file_list[idx], 'rb') as f:
-            data_pkl = pickle.load(f)
+        if self.shard_windows is not None:
+            signals, label = self.shard_windows[idx]
+        else:
+            with open(self.file_list[idx], 'rb') as f:
+                data_pkl = pickle.load(f)
             signals = np.asarray(data_pkl['STFT'])
+            label = 0. if data_pkl['label'] == "bckg" else 1.
 
-            filename = self.file_list[idx].split('/')[-1]
-            MASK = self.file_mask_dict[filename]
-
-            signals[MASK] = -1  # Set all elements corresponding to True in MASK to -1
+        filename = self.file_list[idx].split('/')[-1]
+        MASK = self.file_mask_dict[filename]
 
-            signals = np.reshape(signals, (-1, signals.shape[2]))
-            signals = self.transform(signals)
+        signals[MASK] = -1  # Set all elements corresponding to True in MASK to -1
 
-            label = data_pkl['label']
-            label = 0. if label == "bckg" else 1.
+        signals = np.reshape(signals, (-1, signals.shape[2]))
+        signals = self.transform(signals)
         return signals, label
 
 
 class TUHDatasetEvent(Dataset):
-    def __init__(self, recording_list, transform=None):
+    """
+    With a RecordingStore holding these recordings, the precomputed features of a recording are returned as
+    a view of the store (every window_stride-th window) instead of being recomputed from the pickles
+    """
+    def __init__(self, recording_list, transform=None, store=None, window_stride=1):
         self.recording_list = recording_list
         self.transform = transform
+        self.store = store
+        self.window_stride = window_stride
+        self.store_index = None
+        if store is not None:
+            self.store_index = store.recording_index([parse_window_filename(filenames[0])[0]
+                                                      for filenames in recording_list],
+                                                     num_windows=[len(filenames) for filenames in recording_list])
 
     def __len__(self):
         return len(self.recording_list)
 
     def __getitem__(self, idx):
-        filenames = self.recording_list[idx]
+        if self.store_index is not None:
+            return self.store.recording(self.store_index[idx], stride=self.window_stride)
+
+        filenames = self.recording_list[idx][::self.window_stride]
         recording_signals = []
         recording_labels = []
         for filename in filenames:
@@ -190,54 +249,82 @@ class TUHDatasetEvent(Dataset):
         return np.vstack(recording_signals), np.vstack(recording_labels)
 
 
+def get_manifest(save_dir=args.save_directory):
+    """
+    Return the manifest of the STFT windows of save_dir (opened once per process), refreshed with
+    the files added or removed since the last call, including the windows only stored in a shard
+    """
+    if save_dir not in MANIFESTS:
+        MANIFESTS[save_dir] = Manifest(os.path.join(save_dir, 'manifest.sqlite'))
+    file_dir = {split: os.path.join(save_dir, 'task-binary_datatype-{}_STFT'.format(data_type))
+                for split, data_type in SPLIT_DATA_TYPES.items()}
+    shard_dir = {split: get_shard_directory(save_dir, split) for split in SPLIT_DATA_TYPES.keys()}
+    return MANIFESTS[save_dir].refresh(file_dir, shards=shard_dir)
+
+
 def separate_and_sort_filenames(filenames):
-    parts_dict = {}
-    for filename in filenames:
-        key = filename.split('_label')[0]
-        index = int(filename.split('index_')[-1].split('.pkl')[0])
-        if key not in parts_dict:
-            parts_dict[key] = []
-        parts_dict[key].append((filename, index))
+    # one list per recording, sorted by window index
+    return group_by_recording(filenames)
 
-    sorted_lists = []
-    for key, value in parts_dict.items():
-        sorted_values = sorted(value, key=lambda x: x[1])
-        sorted_list = [filename for filename, index in sorted_values]
-        sorted_lists.append(sorted_list)
 
-    return sorted_lists
+def get_file_lists(save_dir=args.save_directory):
+    return get_manifest(save_dir).file_lists(SPLIT_DATA_TYPES.keys())
 
 
-def get_data(save_dir=args.save_directory, balanced_data=True, return_val_test_signal=False,
-             return_train_signal= False):
-    # Specify the output filename
-    file_lists_filename = os.path.join(args.save_directory, "./file_lists.pkl")
-    if not os.path.exists(file_lists_filename):
-        file_dir = {'train': os.path.join(save_dir, 'task-binary_datatype-train_STFT'),
-                    'val': os.path.join(save_dir, 'task-binary_datatype-dev_STFT'),
-                    'test': os.path.join(save_dir, 'task-binary_datatype-eval_STFT')}
-        file_lists = {'train': {'bckg': [], 'seiz': []}, 'val': {'bckg': [], 'seiz': []},
-                      'test': {'bckg': [], 'seiz': []}}
-
-        for dirname in file_dir.keys():
-            filenames = os.listdir(file_dir[dirname])
-            for filename in filenames:
-                if 'bckg' in filename:
-                    file_lists[dirname]['bckg'].append(os.path.join(file_dir[dirname], filename))
-                elif 'seiz' in filename:
-                    file_lists[dirname]['seiz'].append(os.path.join(file_dir[dirname], filename))
-                else:
-                    print('------------------------  error  ------------------------')
-                    exit(-1)
+def get_shard_directory(save_dir, split):
+    return os.path.join(save_dir, 'task-binary_datatype-{}_STFT_shard'.format(SPLIT_DATA_TYPES[split]))
 
-        # Save file_lists using pickle
-        with open(file_lists_filename, "wb") as pickle_file:
-            pickle.dump(file_lists, pickle_file)
 
-    else:
-        # Save file_lists using pickle
-        with open(file_lists_filename, "rb") as pickle_file:
-            file_lists = pickle.load(pickle_file)
+def get_window_shard(file_list):
+    """
+    Return the ShardWindows of the window pickles of file_list from the shard of their directory
+    (<directory>_shard, see get_shard_directory), None if it does not hold all of them.
+    Without --keep_raw_windows, make_STFT_from_edf writes no pickle and the shard is the only copy of the windows
+    """
+    if len(file_list) == 0:
+        return None
+    return ShardWindows.open(file_list, os.path.dirname(file_list[0]).rstrip('/') + '_shard')
+
+
+def load_signals(data_files, shard_dir=None, dtype=args.storage_dtype, shared=args.shared_signals):
+    """
+    Return the N x 20 x 160 x 15 STFT of data_files, stored in dtype (see stft_shards.STORAGE_DTYPES).
+    If shard_dir holds a shard (see make_STFT_shards) containing these windows, they are memory mapped
+    from it without reading any file, otherwise the pickles are read by a pool of args.load_workers.
+    With shared, a SharedSignals is returned: the shard itself when it can be used as is, or a copy
+    written once to args.shared_directory, so the sweep workers only receive its path.
+    """
+    torch_dtype = STORAGE_DTYPES[dtype]
+    signals = None
+    if shard_dir is not None and os.path.isdir(shard_dir):
+        shard = read_shard(shard_dir)
+        indices = shard_indices(shard, data_files)
+        if indices is not None:
+            print("Memory mapping {} windows from {}".format(len(indices), shard_dir))
+            signals = shard['signals']
+            if not np.array_equal(indices, np.arange(signals.shape[0])):
+                signals = signals[torch.from_numpy(indices)]
+            elif shared and signals.dtype == torch_dtype:
+                return SharedSignals(os.path.join(shard_dir, 'signals.npy'), bfloat16=dtype == 'bfloat16')
+            signals = signals.to(torch_dtype)
+        else:
+            print("{} does not contain all the windows, reading the pickles".format(shard_dir))
+
+    if signals is None:
+        signals = read_pickles(data_files, num_workers=args.load_workers, backend=args.load_backend,
+                               share_memory=args.share_memory and not shared, dtype=torch_dtype)
+    if shared:
+        return SharedSignals.from_tensor(signals, directory=args.shared_directory)
+    return signals
+
+
+def get_data(save_dir=args.save_directory, balanced_data=True, return_val_test_signal=False,
+             return_train_signal= False):
+    """
+    The train windows are returned once, balanced_data only reports the size of the balanced train set:
+    the seizure windows are repeated by the sampler of the train loader, not in memory.
+    """
+    file_lists = get_file_lists(save_dir)
 
     print('--------------------  file_lists  --------------------')
     for dirname in file_lists.keys():
@@ -245,19 +332,13 @@ def get_data(save_dir=args.save_directory, balanced_data=True, return_val_test_s
         for classname in file_lists[dirname].keys():
             print('{} num: {}'.format(classname, len(file_lists[dirname][classname])))
 
-    if balanced_data:
-        train_data = file_lists['train']['bckg'] + file_lists['train']['seiz'] * \
-                     int(len(file_lists['train']['bckg']) / len(file_lists['train']['seiz']))
-        seizure_labels = np.ones(len(file_lists['train']['seiz']) *
-                                 int(len(file_lists['train']['bckg']) / len(file_lists['train']['seiz']))
-                                 , dtype=np.int32)
-    else:
-        train_data = file_lists['train']['bckg'] + file_lists['train']['seiz']
-        seizure_labels = np.ones(len(file_lists['train']['seiz']), dtype=np.int32)
-
-    non_seizure_labels = np.zeros(len(file_lists['train']['bckg']), dtype=np.int32)
-    train_label = np.concatenate((non_seizure_labels, seizure_labels))
+    # one copy of each window, the classes are balanced by the sampler of get_dataloader (see balanced_indices)
+    train_data = file_lists['train']['bckg'] + file_lists['train']['seiz']
+    train_label = np.concatenate((np.zeros(len(file_lists['train']['bckg']), dtype=np.int32),
+                                  np.ones(len(file_lists['train']['seiz']), dtype=np.int32)))
     print('len(train_data): {}'.format(len(train_data)))
+    if balanced_data:
+        print('balanced len(train_data): {}'.format(len(balanced_indices(train_label))))
 
     val_data = file_lists['val']['bckg'] + file_lists['val']['seiz']
     test_data = file_lists['test']['bckg'] + file_lists['test']['seiz']
@@ -271,15 +352,9 @@ def get_data(save_dir=args.save_directory, balanced_data=True, return_val_test_s
         test_label = np.concatenate((np.zeros(len(file_lists['test']['bckg'])),
                                      np.ones(len(file_lists['test']['seiz']))))
 
-        train_signal = torch.zeros((len(train_data), 20, 160, 15), dtype=torch.float)
-        validation_signal = torch.zeros((len(val_data), 20, 160, 15), dtype=torch.float)
-        test_signal = torch.zeros((len(test_data), 20, 160, 15), dtype=torch.float)
-        for input_signal, input_data_files in zip([train_signal, validation_signal, test_signal],
-                                                  [train_data, val_data, test_data]):
-            for idx in tqdm(range(len(input_data_files)), desc="Reading input files"):
-                with open(input_data_files[idx], 'rb') as f:
-                    data_pkl = pickle.load(f)
-                    input_signal[idx, :, :, :] = torch.from_numpy(np.asarray(data_pkl['STFT']))
+        train_signal = load_signals(train_data, get_shard_directory(save_dir, 'train'))
+        validation_signal = load_signals(val_data, get_shard_directory(save_dir, 'val'))
+        test_signal = load_signals(test_data, get_shard_directory(save_dir, 'test'))
 
         return (train_data, val_data, test_data,
                 train_signal, train_label,
@@ -292,13 +367,8 @@ def get_data(save_dir=args.save_directory, balanced_data=True, return_val_test_s
         test_label = np.concatenate((np.zeros(len(file_lists['test']['bckg'])),
                                      np.ones(len(file_lists['test']['seiz']))))
 
-        validation_signal = torch.zeros((len(val_data), 20, 160, 15), dtype=torch.float)
-        test_signal = torch.zeros((len(test_data), 20, 160, 15), dtype=torch.float)
-        for input_signal, input_data_files in zip([validation_signal, test_signal], [val_data, test_data]):
-            for idx in tqdm(range(len(input_data_files)), desc="Reading input files"):
-                with open(input_data_files[idx], 'rb') as f:
-                    data_pkl = pickle.load(f)
-                    input_signal[idx, :, :, :] = torch.from_numpy(np.asarray(data_pkl['STFT']))
+        validation_signal = load_signals(val_data, get_shard_directory(save_dir, 'val'))
+        test_signal = load_signals(test_data, get_shard_directory(save_dir, 'test'))
 
         return (train_data, val_data, test_data,
                 None, train_label,
@@ -309,12 +379,128 @@ def get_data(save_dir=args.save_directory, balanced_data=True, return_val_test_s
         return train_data, val_data, test_data, None, train_label, None, None, None, None
 
 
+def get_recording_store_directory(filenames):
+    return os.path.dirname(filenames[0]).rstrip('/') + '_recordings'
+
+
+def recording_store_key(filenames):
+    """
+    Hash of the windows of filenames (path, size and mtime) and of the features computed from them,
+    a recording store written from other windows or features is stale
+    """
+    windows = []
+    for filename in sorted(filenames):
+        stat = os.stat(filename)
+        windows.append([filename, stat.st_size, stat.st_mtime_ns])
+    return params_hash({'eeg_type': args.eeg_type, 'windows': windows})
+
+
+def get_recording_store(filenames, build=args.recording_store):
+    """
+    Return the RecordingStore of the recordings of filenames, None if there is none up to date.
+    With build, the store is (re)written first if it is missing or stale (see make_recording_store)
+    """
+    store_dir = get_recording_store_directory(filenames)
+    sources_key = recording_store_key(filenames)
+    if os.path.isdir(store_dir):
+        store = RecordingStore(store_dir)
+        if store.sources_key == sources_key:
+            return store
+        print("The recording store {} is stale".format(store_dir))
+    if not build:
+        return None
+    make_recording_store(filenames, sources_key=sources_key)
+    return RecordingStore(store_dir)
+
+
+def event_features(signals):
+    # the features TUHDatasetEvent computes for a window
+    if args.eeg_type == 'stft':
+        f, t, signals = spectrogram_unfold_feature(signals)
+    return signals
+
+
+def make_recording_store(filenames, sources_key=None):
+    """
+    Precompute the features of the recordings of filenames for TUHDatasetEvent
+    """
+    if sources_key is None:
+        sources_key = recording_store_key(filenames)
+    write_recording_store(separate_and_sort_filenames(filenames), get_recording_store_directory(filenames),
+                          event_features, sources_key=sources_key)
+
+
+def make_STFT_shards(save_dir=args.save_directory, dtype=args.storage_dtype):
+    """
+    Pack the STFT pickles of every split into a shard read by get_data
+    """
+    manifest = get_manifest(save_dir)
+    file_lists = manifest.file_lists(SPLIT_DATA_TYPES.keys())
+    for split in SPLIT_DATA_TYPES.keys():
+        file_list = file_lists[split]['bckg'] + file_lists[split]['seiz']
+        write_shard(file_list, get_shard_directory(save_dir, split), dtype=dtype)
+        manifest.set_shard_offsets(file_list)
+
+
+def balanced_indices(labels):
+    """
+    Return the indices of the balanced train set: every non-seizure window once and every seizure window
+    int(#non-seizure / #seizure) times
+    """
+    labels = np.asarray(labels)
+    non_seizure_idx = np.where(labels == 0)[0]
+    seizure_idx = np.where(labels == 1)[0]
+    repeats = max(1, int(len(non_seizure_idx) / max(1, len(seizure_idx))))
+    return np.concatenate((non_seizure_idx, np.tile(seizure_idx, repeats)))
+
+
+class RepeatedIndexSampler(Sampler):
+    """
+    Sample a random permutation of indices at every epoch, indices can be repeated to oversample a class
+    of a dataset holding a single copy of each window
+    """
+
+    def __init__(self, indices):
+        self.indices = torch.as_tensor(indices, dtype=torch.long)
+
+    def __iter__(self):
+        return iter(self.indices[torch.randperm(len(self.indices))].tolist())
+
+    def __len__(self):
+        return len(self.indices)
+
+
+def make_loader(dataset, batch_size=1, shuffle=False, sampler=None, batch_sampler=None, num_workers=6,
+                device=None):
+    """
+    Return an InMemoryLoader for a TUHDataset holding its signals in memory, a DataLoader otherwise.
+    device is where the batches are used, the InMemoryLoader pins its buffers only for a CUDA device.
+    """
+    if isinstance(dataset, TUHDataset) and dataset.file_list is None:
+        pin_memory = device is not None and torch.device(device).type == 'cuda'
+        return InMemoryLoader(dataset, batch_size=batch_size, shuffle=shuffle, sampler=sampler,
+                              batch_sampler=batch_sampler, pin_memory=pin_memory)
+    if batch_sampler is not None:
+        return DataLoader(dataset=dataset, batch_sampler=batch_sampler, num_workers=num_workers)
+    return DataLoader(dataset=dataset, batch_size=batch_size, shuffle=shuffle, sampler=sampler,
+                      num_workers=num_workers)
+
+
 def get_dataloader(train_data, val_data, test_data,
                    train_signal, train_label,
                    validation_signal, val_label, test_signal, test_label,
                    batch_size, event_base=False, random_mask=False,
                    return_dataset=False, masking=True, remove_not_used=False,
-                   selected_channel_id = args.selected_channel_id, ):
+                   selected_channel_id = args.selected_channel_id, balanced_data=True, device=None,
+                   window_stride=args.window_stride):
+    """
+    The loaders mask (or remove) the channels of whole batches, see batch_transforms.ChannelMasking. They are meant
+    to be moved to device (if given) by a tensor_loader.Prefetcher, which masks the batches there after the copy.
+    The datasets returned with return_dataset mask every window.
+    The event-based datasets return every window_stride-th window of a recording, from the recording store
+    of the split if there is one (see get_recording_store)
+    """
+    batch_masking = not return_dataset
 
     train_transforms = transforms.ToTensor()
 
@@ -323,48 +509,60 @@ def get_dataloader(train_data, val_data, test_data,
     test_transforms = transforms.ToTensor()
 
     if random_mask:
-        train_data = TUHDataset(train_data, transform=train_transforms, masking=masking)
+        train_data = TUHDataset(train_data, transform=train_transforms, masking=masking, batch_masking=batch_masking)
         if event_base:
-            val_data = TUHDatasetEvent(separate_and_sort_filenames(val_data), transform=val_transforms)
-            test_data = TUHDatasetEvent(separate_and_sort_filenames(test_data), transform=test_transforms)
+            val_data = TUHDatasetEvent(separate_and_sort_filenames(val_data), transform=val_transforms,
+                                       store=get_recording_store(val_data), window_stride=window_stride)
+            test_data = TUHDatasetEvent(separate_and_sort_filenames(test_data), transform=test_transforms,
+                                        store=get_recording_store(test_data), window_stride=window_stride)
         else:
             val_data = TUHDatasetValidation(val_data, transform=val_transforms)
-            test_data = TUHDataset(test_data, transform=test_transforms)
+            test_data = TUHDataset(test_data, transform=test_transforms, batch_masking=batch_masking)
     else:
         # TODO: set selected channels based on json and the args.selected_channel_id
         if train_data is None:
             train_data = TUHDataset(None, signals=train_signal, labels=train_label,
                                     transform=train_transforms,
                                     selected_channel_id=selected_channel_id,
-                                    masking=masking, remove_not_used=remove_not_used)
+                                    masking=masking, remove_not_used=remove_not_used,
+                                    batch_masking=batch_masking)
         else:
             train_data = TUHDataset(train_data, signals=None, labels=None, transform=train_transforms,
                                 selected_channel_id=selected_channel_id,
-                                masking=masking, remove_not_used=remove_not_used)
+                                masking=masking, remove_not_used=remove_not_used,
+                                batch_masking=batch_masking)
         if val_data is None:  # Using signals and labels to speedup. The drawback is that it occupies more memory in GPU
             val_data = TUHDataset(None, signals=validation_signal, labels=val_label, transform=val_transforms,
                                   selected_channel_id=selected_channel_id,
-                                  masking=masking, remove_not_used=remove_not_used)
+                                  masking=masking, remove_not_used=remove_not_used,
+                                  batch_masking=batch_masking)
             test_data = TUHDataset(None, signals=test_signal, labels=test_label, transform=test_transforms,
                                    selected_channel_id=selected_channel_id,
-                                   masking=masking, remove_not_used=remove_not_used)
+                                   masking=masking, remove_not_used=remove_not_used,
+                                   batch_masking=batch_masking)
         else:
             val_data = TUHDataset(val_data, signals= None, labels=None, transform=val_transforms, masking=masking,
                                   selected_channel_id=selected_channel_id,
-                                  remove_not_used=remove_not_used)
+                                  remove_not_used=remove_not_used, batch_masking=batch_masking)
             test_data = TUHDataset(test_data, signals=None, labels=None, transform=test_transforms, masking=masking,
                                    selected_channel_id=selected_channel_id,
-                                   remove_not_used=remove_not_used)
+                                   remove_not_used=remove_not_used, batch_masking=batch_masking)
 
     if return_dataset:
         return train_data, val_data, test_data
 
     else:
-        train_loader = DataLoader(dataset=train_data, batch_size=batch_size, shuffle=True, num_workers=6)
-        val_loader = DataLoader(dataset=val_data, batch_size=batch_size, shuffle=True, num_workers=6)
-        test_loader = DataLoader(dataset=test_data, batch_size=batch_size, shuffle=True, num_workers=6)
+        if balanced_data and train_label is not None:
+            train_loader = make_loader(train_data, batch_size=batch_size,
+                                       sampler=RepeatedIndexSampler(balanced_indices(train_label)), device=device)
+        else:
+            train_loader = make_loader(train_data, batch_size=batch_size, shuffle=True, device=device)
+        val_loader = make_loader(val_data, batch_size=batch_size, shuffle=True, device=device)
+        test_loader = make_loader(test_data, batch_size=batch_size, shuffle=True, device=device)
 
-        return train_loader, val_loader, test_loader
+        return tuple(TransformedLoader(loader, loader.dataset.channel_masking)
+                     if isinstance(loader.dataset, TUHDataset) else loader
+                     for loader in (train_loader, val_loader, test_loader))
 
 
 def _get_sample_frequency(signal_header):
@@ -459,94 +657,199 @@ def read_edf(edf_file, ch_nrs=None, ch_names=None, digital=False, verbose=False)
     return signals, signal_headers, header
 
 
-def generate_lead_wise_data(edf_file):
+@lru_cache(maxsize=None)
+def bandpass_sos(fs, lowcut, highcut, order):
+    """
+    Second-order sections of the band-pass filter of the EEG, designed once per sampling frequency
+    """
+    nyquist_freq = 0.5 * fs
+    return butter(order, [lowcut / nyquist_freq, highcut / nyquist_freq], btype='band', output='sos')
+
+
+def bipolar_montage_matrix(bipolar_montage):
+    """
+    Return the montage as a matrix, with the referential channels it uses and the pairs it computes:
+    bipolar_signals[valid_pairs] = montage_matrix @ signals[used_channels]
+    A pair with a missing channel (-1) is not computed.
+    """
+    bipolar_montage = np.asarray(bipolar_montage, dtype=np.int64).reshape((-1, 2))
+    valid_pairs = np.all(bipolar_montage != -1, axis=1)
+    used_channels = np.unique(bipolar_montage[valid_pairs])
+    montage_matrix = np.zeros((valid_pairs.sum(), len(used_channels)))
+    rows = np.arange(valid_pairs.sum())
+    montage_matrix[rows, np.searchsorted(used_channels, bipolar_montage[valid_pairs, 0])] += 1
+    montage_matrix[rows, np.searchsorted(used_channels, bipolar_montage[valid_pairs, 1])] -= 1
+    return montage_matrix, used_channels, valid_pairs
+
+
+def lead_wise_signals(edf_file):
+    """
+    Return the name of the recording, its 20 bipolar channels band-pass filtered and resampled to
+    GLOBAL_INFO['sample_rate'], and the labels of its slices
+    """
     filename = edf_file.split('/')[-1].split('.edf')[0]
     signals, signal_headers, header = read_edf(edf_file)
-    file_info = TUSZv2_info_df.loc[filename]
+    file_info = get_TUSZv2_info().loc[filename]
     fs = file_info['sampling_frequency']
     length = file_info['length']
     labels = file_info['labels']
     num_target_samples = length * GLOBAL_INFO['sample_rate']
-    signal_list = []
-    disease_labels = {0: 'bckg', 1: 'seiz'}
-    for bipolar_channel in file_info['bipolar_montage']:
-        x = bipolar_channel[0]
-        y = bipolar_channel[1]
 
-        if x == -1 or y == -1:
-            signal_list.append(np.zeros(num_target_samples))
-            continue
+    # all the bipolar channels at once, band-pass filtered (0.1-80 Hz) in one zero-phase pass
+    montage_matrix, used_channels, valid_pairs = bipolar_montage_matrix(file_info['bipolar_montage'])
+    signal_list_ordered = np.zeros((len(valid_pairs), num_target_samples))
+    if valid_pairs.any():
+        bipolar_signals = montage_matrix @ np.asarray([signals[channel] for channel in used_channels])
+        bipolar_signals_filtered = sosfiltfilt(bandpass_sos(fs, **BANDPASS), bipolar_signals, axis=-1)
 
-        bipolar_signal = signals[x] - signals[y]
-        # Define the band-pass filter parameters
-        lowcut = 0.1  # Lower cutoff frequency in Hz
-        highcut = 80  # Upper cutoff frequency in Hz
-        order = 4  # Filter order (adjust as needed)
+        if fs != GLOBAL_INFO['sample_rate']:
+            bipolar_signals_filtered = resample_channels(bipolar_signals_filtered, fs, GLOBAL_INFO['sample_rate'],
+                                                         num_target_samples, method=args.resample_method)
+        elif bipolar_signals_filtered.shape[1] != num_target_samples:
+            signal_list_ordered = np.zeros((len(valid_pairs), bipolar_signals_filtered.shape[1]))
+        signal_list_ordered[valid_pairs] = bipolar_signals_filtered
+    return filename, signal_list_ordered, labels
 
-        # Calculate the normalized cutoff frequencies
-        nyquist_freq = 0.5 * fs  # Nyquist frequency
-        low = lowcut / nyquist_freq
-        high = highcut / nyquist_freq
 
-        # Design and apply the band-pass filter
-        b, a = butter(order, [low, high], btype='band')
-        bipolar_signal_filtered = filtfilt(b, a, bipolar_signal)
+def lead_wise_pieces(edf_file):
+    """
+    Stream the 20 bipolar channels of the recording, band-pass filtered and resampled to GLOBAL_INFO['sample_rate'],
+    as consecutive float32 pieces, so the memory of a worker does not grow with the length of the recording.
+    Only the referential channels of the montage are read, in chunks of args.edf_chunk_seconds extended by
+    args.edf_overlap_seconds on both sides, and the overlap is dropped after the (zero-phase) filter and the
+    resampling, so the chunk edges match the filtering of the whole recording.
+    With args.resample_method fft, the recording is processed whole by lead_wise_signals.
+    Returns the name of the recording, the labels of its slices and the generator of the pieces
+    """
+    if args.resample_method == 'fft':
+        filename, signals, labels = lead_wise_signals(edf_file)
+        return filename, labels, iter([signals.astype(np.float32)])
 
-        if fs != GLOBAL_INFO['sample_rate']:
-            bipolar_signal_resampled = resample(bipolar_signal_filtered, num_target_samples)
-            signal_list.append(bipolar_signal_resampled)
-        else:
-            signal_list.append(bipolar_signal_filtered)
+    filename = edf_file.split('/')[-1].split('.edf')[0]
+    file_info = get_TUSZv2_info().loc[filename]
+    fs = file_info['sampling_frequency']
+    labels = file_info['labels']
+    montage_matrix, used_channels, valid_pairs = bipolar_montage_matrix(file_info['bipolar_montage'])
+    if not valid_pairs.any():
+        return filename, labels, iter([np.zeros((len(valid_pairs), file_info['length'] * GLOBAL_INFO['sample_rate']),
+                                                dtype=np.float32)])
+
+    # the chunks start on a multiple of down, so each one is resampled on the output sample grid
+    up, down = resample_factors(fs, GLOBAL_INFO['sample_rate']) if fs != GLOBAL_INFO['sample_rate'] else (1, 1)
+    chunk_samples = int(np.ceil(args.edf_chunk_seconds * fs / down)) * down
+    overlap_samples = int(np.ceil(args.edf_overlap_seconds * fs / down)) * down
+    montage_matrix = montage_matrix.astype(np.float32)
+
+    def pieces():
+        for start, core_start, core_end, chunk in read_edf_chunks(edf_file, used_channels.tolist(), chunk_samples,
+                                                                  overlap_samples):
+            bipolar_signals = sosfiltfilt(bandpass_sos(fs, **BANDPASS), montage_matrix @ chunk, axis=-1)
+            if (up, down) != (1, 1):
+                bipolar_signals = resample_chunk(bipolar_signals, up, down)
+            # the core of the chunk, in output samples
+            piece_start = (core_start - start) * up // down
+            piece_end = -(-(core_end - start) * up // down)
+            piece = np.zeros((len(valid_pairs), piece_end - piece_start), dtype=np.float32)
+            piece[valid_pairs] = bipolar_signals[:, piece_start:piece_end]
+            yield piece
+
+    return filename, labels, pieces()
+
+
+def save_lead_wise_windows(filename, windows, labels, first_window=0):
+    """
+    Save the n x 20 x window_length windows first_window, first_window + 1, ... of the recording as lead-wise
+    window pickles, returns their paths
+    """
+    disease_labels = {0: 'bckg', 1: 'seiz'}
+    outputs = []
+    for i, slice_eeg in enumerate(windows, start=first_window):
+        label = labels[i]
+        output = "{}/{}_label_{}_index_{}.pkl".format(GLOBAL_INFO['save_directory'], filename, disease_labels[label], i)
+        atomic_pickle_dump({'signals': slice_eeg, 'patient id': filename.split('_')[0],
+                            'label': disease_labels[label]}, output)
+        outputs.append(output)
+    return outputs
 
-    signal_list_ordered = np.asarray(signal_list)
 
-    for i, label in enumerate(labels):
-        slice_eeg = signal_list_ordered[:,
-                    int(i * GLOBAL_INFO['slice_length']) * GLOBAL_INFO['sample_rate']:
-                    int((i + 1) * GLOBAL_INFO['slice_length']) * GLOBAL_INFO['sample_rate']]
+def generate_lead_wise_data(edf_file):
+    filename, labels, pieces = lead_wise_pieces(edf_file)
+    window_length = GLOBAL_INFO['slice_length'] * GLOBAL_INFO['sample_rate']
+    outputs = []
+    for first_window, windows in stream_windows(pieces, window_length, len(labels)):
+        outputs += save_lead_wise_windows(filename, windows, labels, first_window)
+    return edf_file, outputs
 
-        with open("{}/{}_label_{}_index_{}.pkl".format(GLOBAL_INFO['save_directory'],
-                                                       edf_file.split('/')[-1].split('.')[0],
-                                                       disease_labels[label], i), 'wb') as f:
-            pickle.dump({'signals': slice_eeg, 'patient id': edf_file.split('/')[-1].split('.')[0].split('_')[0],
-                         'label': disease_labels[label]}, f)
+
+def STFT_features(signals):
+    """
+    Log-magnitude STFT (0-80 Hz) of the ... x 3072 windows, along the last axis: ... x 160 x 15
+    """
+    nfft = STFT_PARAMS['sampling_rate'] * STFT_PARAMS['freq_resolution']
+    freqs, times, spec = stft(signals, fs=STFT_PARAMS['sampling_rate'], nperseg=STFT_PARAMS['nperseg'],
+                              noverlap=STFT_PARAMS['noverlap'], nfft=nfft, boundary=None, padded=False, axis=-1)
+    spec = spec[..., :STFT_PARAMS['cutoff_freq'] * STFT_PARAMS['freq_resolution'], :]
+    return (np.log(np.abs(spec) + 1e-10)).astype(np.float32)
 
 
 def generate_STFT(pickle_file):
     save_directory = "{}/task-{}_datatype-{}_STFT".format(args.save_directory, args.task_type, args.data_type)
 
-    nperseg = 256
-    noverlap = 64
-    sampling_rate = 256
-    freq_resolution = 2
-    nfft = sampling_rate * freq_resolution
-    cutoff_freq = 80
-
     with open(pickle_file, 'rb') as f:
         data_pkl = pickle.load(f)
         signals = np.asarray(data_pkl['signals'])
         if signals.shape != (20, 3072):
             print("Error in shape: ", signals.shape)
 
-        freqs, times, spec = stft(signals, fs=sampling_rate, nperseg=nperseg, noverlap=noverlap, nfft=nfft,
-                                  boundary=None, padded=False)
-
-        spec = spec[:, :cutoff_freq*freq_resolution, :]
-        amp = (np.log(np.abs(spec) + 1e-10)).astype(np.float32)
+        amp = STFT_features(signals)
 
         label = data_pkl['label']
-        with open("{}/{}.pkl".format(save_directory, pickle_file.split('/')[-1].split('.')[0]), 'wb') as out_f:
-            pickle.dump({'STFT': amp, 'label': label}, out_f)
+        output = "{}/{}.pkl".format(save_directory, pickle_file.split('/')[-1].split('.')[0])
+        atomic_pickle_dump({'STFT': amp, 'label': label}, output)
+    return pickle_file, [output]
 
 
-def run_multi_process(f, l: list, n_processes=1):
+def generate_STFT_windows(task, batch_size=64):
+    """
+    Compute the STFT of the windows of a recording from its lead-wise pieces, batch_size windows per call,
+    and write them straight into the shard being written (GLOBAL_INFO['shard_signals']).
+    task is the EDF file and the offsets of the windows of the recording in the shard.
+    With GLOBAL_INFO['keep_raw_windows'], the lead-wise window pickles of main are saved as well.
+    Returns the EDF file and the files written
+    """
+    edf_file, offsets = task
+    filename, labels, pieces = lead_wise_pieces(edf_file)
+    shard_signals = np.load(GLOBAL_INFO['shard_signals'], mmap_mode='r+')
+    window_length = GLOBAL_INFO['slice_length'] * GLOBAL_INFO['sample_rate']
+    outputs = []
+    for first_window, windows in stream_windows(pieces, window_length, len(labels)):
+        if GLOBAL_INFO['keep_raw_windows']:
+            outputs += save_lead_wise_windows(filename, windows, labels, first_window)
+        for start in range(0, len(windows), batch_size):
+            batch = windows[start:start + batch_size]
+            batch_offsets = offsets[first_window + start:first_window + start + len(batch)]
+            shard_signals[batch_offsets] = to_storage(STFT_features(batch), GLOBAL_INFO['storage_dtype'])
+    shard_signals.flush()
+    return edf_file, outputs
+
+
+def run_multi_process(f, l: list, n_processes=1, callback=None):
+    """
+    Map f over l with a pool of n_processes. If callback is given, it is called on each result as soon as
+    it is returned, instead of keeping the results
+    """
     n_processes = min(n_processes, len(l))
     print('processes num: {}'.format(n_processes))
+    if n_processes == 0:
+        return []
 
     results = []
     pool = Pool(processes=n_processes)
     for r in tqdm(pool.imap_unordered(f, l), total=len(l), ncols=75):
-        results.append(r)
+        if callback is not None:
+            callback(r)
+        else:
+            results.append(r)
 
     pool.close()
     pool.join()
@@ -554,30 +857,23 @@ def run_multi_process(f, l: list, n_processes=1):
     return results
 
 
-def main(args):
+def init_global_info(args, edf_list, data_directory, save_directory):
     channel_list = ['EEG FP1', 'EEG FP2', 'EEG F3', 'EEG F4', 'EEG F7', 'EEG F8', 'EEG C3', 'EEG C4', 'EEG CZ',
                     'EEG T3', 'EEG T4', 'EEG P3', 'EEG P4', 'EEG O1', 'EEG O2', 'EEG T5', 'EEG T6', 'EEG PZ', 'EEG FZ']
 
-    save_directory = "{}/task-{}_datatype-{}".format(args.save_directory, args.task_type, args.data_type)
-    if os.path.isdir(save_directory):
-        os.system("rm -r {}".format(save_directory))
-    os.system("mkdir -p {}".format(save_directory))
-
-    data_directory = "{}/edf/{}".format(args.data_directory, args.data_type)
-
     if args.task_type == "binary":
         disease_labels = {'bckg': 0, 'seiz': 1}
     else:
         exit(-1)
 
-    edf_list = search_walk({'path': data_directory, 'extensions': [".edf", ".EDF"]})
-
+    GLOBAL_INFO.clear()
     GLOBAL_INFO['channel_list'] = channel_list
     GLOBAL_INFO['disease_labels'] = disease_labels
     GLOBAL_INFO['save_directory'] = save_directory
     GLOBAL_INFO['label_type'] = args.label_type
     GLOBAL_INFO['sample_rate'] = args.sample_rate
     GLOBAL_INFO['slice_length'] = args.slice_length
+    GLOBAL_INFO['keep_raw_windows'] = args.keep_raw_windows
     # GLOBAL_INFO['disease_type'] = args.disease_type
 
     print("Number of EDF files: ", len(edf_list))
@@ -586,28 +882,177 @@ def main(args):
     with open(data_directory + '/preprocess_info.pickle', 'wb') as pkl:
         pickle.dump(GLOBAL_INFO, pkl, protocol=pickle.HIGHEST_PROTOCOL)
 
+
+def get_ledger(save_dir=args.save_directory):
+    """
+    Return the ledger of the recordings preprocessed into save_dir (opened once per process)
+    """
+    if save_dir not in LEDGERS:
+        os.makedirs(save_dir, exist_ok=True)
+        LEDGERS[save_dir] = PreprocessLedger(os.path.join(save_dir, 'preprocess_ledger.sqlite'),
+                                             checksum=args.ledger_checksum)
+    return LEDGERS[save_dir]
+
+
+def recording_info(edf_file):
+    """
+    The row of TUSZv2_info.json the windows of an EDF file depend on: its labels, length, sampling frequency
+    and montage
+    """
+    file_info = get_TUSZv2_info().loc[edf_file.split('/')[-1].split('.edf')[0]]
+    return {name: file_info[name] for name in ['labels', 'length', 'sampling_frequency', 'bipolar_montage']}
+
+
+def preprocess_params(args, stage):
+    """
+    The parameters the outputs of a preprocessing stage ('lead_wise', 'STFT' or 'STFT_shard') depend on.
+    The stages reading the EDF files get a function of the EDF file, which adds its recording_info
+    """
+    lead_wise = {'sample_rate': args.sample_rate, 'slice_length': args.slice_length, 'bandpass': BANDPASS,
+                 'resample_method': args.resample_method, 'edf_chunk_seconds': args.edf_chunk_seconds,
+                 'edf_overlap_seconds': args.edf_overlap_seconds}
+    if stage == 'STFT':
+        return {'stft': STFT_PARAMS}
+    if stage == 'STFT_shard':
+        lead_wise = dict(lead_wise, stft=STFT_PARAMS, storage_dtype=args.storage_dtype,
+                         keep_raw_windows=args.keep_raw_windows)
+    return lambda edf_file: dict(lead_wise, recording=recording_info(edf_file))
+
+
+def main(args):
+    """
+    Save the lead-wise windows of the EDF files of args.data_type, only for the recordings which are new, changed
+    or not finished since the last run (see PreprocessLedger)
+    """
+    save_directory = "{}/task-{}_datatype-{}".format(args.save_directory, args.task_type, args.data_type)
+    os.makedirs(save_directory, exist_ok=True)
+    remove_partial_files(save_directory)
+
+    data_directory = "{}/edf/{}".format(args.data_directory, args.data_type)
+    edf_list = search_walk({'path': data_directory, 'extensions': [".edf", ".EDF"]})
+    init_global_info(args, edf_list, data_directory, save_directory)
+
+    ledger = get_ledger(args.save_directory)
+    params = preprocess_params(args, 'lead_wise')
+    edf_list = ledger.update(save_directory, edf_list, params)
+
     # for edf_file in tqdm(edf_list[:4]):
     #     generate_lead_wise_data(edf_file)
-    run_multi_process(generate_lead_wise_data, edf_list, n_processes=6)
+    run_multi_process(generate_lead_wise_data, edf_list, n_processes=args.preprocess_workers,
+                      callback=lambda result: ledger.record(save_directory, result[0], params, result[1]))
 
 
 def make_STFT(args):
+    """
+    Compute the STFT of the lead-wise windows which are new, changed or not finished since the last run
+    """
     save_directory = "{}/task-{}_datatype-{}_STFT".format(args.save_directory, args.task_type, args.data_type)
-    if os.path.isdir(save_directory):
-        os.system("rm -r {}".format(save_directory))
-    os.system("mkdir -p {}".format(save_directory))
+    os.makedirs(save_directory, exist_ok=True)
+    remove_partial_files(save_directory)
 
     data_directory = "{}/task-{}_datatype-{}".format(args.save_directory, args.task_type, args.data_type)
     pickle_list = []
-    for pickle_file in os.listdir(data_directory):
+    for pickle_file in sorted(os.listdir(data_directory)):
         if pickle_file.endswith(".pkl"):
             pickle_list.append(os.path.join(data_directory, pickle_file))
 
-    run_multi_process(generate_STFT, pickle_list, n_processes=6)
+    ledger = get_ledger(args.save_directory)
+    params = preprocess_params(args, 'STFT')
+    pickle_list = ledger.update(save_directory, pickle_list, params)
+    run_multi_process(generate_STFT, pickle_list, n_processes=args.preprocess_workers,
+                      callback=lambda result: ledger.record(save_directory, result[0], params, result[1]))
     # for pickle_file in tqdm(pickle_list[:1]):
     #     generate_STFT(pickle_file)
 
 
+def make_STFT_from_edf(args):
+    """
+    Fused main + make_STFT + make_STFT_shards: each worker streams an EDF file through the montage, filter,
+    resampling, windowing and STFT (see lead_wise_pieces), and writes the STFT of its windows straight into the
+    shard of the split. No lead-wise or STFT pickle is written (unless
+    args.keep_raw_windows), the manifest lists the windows of the shard (see get_manifest).
+    The windows are stored in the order of the manifest file lists, so get_data maps the shard as is.
+    Only the recordings which are new or changed since the last run (see PreprocessLedger) are processed.
+    If there is none, the shard is left as it is. Otherwise the windows of the others are copied from the previous
+    shard into a new one, which replaces it once complete so the previous shard can be read until then:
+    a run with any change reads and writes the whole shard (I/O in the size of the split, not of the changes).
+    Each recording is recorded in the ledger of the temporary shard as soon as its worker returns, so after an
+    interruption the temporary shard is reopened and only the recordings which were not finished are processed again.
+    """
+    save_directory = "{}/task-{}_datatype-{}".format(args.save_directory, args.task_type, args.data_type)
+    shard_dir = "{}/task-{}_datatype-{}_STFT_shard".format(args.save_directory, args.task_type, args.data_type)
+    if args.keep_raw_windows:
+        os.makedirs(save_directory, exist_ok=True)
+        remove_partial_files(save_directory)
+
+    data_directory = "{}/edf/{}".format(args.data_directory, args.data_type)
+    edf_list = search_walk({'path': data_directory, 'extensions': [".edf", ".EDF"]})
+    init_global_info(args, edf_list, data_directory, save_directory)
+
+    # every window of the split, ordered by label, recording and index like Manifest.file_lists
+    disease_labels = {0: 'bckg', 1: 'seiz'}
+    windows = []
+    for edf_file in edf_list:
+        filename = edf_file.split('/')[-1].split('.edf')[0]
+        windows += [(label, filename, i) for i, label in enumerate(get_TUSZv2_info().loc[filename]['labels'])]
+    windows.sort()
+    window_names = ['{}_label_{}_index_{}.pkl'.format(filename, disease_labels[label], i)
+                    for label, filename, i in windows]
+    recording_offsets = {}
+    for offset, (label, filename, i) in enumerate(windows):
+        recording_offsets.setdefault(filename, []).append((i, offset))
+    recording_offsets = {filename: [offset for _, offset in sorted(offsets)]
+                         for filename, offsets in recording_offsets.items()}
+
+    ledger = get_ledger(args.save_directory)
+    params = preprocess_params(args, 'STFT_shard')
+    pending = set(ledger.update(shard_dir, edf_list, params))
+    if not pending and same_layout(shard_dir, window_names, args.storage_dtype):
+        if os.path.isdir(shard_dir + '.tmp'):  # left by an interrupted run, whose recordings are all in the shard
+            shutil.rmtree(shard_dir + '.tmp')
+        print("{} is up to date".format(shard_dir))
+        return
+
+    # the recordings already written into the temporary shard by an interrupted run
+    writer = ShardWriter(window_names, shard_dir, dtype=args.storage_dtype, resume=True)
+    tmp_stage = writer.tmp_dir
+    if writer.resumed:
+        resumed = set(edf_list) - set(ledger.update(tmp_stage, edf_list, params))
+    else:
+        resumed = set()
+        ledger.update(tmp_stage, [], params)
+    pending -= resumed
+    print("{} recordings resumed from {}".format(len(resumed), tmp_stage))
+
+    if os.path.isdir(shard_dir):
+        previous = read_shard(shard_dir)
+        previous_index = {filename: idx for idx, filename in enumerate(previous['filenames'])}
+        for edf_file in edf_list:
+            if edf_file in pending or edf_file in resumed:
+                continue
+            offsets = recording_offsets[edf_file.split('/')[-1].split('.edf')[0]]
+            indices = [previous_index.get(window_names[offset]) for offset in offsets]
+            if any(idx is None for idx in indices):
+                pending.add(edf_file)
+            else:
+                writer.write(offsets, previous['signals'][torch.tensor(indices)])
+        del previous
+    else:
+        pending = set(edf_list) - resumed
+    print("{} recordings to process, {} copied from {}".format(
+        len(pending), len(edf_list) - len(pending) - len(resumed), shard_dir))
+
+    # the workers write the windows of their recording into the signals of the shard (flushed before they return)
+    GLOBAL_INFO['shard_signals'] = writer.signals_path
+    GLOBAL_INFO['storage_dtype'] = args.storage_dtype
+    tasks = [(edf_file, recording_offsets[edf_file.split('/')[-1].split('.edf')[0]]) for edf_file in sorted(pending)]
+    run_multi_process(generate_STFT_windows, tasks, n_processes=args.preprocess_workers,
+                      callback=lambda result: ledger.record(tmp_stage, result[0], params, result[1]))
+    writer.close()
+    ledger.move(tmp_stage, shard_dir)
+    print("{} windows written to {}".format(len(windows), shard_dir))
+
+
 def save_validation_inference():
     batch_size = 100
     _, val_loader, test_loader = get_data_loader(batch_size)
@@ -623,4 +1068,6 @@ def save_validation_inference():
 
 if __name__ == '__main__':
     # make_STFT(args)
+    # make_STFT_from_edf(args)
+    # make_STFT_shards(args.save_directory)
     pass
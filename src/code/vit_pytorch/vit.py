@@ -88,6 +88,7 @@ class ViT(nn.Module):
         assert image_height % patch_height == 0 and image_width % patch_width == 0, 'Image dimensions must be divisible by the patch size.'
 
         num_patches = (image_height // patch_height) * (image_width // patch_width)
+        self.patch_grid = (image_height // patch_height, image_width // patch_width)
         patch_dim = channels * patch_height * patch_width
         assert pool in {'cls', 'mean'}, 'pool type must be either cls (cls token) or mean (mean pooling)'
 
@@ -110,13 +111,37 @@ class ViT(nn.Module):
             nn.Linear(dim, num_classes)
         )
 
-    def forward(self, img):
-        x = self.to_patch_embedding(img)
+    def embed_patches(self, img):
+        return self.to_patch_embedding(img)
+
+    def channel_patch_mask(self, channel_mask):
+        # the image is built by stacking `len(channel_mask)` channels along the height,
+        # so every channel owns a contiguous run of patch rows (patches are ordered (h w))
+        channel_mask = torch.as_tensor(channel_mask, dtype = torch.bool)
+        num_rows, num_cols = self.patch_grid
+        assert num_rows % channel_mask.shape[-1] == 0, 'patch rows must be divisible by the number of channels'
+        patches_per_channel = (num_rows // channel_mask.shape[-1]) * num_cols
+        return channel_mask.repeat_interleave(patches_per_channel, dim = -1)
+
+    def constant_patch_embedding(self, value):
+        # embedding of a patch whose pixels are all `value`, e.g. the -1 used for absent channels
+        weight = self.to_patch_embedding[1].weight
+        patch_dim = weight.shape[1]
+        patch = torch.full((1, patch_dim), value, dtype = weight.dtype, device = weight.device)
+        return self.to_patch_embedding[1](patch)[0]
+
+    def forward_patches(self, x, positions = None):
         b, n, _ = x.shape
 
+        if positions is None:
+            pos_embedding = self.pos_embedding[:, :(n + 1)]
+        else:
+            # the tokens keep the positional embedding of the patch they come from
+            pos_embedding = torch.cat((self.pos_embedding[:, :1], self.pos_embedding[:, positions + 1]), dim = 1)
+
         cls_tokens = repeat(self.cls_token, '1 1 d -> b 1 d', b = b)
         x = torch.cat((cls_tokens, x), dim=1)
-        x += self.pos_embedding[:, :(n + 1)]
+        x += pos_embedding
         x = self.dropout(x)
 
         x = self.transformer(x)
@@ -125,3 +150,15 @@ class ViT(nn.Module):
 
         x = self.to_latent(x)
         return self.mlp_head(x)
+
+    def forward(self, img, channel_mask = None):
+        if channel_mask is None:
+            x = self.to_patch_embedding(img)
+            return self.forward_patches(x)
+
+        # channel_mask is True for the absent channels, only the patches of the present ones become tokens
+        keep = ~self.channel_patch_mask(channel_mask).to(img.device)
+        positions = keep.nonzero().squeeze(1)
+        to_patches, patch_to_embedding = self.to_patch_embedding
+        x = patch_to_embedding(to_patches(img)[:, positions])
+        return self.forward_patches(x, positions = positions)
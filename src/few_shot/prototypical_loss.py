@@ -34,6 +34,20 @@ def euclidean_dist(x, y):
     return torch.pow(x - y, 2).sum(2)
 
 
+def cosine_dist(x, y):
+    '''
+    Compute the cosine distance (1 - cosine similarity) between two tensors
+    '''
+    # x: N x D
+    # y: M x D
+    if x.size(1) != y.size(1):
+        raise Exception
+
+    x = F.normalize(x, dim=1)
+    y = F.normalize(y, dim=1)
+    return 1 - torch.matmul(x, y.t())
+
+
 def prototypical_loss(input, target, n_support):
     """
     Inspired by https://github.com/jakesnell/prototypical-networks/blob/master/protonets/models/few_shot.py
@@ -103,7 +117,7 @@ def get_prototypes(input, target):
     return prototypes
 
 
-def prototypical_evaluation(prototypes, inputs):
+def prototypical_evaluation(prototypes, inputs, distance_fn=euclidean_dist):
     """
     Inspired by https://github.com/jakesnell/prototypical-networks/blob/master/protonets/models/few_shot.py
 
@@ -118,9 +132,10 @@ def prototypical_evaluation(prototypes, inputs):
     - target: ground truth for the above batch of samples
     - n_support: number of samples to keep in account when computing
       barycentres, for each one of the current classes
+    - distance_fn: distance between the samples and the prototypes, euclidean_dist by default
     """
     query_samples = inputs
-    dists = euclidean_dist(query_samples, prototypes)
+    dists = distance_fn(query_samples, prototypes)
     log_p_y = F.softmax(-dists, dim=1)
     y_hat = log_p_y.argmax(dim=1)
     y_prob = log_p_y[:, 1]
@@ -129,3 +144,43 @@ def prototypical_evaluation(prototypes, inputs):
 
 
 
+
+
+def get_batched_prototypes(input, target):
+    """
+    Same as get_prototypes for a block of K independent support sets sharing the same target
+    Args:
+    - input: the model output for K versions of the support set, K x n_support x D
+    - target: ground truth of the support set, n_support
+    Returns the prototypes, K x n_classes x D
+    """
+    target = target.to(input.device)
+    classes = torch.unique(target)
+    return torch.stack([input[:, target.eq(c)].mean(1) for c in classes], dim=1)
+
+
+def batched_prototypical_evaluation(prototypes, inputs):
+    """
+    Same as prototypical_evaluation for a block of K configurations
+    Args:
+    - prototypes: K x n_classes x D
+    - inputs: the model output of the queries for each configuration, K x N x D
+    Returns the probability of class 1 and the predicted class, both K x N
+    """
+    dists = torch.pow(inputs.unsqueeze(2) - prototypes.unsqueeze(1), 2).sum(3)
+    p_y = F.softmax(-dists, dim=2)
+    y_hat = p_y.argmax(dim=2)
+    y_prob = p_y[:, :, 1]
+    return y_prob, y_hat
+
+
+def batched_prototypical_log_odds(prototypes, inputs):
+    """
+    Log-odds of class 1 (log p(1) - log p(0)) of batched_prototypical_evaluation for two classes, K x N
+    Unlike the probabilities, they do not saturate when the distances to the prototypes are large
+    Args:
+    - prototypes: K x 2 x D
+    - inputs: the model output of the queries for each configuration, K x N x D
+    """
+    dists = torch.pow(inputs.unsqueeze(2) - prototypes.unsqueeze(1), 2).sum(3)
+    return dists[:, :, 0] - dists[:, :, 1]
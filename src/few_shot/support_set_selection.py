@@ -5,6 +5,7 @@ import os
 import pickle
 from src.code.prepare_dataset import zero_crossings, calculateMovingAvrgMeanWithUndersampling_v2
 from src.code.prepare_dataset import calculateOtherMLfeatures_oneCh
+from src.code.manifest import Manifest
 
 from multiprocessing import Pool
 from functools import partial
@@ -16,6 +17,13 @@ from sklearn.metrics import roc_auc_score, confusion_matrix, precision_recall_cu
 from sklearn_extra.cluster import KMedoids
 from sklearn.preprocessing import StandardScaler
 
+# the lead-wise window pickles of each split, their features are saved in <directory>_features
+PREPROCESS_DIRECTORY = "../../TUSZv2/preprocess"
+WINDOW_DIRECTORIES = {split: "{}/task-binary_datatype-{}".format(PREPROCESS_DIRECTORY, data_type)
+                      for split, data_type in [('train', 'train'), ('val', 'dev'), ('test', 'eval')]}
+# the manifest opened by each process (an sqlite connection is not to be used across a fork)
+WINDOW_MANIFESTS = {}
+
 
 def get_features(signals):
     """
@@ -82,6 +90,16 @@ def get_features(signals):
     return all_features
 
 
+def get_window_manifest():
+    """
+    Manifest of the lead-wise windows of the splits (see src.code.manifest), opened once per process and
+    refreshed with the files added or removed since the last call
+    """
+    if os.getpid() not in WINDOW_MANIFESTS:
+        WINDOW_MANIFESTS[os.getpid()] = Manifest(os.path.join(PREPROCESS_DIRECTORY, 'lead_wise_manifest.sqlite'))
+    return WINDOW_MANIFESTS[os.getpid()].refresh(WINDOW_DIRECTORIES)
+
+
 def process_file(file_path, features_dir):
     try:
         # Load data from the pickle file
@@ -106,14 +124,14 @@ def process_file(file_path, features_dir):
 
 
 def process_files():
-    dir_name = "../../TUSZv2/preprocess/task-binary_datatype-train"
+    dir_name = WINDOW_DIRECTORIES['train']
     # Check if the directory exists
     if not os.path.exists(dir_name):
         print(f"Directory '{dir_name}' does not exist.")
         return
 
-    # Get a list of files in the directory
-    file_list = os.listdir(dir_name)
+    # Get the list of the windows of the directory
+    file_list = get_window_manifest().paths(split='train')
 
     # Create a new directory for saving the features
     features_dir = dir_name + "_features"
@@ -124,45 +142,43 @@ def process_files():
     with Pool(num_processes) as pool:
         # Map the file processing function to the list of files
         partial_process_file = partial(process_file, features_dir=features_dir)
-        list(tqdm(pool.imap(partial_process_file, [os.path.join(dir_name, filename) for filename in file_list]),
+        list(tqdm(pool.imap(partial_process_file, file_list),
                   total=len(file_list), desc="Processing Files", unit="file"))
 
 
-def load_features_from_folder(folder_path):
+def load_features(split):
+    """
+    Load the features saved by process_file for the windows of split in the manifest, with their labels
+    (0 for bckg, 1 for seiz) and names
+    """
     features = []
     labels = []
     filenames = []
+    folder_path = WINDOW_DIRECTORIES[split] + "_features"
     if not os.path.exists(folder_path):
         print(f"Directory '{folder_path}' does not exist.")
         return
 
-    for filename in os.listdir(folder_path):
-        if filename.endswith("_features.pkl"):
-            file_path = os.path.join(folder_path, filename)
-            with open(file_path, 'rb') as file:
-                feature_vector = pickle.load(file)
-                features.append(feature_vector)
-
-            # Extract the label from the filename (positive if "seiz" in filename, otherwise negative)
-            if "seiz" in filename:
-                label = 1
-            else:
-                label = 0
-            labels.append(label)
-            filenames.append(filename.split("_features.pkl")[0])
+    for path, label in get_window_manifest().query(('path', 'label'), split=split):
+        filename = os.path.splitext(os.path.basename(path))[0]
+        file_path = os.path.join(folder_path, filename + "_features.pkl")
+        if not os.path.exists(file_path):  # the window could not be processed
+            continue
+        with open(file_path, 'rb') as file:
+            feature_vector = pickle.load(file)
+            features.append(feature_vector)
+        labels.append(label)
+        filenames.append(filename)
 
     return np.array(features), np.array(labels), np.array(filenames)
 
 
 def train_random_forest():
-    train_folder = "../../TUSZv2/preprocess/task-binary_datatype-train_features"
-    train_features, y_train, _ = load_features_from_folder(train_folder)
+    train_features, y_train, _ = load_features('train')
     print("Train data extracted!")
-    dev_folder = "../../TUSZv2/preprocess/task-binary_datatype-dev_features"
-    dev_features, y_dev, _ = load_features_from_folder(dev_folder)
+    dev_features, y_dev, _ = load_features('val')
     print("Dev data extracted!")
-    test_folder = "../../TUSZv2/preprocess/task-binary_datatype-eval_features"
-    test_features, y_test, _ = load_features_from_folder(test_folder)
+    test_features, y_test, _ = load_features('test')
     print("Eval data extracted!")
 
     # Create a Random Forest Classifier with desired parameters
@@ -215,15 +231,13 @@ def inference_random_forest():
     model_path = '../../output/rf_model.pkl'
     loaded_model = joblib.load(model_path)
 
-    dev_folder = "../../TUSZv2/preprocess/task-binary_datatype-dev_features"
-    dev_features, y_dev, _ = load_features_from_folder(dev_folder)
+    dev_features, y_dev, _ = load_features('val')
     predicted_probabilities = loaded_model.predict_proba(dev_features)
     threshold = thresh_max_f1(y_dev, predicted_probabilities[:, 1])
     print("Best threshold ", threshold)
 
     # Now you can use the loaded_model to make predictions on new data
-    test_folder = "../../TUSZv2/preprocess/task-binary_datatype-eval_features"
-    test_features, y_test, _ = load_features_from_folder(test_folder)
+    test_features, y_test, _ = load_features('test')
     predicted_probabilities = loaded_model.predict_proba(test_features)
     auc_score = roc_auc_score(y_test, predicted_probabilities[:, 1])
     print(f"AUC Score: {auc_score:.4f}")
@@ -257,8 +271,7 @@ def apply_kmedoids_to_class(class_features, class_label, n_clusters):
 
 
 def k_mean_clusters():
-    train_folder = "../../TUSZv2/preprocess/task-binary_datatype-train_features"
-    train_features, labels, filenames = load_features_from_folder(train_folder)
+    train_features, labels, filenames = load_features('train')
     train_features = train_features.astype(np.float32)
 
     # Create a StandardScaler object